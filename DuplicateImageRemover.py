@@ -2,11 +2,15 @@ import os
 import ctypes
 import shutil
 import imagehash
+import numpy as np
 from PIL import Image
 from utils.utils import setup_logger
 from collections import defaultdict
 from utils.utils import FileTools
 from utils.media_db import FileHashDB
+from utils.media_scanner import MediaScanner
+from utils.path_matcher import PathMatcher
+from utils.metrics import metrics
 from colorama import Fore, Style, init
 from tqdm import tqdm
 
@@ -15,7 +19,21 @@ from tqdm import tqdm
 Currently scan images will exclude any exclusion directories set by self.exclusion_directories, but if the the scan_image method 
 """
 
+def _dct_matrix(size, keep):
+    """ Rows of the (unnormalized, type II) DCT matrix for the first keep frequencies, same scaling as scipy.fftpack.dct """
+    k = np.arange(keep).reshape(-1, 1)
+    n = np.arange(size).reshape(1, -1)
+    return 2.0 * np.cos(np.pi * k * (2 * n + 1) / (2 * size))
+
+
 class DuplicateImageRemover:
+    HASH_NORMALIZE_SIZE = 256                   # images are resized to this before phash
+    HASH_METHODS = ("full", "fast")
+    PHASH_SIZE = 8                              # 8x8 low frequencies -> 64 bit hash (imagehash.phash defaults)
+    PHASH_INPUT_SIZE = 32                       # grayscale buffer the DCT runs on (hash_size * highfreq_factor)
+    HASH_BATCH_SIZE = 64                        # images hashed per phash_batch call by scan_images
+    _DCT = _dct_matrix(PHASH_INPUT_SIZE, PHASH_SIZE)
+
     def __init__(self, root_dir, logger, extensions=(".jpg", ".jpeg", ".JPG", ".JPEG")):
         self.root_dir = root_dir
         self.extensions = extensions
@@ -23,13 +41,17 @@ class DuplicateImageRemover:
         self.seen_hashes = {}
         self.duplicates = []
         self.exclude_directories = []
+        self.exclusion_matcher = PathMatcher()  # exclude_directories precompiled, see is_excluded
+        self.atomic_registration = False        # True when several processes register hashes in the same db (see check_image)
+        self.near_duplicate_threshold = 0       # max hamming distance between hashes counted as a duplicate, 0 = exact only
+        self.hash_method = "full"               # "full" decodes every pixel, "fast" decodes at reduced resolution (see hash_image)
 
         self.logger = logger
         self.logger.info("TEST TEST TEST")
 
-    def load_image_hash_db(self, path):
+    def load_image_hash_db(self, path, batch_size=500, journal_mode="WAL"):
         self.logger.info(f"Loading hash database: {path}")
-        self.img_hash_db = FileHashDB(path)
+        self.img_hash_db = FileHashDB(path, batch_size=batch_size, journal_mode=journal_mode)
 
         if os.path.isfile(path):
             print("Media database loaded")
@@ -57,25 +79,63 @@ class DuplicateImageRemover:
                     print("invalid Input.  Input 'yes' to continue")
 
         self.img_hash_db._init_db()
+        self.img_hash_db.hash_method = self.hash_method
 
-    def get_image_hash(self, path, logger=None, hash_obj=False):
+    def set_hash_method(self, method):
+        """
+        Sets how images are decoded for hashing ("full" or "fast", see hash_image).  Hashes of the two methods
+        can differ by a few bits, check_hash_compatibility / rehash_database.py report and migrate stored rows.
+        """
+        if method not in self.HASH_METHODS:
+            raise ValueError(f"Unknown hash method: {method}.  Expected one of {self.HASH_METHODS}")
+        self.hash_method = method
+        if hasattr(self, "img_hash_db"):
+            self.img_hash_db.hash_method = method
+            other = {m: n for m, n in self.img_hash_db.hash_method_counts().items() if m != method}
+            if other:
+                self.logger.info(f"WARNING - media.db contains hashes from another hash method {other}. Run rehash_database.py to migrate them")
+
+    def load_hash_index(self, memory_budget_mb=64, bloom=False):
+        """ Preloads all known hashes into memory (see FileHashDB.load_hash_index) """
+        index = self.img_hash_db.load_hash_index(memory_budget_mb, bloom=bloom)
+        self.logger.info(f"Loaded hash index ({index.mode} mode, {index.memory_usage() / 1024 / 1024:.1f} MB)")
+        return index
+
+    def enable_near_duplicates(self, threshold):
+        """
+        Counts images whose hash is within threshold bits of a stored hash as duplicates (re-compressed,
+        resized or re-exported copies).  Builds the hamming index over media.db, 0 disables it.
+        """
+        self.near_duplicate_threshold = int(threshold or 0)
+        if self.near_duplicate_threshold > 0:
+            index = self.img_hash_db.load_hamming_index(self.near_duplicate_threshold)
+            self.logger.info(f"Near duplicate detection enabled. Threshold: {self.near_duplicate_threshold} bits, {len(index)} hashes indexed")
+
+    def is_near_duplicate(self, image_path, img_hash):
+        """ True if a stored hash is within self.near_duplicate_threshold bits of img_hash """
+        if self.near_duplicate_threshold <= 0:
+            return False
+        matches = self.img_hash_db.find_similar(img_hash, self.near_duplicate_threshold)
+        if matches:
+            distance, match = matches[0]
+            self.logger.info(f"Near duplicate: {image_path} is {distance} bits from {match}")
+            return True
+        return False
+
+    def get_image_hash(self, path, logger=None, hash_obj=False, img=None):
         """
         Load image and return hash based on pixel content (ignores metadata).
+        - img can be passed if the image is already decoded, so the file isn't read a second time
         """
 
         hash = self.img_hash_db.get_hash(path)
 
         if hash is None:
             try:
+                if img is not None:
+                    return self.hash_image(img, hash_obj)
                 with Image.open(path) as img:
-                    # Convert to a fixed format so compression artifacts don’t alter the hash
-                    img = img.convert("RGB")  # ensure consistent color mode
-                    img = img.resize((256, 256), Image.LANCZOS)  # fixed size normalization
-
-                    if hash is True:
-                        return imagehash.phash(img)             # return hash object
-                    else:
-                        return str(imagehash.phash(img))        # return hash string (default)
+                    return self.hash_image(img, hash_obj)
 
             except Exception as e:
                 message = f"Failed to get image hash for {path}: {e}"
@@ -87,6 +147,153 @@ class DuplicateImageRemover:
         else:
             return hash
 
+    def hash_pixels(self, img, method=None):
+        """
+        Returns the 32x32 grayscale buffer (uint8 array) phash is computed from.  Feed a list of them
+        to phash_batch.
+        - method "fast" decodes at reduced resolution: JPEG DCT scaling / HEIC embedded thumbnail through
+          Image.draft if the image isn't loaded yet, else a box reduce before the resize
+        """
+        method = method or self.hash_method
+        size = self.HASH_NORMALIZE_SIZE
+        if method == "fast":
+            img.draft("RGB", (size, size))                          # no-op if already loaded or not supported by the format
+            factor = min(img.size) // size
+            if factor >= 2:
+                img = img.reduce(factor)                            # cheap box downscale, LANCZOS below only sees ~2x the target
+
+        # Convert to a fixed format so compression artifacts don’t alter the hash
+        img = img.convert("RGB")  # ensure consistent color mode
+        img = img.resize((size, size), Image.LANCZOS)  # fixed size normalization
+
+        # same reduction imagehash.phash does before its DCT
+        img = img.convert("L").resize((self.PHASH_INPUT_SIZE, self.PHASH_INPUT_SIZE), Image.LANCZOS)
+        return np.asarray(img, dtype=np.uint8)
+
+    @classmethod
+    def phash_batch(cls, buffers):
+        """
+        Computes the pHash of N grayscale buffers (see hash_pixels) in one vectorized pass.  Bit for bit the
+        same as imagehash.phash.
+
+        Returns:
+            uint64 array with one packed hash per buffer (hash_to_str gives the usual hex string)
+        """
+        if len(buffers) == 0:
+            return np.empty(0, dtype=np.uint64)
+        pixels = np.asarray(buffers, dtype=np.float64).reshape(-1, cls.PHASH_INPUT_SIZE, cls.PHASH_INPUT_SIZE)
+
+        # 2D DCT, only the low frequency corner is computed:  D @ X @ D.T
+        low = (cls._DCT @ pixels @ cls._DCT.T).reshape(len(pixels), -1)
+        low = np.round(low, 6)                          # drop float noise, flat images must give exact 0s like the FFT based DCT
+        bits = low > np.median(low, axis=1, keepdims=True)
+        return np.packbits(bits, axis=1).view(">u8").ravel().astype(np.uint64)
+
+    @staticmethod
+    def hash_to_str(value):
+        """ Packed uint64 hash -> hex string, as stored in media.db """
+        return f"{int(value):016x}"
+
+    def hash_image(self, img, hash_obj=False, method=None):
+        """
+        Returns the perceptual hash of a PIL image (see hash_pixels for method)
+        """
+        img_hash = self.hash_to_str(self.phash_batch([self.hash_pixels(img, method)])[0])
+        if hash_obj is True:
+            return imagehash.hex_to_hash(img_hash)      # return hash object
+        else:
+            return img_hash                             # return hash string (default)
+
+    def hash_files(self, paths, method=None):
+        """
+        Hashes a list of image files with a single phash_batch call.
+
+        Returns:
+            list of hash strings in the order of paths, None for files that couldn't be hashed
+        """
+        buffers = []
+        hashed = []                                     # index in paths of every buffer
+        for i, path in enumerate(paths):
+            try:
+                with Image.open(path) as img:
+                    buffers.append(self.hash_pixels(img, method))
+                hashed.append(i)
+            except Exception as e:
+                self.logger.info(f"Failed to get image hash for {path}: {e}")
+
+        hashes = [None] * len(paths)
+        for i, value in zip(hashed, self.phash_batch(buffers)):
+            hashes[i] = self.hash_to_str(value)
+        return hashes
+
+    def check_hash_compatibility(self, method=None, sample_size=50):
+        """
+        Compares stored hashes against hashes computed with method, for a random sample of stored files that
+        still exist.  Used before switching hash methods on an existing media.db.
+
+        Returns:
+            dict with the number of files compared, how many matched exactly and the max/mean bit distance
+        """
+        method = method or self.hash_method
+        distances = []
+        for path, stored_hash in self.img_hash_db.get_rows_by_method(exclude_method=method, limit=sample_size):
+            if not os.path.isfile(path):
+                continue
+            try:
+                with Image.open(path) as img:
+                    new_hash = self.hash_image(img, method=method)
+            except Exception as e:
+                self.logger.info(f"Failed to hash {path} during compatibility check: {e}")
+                continue
+            distances.append((int(stored_hash, 16) ^ int(new_hash, 16)).bit_count())
+
+        result = {
+            "method": method,
+            "compared": len(distances),
+            "exact": sum(1 for d in distances if d == 0),
+            "max_distance": max(distances, default=0),
+            "mean_distance": sum(distances) / len(distances) if distances else 0.0,
+        }
+        result["compatible"] = result["exact"] == result["compared"]
+        self.logger.info(f"Hash compatibility check: {result}")
+        return result
+
+    def migrate_hashes(self, method=None):
+        """
+        Re-hashes every stored row that was hashed with another method, so exact duplicate checks keep
+        working after switching methods.  Rows whose file no longer exists are left as they are.
+
+        Returns:
+            (number of rows migrated, number of rows skipped)
+        """
+        method = method or self.hash_method
+        previous_method = self.img_hash_db.hash_method
+        self.img_hash_db.hash_method = method
+        migrated = skipped = 0
+
+        def rehashed():
+            nonlocal migrated, skipped
+            paths = [path for path, _ in self.img_hash_db.get_rows_by_method(exclude_method=method)]
+            progress = tqdm(total=len(paths), desc="Migrating hashes", unit="file")
+            for start in range(0, len(paths), self.HASH_BATCH_SIZE):
+                chunk = [path for path in paths[start:start + self.HASH_BATCH_SIZE] if os.path.isfile(path)]
+                skipped += min(self.HASH_BATCH_SIZE, len(paths) - start) - len(chunk)
+                for path, new_hash in zip(chunk, self.hash_files(chunk, method)):
+                    if new_hash is None:
+                        skipped += 1
+                        continue
+                    migrated += 1
+                    yield path, new_hash
+                progress.update(min(self.HASH_BATCH_SIZE, len(paths) - start))
+            progress.close()
+
+        try:
+            self.img_hash_db.add_files(rehashed())
+        finally:
+            self.img_hash_db.hash_method = previous_method
+        self.logger.info(f"Migrated {migrated} hashes to the {method} method, {skipped} skipped")
+        return migrated, skipped
+
     def exclude_dir(self, exlusion_dir, enable=True):
         """
         - Takes in a single directory or a list of directories and excludes them from the search.
@@ -97,14 +304,20 @@ class DuplicateImageRemover:
             # Single directory path
             full_path = os.path.join(self.root_dir, exlusion_dir)
             self.exclude_directories.append(full_path)
+            self.exclusion_matcher.add(full_path)
         elif isinstance(exlusion_dir, list):
             # List of directories
             for d in exlusion_dir:
                 full_path = os.path.join(self.root_dir, d)
                 self.exclude_directories.append(full_path)
+            self.exclusion_matcher.add([os.path.join(self.root_dir, d) for d in exlusion_dir])
         else:
             raise TypeError("new_dirs must be a string or a list of strings")
 
+    def is_excluded(self, dirpath):
+        """ True if dirpath is (inside) an exclusion directory.  String comparisons only, no filesystem calls """
+        return self.exclusion_matcher.matches(dirpath)
+
     def get_size_on_disk(self, path):
         """Returns the size on disk in bytes (Windows only).  Currently didn't lead to any more duplicates being removed"""
         if not os.path.exists(path):
@@ -117,49 +330,114 @@ class DuplicateImageRemover:
         low = GetCompressedFileSizeW(path, ctypes.byref(high))
         return (high.value << 32) + low
 
-    def scan_images(self, dir):
+    def scan_images(self, dir, incremental=True):
+        """
+        Scans all images within dir and adds them to the database.
+
+        - incremental: only images that are new, or whose size/mtime changed since they were stored, are
+          hashed.  Rows of images that no longer exist are removed in the same pass.
+        - incremental=False re-checks every image
+        """
         self.logger.info("Scanning images")
 
+        def skip_dir(dirpath):
+            if self.is_excluded(dirpath):
+                self.logger.info(f"Exclusion Directory. Skipping {dirpath}")
+                return True
+            return False
+
         # Collect all files to scan
-        all_files = []
+        scanner = MediaScanner(self.extensions, ())
+        stored = self.img_hash_db.get_file_states(dir) if incremental else {}
+        to_check = []                       # (path, rehash)
+        unchanged = 0
         duplicate_count = 0
-        for dirpath, _, files in os.walk(dir):
-            if FileTools.is_child_of_any(dirpath, self.exclude_directories):
-                self.logger.info(f"Exclusion Directory. Skipping {dirpath}")
+
+        if self.is_excluded(dir):
+            self.logger.info(f"Exclusion Directory. Skipping {dir}")
+            entries = []
+        else:
+            entries = scanner.scan(dir, skip_dir=skip_dir)
+
+        for entry in entries:
+            state = stored.pop(entry.path, None)
+            if state is None:
+                to_check.append((entry.path, False))                            # new file
                 continue
-            all_files.extend([os.path.join(dirpath, f) for f in files if f.endswith(self.extensions)])
 
-        print(Fore.MAGENTA + f"\nScanning {len(all_files)} images")
-        # Global progress bar
-        for file_path in tqdm(all_files, desc="Scanning Images", unit="file"):
-            duplicate = self.check_image(file_path)
-            if duplicate:
-                duplicate_count += 1
+            file_hash, mtime, size = state
+            if mtime == entry.mtime and size in (None, entry.size):
+                unchanged += 1
+                if size is None:                                                # row from before sizes were stored
+                    self.img_hash_db.stage_file(entry.path, file_hash, entry.mtime, entry.size)
+            else:
+                to_check.append((entry.path, True))                             # changed since last scan
+
+        # Anything left in stored wasn't found on disk.  Rows in excluded directories weren't walked, keep them
+        removed = [path for path in stored
+                   if path.endswith(self.extensions) and not self.is_excluded(os.path.dirname(path))]
+        if removed:
+            self.img_hash_db.remove_files(removed)
+
+        print(Fore.MAGENTA + f"\nScanning {len(to_check)} images"+Fore.RESET+f"  ({unchanged} unchanged, {len(removed)} removed)")
+        # Global progress bar.  Images are hashed in chunks, each chunk with a single phash_batch call
+        progress = tqdm(total=len(to_check), desc="Scanning Images", unit="file")
+        for start in range(0, len(to_check), self.HASH_BATCH_SIZE):
+            chunk = to_check[start:start + self.HASH_BATCH_SIZE]
+            hashes = self.hash_files([file_path for file_path, _ in chunk])
+            for (file_path, rehash), img_hash in zip(chunk, hashes):
+                progress.update(1)
+                if img_hash is None:
+                    self.logger.info(f"[ERROR] Image hash returned: None {file_path}")
+                    continue
+                duplicate = self.check_image(file_path, rehash=rehash, record_duplicate=incremental, img_hash=img_hash)
+                if duplicate:
+                    duplicate_count += 1
+        progress.close()
+        self.img_hash_db.flush()                        # write the last batch of new hashes
+        self.logger.info(f"Scan complete. {len(to_check)} hashed, {unchanged} unchanged, {len(removed)} removed, {duplicate_count} duplicates")
         print(Fore.MAGENTA + f"\nScan Complete."+Fore.CYAN+f"  {duplicate_count} Duplicates detected\n")
 
-    def check_image(self, image_path):
+    @metrics.timed("duplicate_check_seconds")
+    def check_image(self, image_path, img=None, rehash=False, record_duplicate=False, img_hash=None):
         """
         - Check if a single image is a duplicate based on its hash.
         - Adds image to db if no duplicate hash is found
         - Skips of folderpath is listed in self.exclusion_directories
+        - img can be passed if the image is already decoded (see get_image_hash)
+        - img_hash can be passed if the hash was already computed (see phash_batch)
+        - rehash ignores the hash stored for image_path, used when the file changed since it was stored
+        - record_duplicate also stores the row of a duplicate, so rescans know the file was already checked
 
         """
         base_filepath = os.path.dirname(image_path)
-        exclusion_dir_check = FileTools.is_child_of_any(base_filepath, self. exclude_directories)
+        exclusion_dir_check = self.is_excluded(base_filepath)
 
         if exclusion_dir_check is False:
-            img_hash = self.get_image_hash(image_path, self.logger)
+            if rehash is True:
+                self.img_hash_db.remove_files([image_path])                 # stale hash would count as a duplicate of itself
+            if img_hash is None:
+                img_hash = self.get_image_hash(image_path, self.logger, img=img)
             if img_hash is None:
                 self.logger.info(f"[ERROR] Image hash returned: None {image_path}")
                 return False  # can't hash, treat as not a duplicate
 
-            if self.img_hash_db.hash_exists(img_hash):
+            if self.atomic_registration is True:
+                # Check and add in one transaction so parallel import workers can't both register the same hash
+                duplicate = self.is_near_duplicate(image_path, img_hash) or self.img_hash_db.register_hash(image_path, img_hash)
+            else:
+                # Single writer, new hashes are written in batches (staged hashes are visible to hash_exists)
+                duplicate = self.img_hash_db.hash_exists(img_hash) or self.is_near_duplicate(image_path, img_hash)
+                if not duplicate or record_duplicate is True:
+                    self.img_hash_db.stage_file(image_path, img_hash)
+
+            metrics.inc("duplicate_checks_total", result="duplicate" if duplicate else "new")
+            if duplicate:
                 # Already seen → duplicate
                 self.duplicates.append(image_path)
                 return True
             else:
-                # Not seen yet → add to database
-                self.img_hash_db.add_file(image_path, img_hash) 
+                # Not seen yet → added to database
                 return False
 
     def delete_duplicates(self):
@@ -1,26 +1,63 @@
+import io
 import os
+import asyncio
 import json
 import shutil
 import piexif
+import threading
 import traceback        # only for debugging of traceback.  Possibly remove?
 from utils.utils import FileTools, get_exif_datetime
 from utils.confighandler import AppProperties
+from utils.pipeline import StagedPipeline
+from utils.name_allocator import NameAllocator
+from utils.sidecar_index import SidecarIndex
+from utils.import_journal import PLACED, ORIGINAL_DELETED, SIDECAR_COPIED, DONE, FAILED
+from utils.metrics import metrics
+from utils.exif_reader import read_exif_dates, DATETIME, DATETIME_ORIGINAL, DATETIME_DIGITIZED, EXIF_IFD_POINTER
 from PIL import Image
-from PIL.ExifTags import TAGS
 from datetime import datetime
-import pillow_heif
 from pillow_heif import register_heif_opener
 from DuplicateImageRemover import DuplicateImageRemover
 from utils.confighandler import AppProperties
 
+register_heif_opener()                                      # Register HEIF support with Pillow (handles .heic and .heif)
+
+class ImageJob:
+    """
+    Per image state passed between the ImgHandler stages.  Kept separate from ImgHandler so several images
+    can be in flight at once when the stages run as a pipeline.
+    """
+    def __init__(self, filepath, output_dir_root):
+        self.filepath = filepath                            # original filepath in the import directory
+        self.filename = os.path.basename(filepath)
+        self.extension = os.path.splitext(self.filename)[1]
+        self.file_output_dir = output_dir_root              # output directory, updated once the image is placed
+
+        self.json_exists = False                            # set by ImgHandler.load_image_json
+        self.json_path = None
+        self.metadata = False
+
+        self.raw_bytes = None                               # original file contents       (read stage)
+        self.passthrough = False                            # jpg copied as is, only exif replaced (decode stage)
+        self.loaded_img = None                              # decoded image                (decode stage)
+        self.exif_data = None                               # exif dict to embed on save   (read stage)
+        self.datetime_taken = None                          # exif "date taken" string     (read stage)
+        self.hash_pixels = None                             # grayscale buffer for phash   (decode stage)
+        self.duplicate = False                              # duplicate hash detected      (hash stage)
+        self.encoded_bytes = None                           # encoded jpg                  (encode stage)
+        self.digest = None                                  # digest of the verified copy  (write stage)
+        self.output_filepath = None                         # final filepath               (write stage)
+        self.placed = False                                 # output file written          (write stage)
+
+        self.image_saved = True
+        self.json_saved = True
+
 
 class ImgHandler:
     def __init__(self, logger, app_properties_filepath):
         
 
         # initilize configurabel settings
-        self.datetime_taken = None                                  # initialize to a default value
-        self.tmp_file_exists = False                                # initilize as false
         self._prevent_duplicates_enabled = False                    # initilize as false
 
         self.app_properties = AppProperties(app_properties_filepath)
@@ -28,71 +65,277 @@ class ImgHandler:
         self.output_dir_root = self.app_properties.get("database.directory")
         self.delete_orig_file = self.app_properties.get("image_handling.delete_after_copy")
         self.temp_path = self.app_properties.get("database.temp_path")
+        self.jpeg_passthrough = self.app_properties.get("image_handling.jpeg_passthrough", True)  # copy jpg bytes instead of re-encoding
+        self.verify_copies = self.app_properties.get("image_handling.verify_copies", False) or self.delete_orig_file == True   # originals are only deleted after a verified copy
 
         # initilize objects
         self.logger = logger
+        self.name_allocator = NameAllocator()                       # output names/directories, shared with the pipeline threads
+        self.sidecar_index = SidecarIndex()                         # .json sidecars, replaced by the scan's index (see use_sidecar_index)
+        self.journal = None                                         # import journal of the current run (see use_journal)
         self.duplicateTracker = DuplicateImageRemover(self.output_dir_root, self.logger)
-        self.duplicateTracker.load_image_hash_db(self.app_properties.get("database.db_path") )
+        self.duplicateTracker.load_image_hash_db(self.app_properties.get("database.db_path"),
+                                                 batch_size=self.app_properties.get("database.batch_size", 500),
+                                                 journal_mode=self.app_properties.get("database.journal_mode", "WAL"))
         self.duplicateTracker.exclude_dir(os.path.join(self.output_dir_root, "unsorted"))      # Exclude unsorted from duplicate tracker (if its enabled)
+        if self.app_properties.get("image_handling.duplicate_detection.hash_index.enabled", True):
+            self.duplicateTracker.load_hash_index(
+                self.app_properties.get("image_handling.duplicate_detection.hash_index.memory_budget_mb", 64),
+                bloom=self.app_properties.get("image_handling.duplicate_detection.hash_index.bloom_filter", False))
+        self.duplicateTracker.set_hash_method(self.app_properties.get("image_handling.duplicate_detection.hash_method", "full"))
+        self.duplicateTracker.enable_near_duplicates(self.app_properties.get("image_handling.duplicate_detection.hamming_threshold", 0))
+        self._duplicate_lock = threading.Lock()                                                 # duplicate check + register must not interleave between pipeline threads
 
         # ensure unsorted filepath exists
         FileTools.ensure_folder_exists(os.path.join(self.output_dir_root, "unsorted"))          # ensure the output directory exists
 
+    @metrics.timed("image_import_seconds")
     def process_img(self, filepath):
         """
+        Imports a single image by running each stage in order.  self.process_imgs_pipelined runs the
+        same stages concurrently for a batch of images.
+
         Currently, due to handling of HEIC images, the json needs to be loaded prior to the heic
-        to jpg conversion since self.heic_to_jpg sets a new filename based on the new saved jpg file.
+        to jpg conversion since self.heic_to_jpg sets a new .jpg filename.
         """
-        self.filepath = filepath
-        self.filename = os.path.basename(filepath)
-        self.extension = os.path.splitext(self.filename)[1]
-        self.file_output_dir = self.output_dir_root         # Reset output directory
-        self.json_exists = False                            # reset json exists flag
+        job = ImageJob(filepath, self.output_dir_root)
+
+        try:
+            self.read_stage(job)                            # Load .json data and the file contents
+            self.decode_stage(job)                          # Decode image and extract metadata
+            self.hash_stage([job])                          # Hash and check for duplicates
+            self.encode_stage(job)                          # Encode the output jpg in memory
+            self.write_stage(job)                           # Save image and json to the new filepath
+        except Exception:
+            self.release_job(job)
+            raise
+        return job
+
+    def process_imgs_pipelined(self, filepaths):
+        """
+        Imports images with the read, decode, hash, encode and write stages running concurrently, joined by
+        bounded queues (see utils.pipeline.StagedPipeline).  Concurrency of each stage and the queue size
+        are set under image_handling.pipeline in the app properties.
+
+        Yields:
+            (filepath, error) for each image once it leaves the pipeline.  error is None on success.
+        """
+        settings = self.app_properties.get("image_handling.pipeline", {}) or {}
+        stages = [
+            ("read",   self.read_stage,   settings.get("read_workers", 4)),       # NAS reads
+            ("decode", self.decode_stage, settings.get("decode_workers", 2)),     # decode (CPU)
+            ("hash",   self.hash_stage,   1, settings.get("hash_batch_size", 32)),  # batched phash + duplicate check
+            ("encode", self.encode_stage, settings.get("encode_workers", 2)),     # jpg encode (CPU)
+            ("write",  self.write_stage,  settings.get("write_workers", 4)),      # NAS writes
+        ]
+        pipeline = StagedPipeline(stages, queue_size=settings.get("queue_size", 8))
+
+        jobs = (ImageJob(filepath, self.output_dir_root) for filepath in filepaths)
+        for job, _, error in pipeline.run(jobs):
+            if error is not None:
+                self.logger.info(f"Failed processing Image [{job.filepath}]: {error}")
+                self.release_job(job)
+            yield job.filepath, error
+
+    async def process_img_async(self, filepath, io_executor, cpu_executor):
+        """
+        Imports a single image with the same stages as process_img, awaited on an asyncio event loop.  The read,
+        hash (media.db) and write stages run on io_executor, decode and encode on cpu_executor, so many images
+        can wait on the NAS at once (see import_media.import_async).
+
+        Returns:
+            (filepath, error), error is None on success
+        """
+        loop = asyncio.get_running_loop()
+        job = ImageJob(filepath, self.output_dir_root)
+        try:
+            await loop.run_in_executor(io_executor, self.read_stage, job)       # sidecar + file reads
+            await loop.run_in_executor(cpu_executor, self.decode_stage, job)    # decode (CPU)
+            await loop.run_in_executor(io_executor, self.hash_stage, [job])     # phash + duplicate check in media.db
+            await loop.run_in_executor(cpu_executor, self.encode_stage, job)    # jpg encode (CPU)
+            await loop.run_in_executor(io_executor, self.write_stage, job)      # NAS writes
+        except Exception as e:
+            self.logger.info(f"Failed processing Image [{job.filepath}]: {e}")
+            self.release_job(job)
+            return job.filepath, e
+        return job.filepath, None
 
-        self.load_image_json()                              # Load .json data if it exists
+    @metrics.timed("image_stage_seconds", stage="read")
+    def read_stage(self, job):
+        """
+        Loads the json sidecar, reads the file contents into memory and extracts the date taken from the
+        EXIF header.  Everything get_output_filepath needs is known after this stage, without any decode.
+        """
+        self.load_image_json(job)                           # Load .json data if it exists
+        with open(job.filepath, "rb") as file:
+            job.raw_bytes = file.read()
+        metrics.inc("image_read_bytes_total", len(job.raw_bytes))
+
+        if job.extension.endswith((".heic", "HEIC")):
+            job.exif_data = self.extract_heic_metadata(job)     # extract .heic metadata
+        else:
+            job.exif_data = self.extract_jpg_metadata(job)      # Extract metadata
+        return job
+
+    @metrics.timed("image_stage_seconds", stage="decode")
+    def decode_stage(self, job):
+        """ Decodes the image, extracts its metadata and reduces it to the buffer phash is computed from """
+
+        # If heic, decode it in memory for the jpg encode
+        if job.extension.endswith((".heic", "HEIC")):
+            self.heic_to_jpg(job)                               # decode image
+
+        else:
+            job.loaded_img = Image.open(io.BytesIO(job.raw_bytes))     # open the image (only reads the header)
+            job.passthrough = self.jpeg_passthrough is True and job.loaded_img.format == "JPEG"
+
+        if not job.passthrough:
+            job.loaded_img.load()                           # decode now, so the work happens in this stage
+            job.raw_bytes = None                            # no longer needed, free the memory
+        # passthrough jpgs keep raw_bytes for the encode stage and are only decoded if a hash is needed below
+
+        if self._prevent_duplicates_enabled is True:
+            try:
+                with metrics.timer("image_hash_pixels_seconds"):                    # decode for the phash, part of the decode stage
+                    job.hash_pixels = self.duplicateTracker.hash_pixels(job.loaded_img)
+            except Exception as e:
+                self.logger.info(f"Failed to get image hash for {job.filepath}: {e}")
+        return job
 
-        # If heic, convert it to a jpg for processing
-        if self.extension.endswith((".heic", "HEIC")):
-            
-            exif_data = self.extract_heic_metadata()                    # extract .heic metadata
-            self.heic_to_jpg()                              # convert image to jpg
-            self.loaded_img = Image.open(self.filepath)     # load the new jpg image
+    @metrics.timed("image_stage_seconds", stage="hash")
+    def hash_stage(self, jobs):
+        """
+        Hashes a batch of decoded images with a single phash_batch call and checks each for duplicates.
+        Takes and returns a list of jobs, so the pipeline can run it as a batched stage.
+        """
+        if self._prevent_duplicates_enabled is not True:
+            return jobs
 
-        else:  
-            self.loaded_img = Image.open(self.filepath)     # load the image
-            exif_data = self.extract_jpg_metadata()         # Extract metadata
-            self.filepath_orig = self.filepath              # stupid variable needed because of self.heic_to_jpg saves a temp file and needs to update self.filepath
+        hashed = [job for job in jobs if job.hash_pixels is not None]
+        hashes = dict(zip(hashed, self.duplicateTracker.phash_batch([job.hash_pixels for job in hashed])))
 
-        # Output file to new directory with metadata
-        output_path = self.get_output_filepath()            # Determine output name of image
-        self.save_image(exif_data, output_path)             # Save image to new filepath with metadata
-        self.save_json(output_path)                         # Save json to new filepath
+        for job in jobs:
+            job.hash_pixels = None
+            img_hash = hashes.get(job)
+            img_hash = self.duplicateTracker.hash_to_str(img_hash) if img_hash is not None else None
+            # Check image for duplicates
+            try:
+                with self._duplicate_lock:
+                    job.duplicate = self.duplicateTracker.check_image(job.filepath, img=job.loaded_img, img_hash=img_hash) is True
+            except Exception as e:
+                print(f"Error porcessing duplcate detection for {job.filepath}: {e}")
+                self.logger.info(f"error porcessing duplcate detection for {job.filepath}: {e}")
+        return jobs
+
+    @metrics.timed("image_stage_seconds", stage="encode")
+    def encode_stage(self, job):
+        """
+        Encodes the output jpg in memory.
+        - Passthrough jpgs keep the original bytes, only the exif segment is replaced (no decode/re-encode)
+        """
+        buffer = io.BytesIO()
+        if job.passthrough is True:
+            if job.json_exists is True and job.exif_data is not None:
+                piexif.insert(piexif.dump(job.exif_data), job.raw_bytes, buffer)    # splice the new exif into the original
+            else:
+                buffer.write(job.raw_bytes)
+            job.raw_bytes = None
+        elif job.json_exists is True:                                 # if json exists, apply metadata as new image is saved
+            exif_bytes = piexif.dump(job.exif_data)                 # Convert exif data into byte stream so it can be embeded into image
+            job.loaded_img.save(buffer, "jpeg", exif=exif_bytes)
+        else:                                                       # if no metadata, save without
+            job.loaded_img.save(buffer, "jpeg")
+        job.loaded_img.close()
+        job.loaded_img = None
+        job.encoded_bytes = buffer.getvalue()
+        return job
+
+    @metrics.timed("image_stage_seconds", stage="write")
+    def write_stage(self, job):
+        """ Places the image in the database and writes the image and json """
+        output_path = self.get_output_filepath(job)         # Determine output name of image (reserves the filename)
+        self.save_image(job, output_path)                   # Save image to new filepath
+        self.save_json(job, output_path)                    # Save json to new filepath
+        self.journal_mark(job.filepath, DONE)
+        return job
+
+    def release_job(self, job):
+        """
+        Cleans up after a job that failed part way through.  The hash check_image registered for the image is
+        removed unless the output was written, otherwise a retry would find the image as a duplicate of itself.
+        Once the output was written the journal keeps its state (placed, original_deleted), so --resume finishes
+        the image instead of importing it again
+        """
+        if job.loaded_img is not None:
+            job.loaded_img.close()
+        job.raw_bytes = job.loaded_img = job.encoded_bytes = job.hash_pixels = None
+        if not job.placed:
+            self.forget_hashes([job.filepath])
+            self.journal_mark(job.filepath, FAILED)
+
+    def close(self):
+        """ Writes any staged database rows and closes the hash database """
+        self.duplicateTracker.img_hash_db.close()
 
     def update_db(self, dir):
         """ Scans and updates DB for all files contained within path"""
         self.duplicateTracker.scan_images(dir)
 
-    def load_image_json(self):
+    def load_image_json(self, job):
 
-        # Handle json file naming conventions
-        json_path_1 = self.filepath.replace(self.extension, ".json")
-        json_path_2 = self.filepath + ".json"
-
-        if os.path.exists(json_path_1):
-            self.json_path = json_path_1    
-            self.json_exists = True
-        elif os.path.exists(json_path_2):
-            self.json_path = json_path_2
-            self.json_exists = True
-        else:
-            self.json_exists = False
+        # Find the sidecar from the directory listing (see utils.sidecar_index), handles Takeout's naming
+        job.json_path = self.sidecar_index.lookup(job.filepath)
+        job.json_exists = job.json_path is not None
 
         # Process JSON metadata
-        if self.json_exists == True:
-            with open(self.json_path, 'r') as json_file:
-                self.metadata = json.load(json_file)
+        if job.json_exists == True:
+            with open(job.json_path, 'r') as json_file:
+                job.metadata = json.load(json_file)
         else:
-            self.metadata = False                               # Creates an empty JSON object
+            job.metadata = False                                # Creates an empty JSON object
+
+    def use_sidecar_index(self, sidecar_index):
+        """
+        - Use the sidecars matched while scanning the import directory (MediaScanner.sidecar_index)
+        """
+        self.sidecar_index = sidecar_index
+
+    def use_journal(self, journal):
+        """
+        - Record the progress of each image in journal (utils.import_journal.ImportJournal), so the run can be resumed
+        """
+        self.journal = journal
+
+    def journal_mark(self, filepath, state, output_filepath=None):
+        if self.journal is not None:
+            self.journal.mark(filepath, state, output_filepath)
+
+    def finish_import(self, filepath, output_filepath, state=PLACED):
+        """
+        Completes an image whose output was written by an interrupted run (see import_media --resume): deletes
+        the original if delete_after_copy is on and the run stopped before it did (state is PLACED, the output was
+        verified before that was recorded), copies the json sidecar if it's still there and marks the image done.
+        The image isn't decoded or hashed again.
+        """
+        if state == PLACED and self.delete_orig_file == True and os.path.isfile(filepath):
+            os.remove(filepath)
+            self.journal_mark(filepath, ORIGINAL_DELETED)
+
+        job = ImageJob(filepath, self.output_dir_root)
+        job.file_output_dir = os.path.dirname(output_filepath)
+        job.output_filepath = output_filepath
+        job.json_path = self.sidecar_index.lookup(filepath)
+        job.json_exists = job.json_path is not None and os.path.isfile(job.json_path)     # may be gone with delete_after_copy
+        self.save_json(job, output_filepath)
+        self.journal_mark(filepath, DONE)
+
+    def forget_hashes(self, filepaths):
+        """
+        Removes the hashes registered for images that weren't imported (failed attempts, files left by an
+        interrupted run), so importing them again doesn't find them as duplicates of themselves
+        """
+        if filepaths:
+            self.duplicateTracker.img_hash_db.remove_files(filepaths)
 
     def prevent_duplicates(self, enable=True, exclude_directories=None):
         """
@@ -123,71 +366,65 @@ class ImgHandler:
         else:
             self.logger.info(f"Archive path can't be None!!")
 
-    def heic_to_jpg(self):
+    @metrics.timed("image_heic_decode_seconds")
+    def heic_to_jpg(self, job):
         """
-        Converts heic images to a .jpg and saves the file to the original containing folder for processing.
+        Decodes heic images in memory for the .jpg encode, nothing is written to disk until the final .jpg
+        is saved.  The metadata was already read from the header in the read stage.
 
         Args:
-            self
+            job (ImageJob): image being processed
 
         Attributes:
-            self.filepath (path): Replaces filepath with new .jpg filepath
-            self.filename (path): Replaces filename with new .jgp filename
+            job.loaded_img (Image): The decoded image (RGB)
+            job.filename (path): Replaces filename with new .jgp filename
 
         """
-        # Register HEIF support with Pillow (handles .heic and .heif)
-        pillow_heif.register_heif_opener()
-
         try:
-            with Image.open(self.filepath) as image:                            # Open the .HEIC file
-                jpg_path = os.path.join(self.file_output_dir, ".tmp", self.filename.replace(self.extension, ".jpg"))    # create tmp filepath
-                jpg_path = FileTools.get_unique_filename(jpg_path)                                                     # ensure this is a unique filename
-                image.save(jpg_path, "jpeg")                                                                            # Save the new .jpg file
-                self.filepath_orig = self.filepath                                                                      # save original filepath for deletion of og image
-                self.filepath = jpg_path                                                                                # set new filepath
-                self.filename = os.path.basename(jpg_path)                                              # set new filename
-
-                self.tmp_file_exists = True
+            image = Image.open(io.BytesIO(job.raw_bytes))                       # Open the .HEIC file
+            image.load()                                                        # decode once
+            if image.mode not in ("RGB", "L"):                                  # jpg can't hold alpha / 16 bit images
+                converted = image.convert("RGB")
+                image.close()
+                image = converted
 
         except Exception as e:
             # Print the error message and the full traceback
-            self.logger.info(f"Error converting {self.filepath} to JPEG: {e}")
+            self.logger.info(f"Error converting {job.filepath} to JPEG: {e}")
             self.logger.info("Full traceback:")
             self.logger.info(traceback.format_exc())  # Prints the full traceback
+            raise
 
-            self.logger.info(f"Error converting {self.filepath} to JPEG: {e}")
+        job.loaded_img = image
+        job.filename = job.filename.replace(job.extension, ".jpg")              # set new filename
 
-    def extract_jpg_metadata(self):
+    def extract_jpg_metadata(self, job):
         """
-        Extracts metadat contgained in self.metadata to EXIF .
+        Extracts metadat contgained in job.metadata to EXIF .
 
         Args:
-            self
+            job (ImageJob): image being processed
 
         Attributes:
-            self.exif_data (str): Images metadata formated in exif
-            self.datetime_taken (str): datetime the image was taken
+            job.datetime_taken (str): datetime the image was taken
+
+        Returns:
+            exif dict to embed on save, or None
         """
 
         exif_new = {"0th": {}, "Exif": {}, "GPS": {}, "1st": {}, "thumbnail": None}
 
-        exif_orig = self.loaded_img._getexif()
-        if exif_orig:
-            for tag_id, value in exif_orig.items():
-                tag_name = TAGS.get(tag_id, tag_id)     # Get human-readable tag name
-                if tag_name == "DateTimeOriginal":      # "Date Taken" metadata
-                    self.datetime_taken = value
-
-                    try:
-                        date_time_original = get_exif_datetime(self.datetime_taken)
-                        exif_new['Exif'][piexif.ExifIFD.DateTimeOriginal] = date_time_original.encode('utf-8')
-                        return exif_new
-                    except Exception as e:
-                        self.logger.info(f"ERROR setting DateTimeOriginal: while processing {self.filepath_orig}")
-                        self.logger(f"ERROR Traceback: {e}")
+        exif_dates = self.read_exif_header(job)             # header only, no pixel decode
+        if exif_dates.get(DATETIME_ORIGINAL):               # "Date Taken" metadata
+            job.datetime_taken = exif_dates[DATETIME_ORIGINAL]
 
-        else:
-            pass
+            try:
+                date_time_original = get_exif_datetime(job.datetime_taken)
+                exif_new['Exif'][piexif.ExifIFD.DateTimeOriginal] = date_time_original.encode('utf-8')
+                return exif_new
+            except Exception as e:
+                self.logger.info(f"ERROR setting DateTimeOriginal: while processing {job.filepath}")
+                self.logger.info(f"ERROR Traceback: {e}")
 
         # Unsure if any of the following is working, commenting out for now.  This is supposed to be
         # extracting metadata, but uses a different method then what is used above.
@@ -245,18 +482,15 @@ class ImgHandler:
 
         return None
 
-    def extract_heic_metadata(self):
-        register_heif_opener()
-        img = Image.open(self.filepath)         # load image.  Not saved to self.loaded_img since its the temp .heic file
-
-        exif_old = img.getexif()
+    def extract_heic_metadata(self, job):
+        exif_old = self.read_exif_header(job)              # header only, no pixel decode
         exif_new = {"0th": {}, "Exif": {}, "GPS": {}, "1st": {}, "thumbnail": None}
 
         if exif_old:
-            self.datetime_taken = exif_old.get(306)  # 36867 = DateTimeOriginal
-            if self.datetime_taken:
+            job.datetime_taken = exif_old.get(DATETIME_ORIGINAL) or exif_old.get(DATETIME)     # 36867 = DateTimeOriginal, 306 = DateTime
+            if job.datetime_taken:
                 try:
-                    date_time_original = get_exif_datetime(self.datetime_taken)
+                    date_time_original = get_exif_datetime(job.datetime_taken)
                     exif_new['Exif'][piexif.ExifIFD.DateTimeOriginal] = date_time_original.encode('utf-8')
                     return exif_new
                 except Exception as e:
@@ -264,136 +498,139 @@ class ImgHandler:
 
         return None
 
-    def get_output_filepath(self):
+    def read_exif_header(self, job):
+        """
+        Returns {tag: value} of the EXIF date tags of job.raw_bytes (see utils.exif_reader), read from the
+        header without decoding the image.  Falls back to Pillow for other formats (.png) or unreadable headers.
+        """
+        try:
+            return read_exif_dates(job.raw_bytes)
+        except ValueError:
+            with Image.open(io.BytesIO(job.raw_bytes)) as img:
+                exif = img.getexif()
+                dates = {DATETIME: exif.get(DATETIME)}
+                exif_ifd = exif.get_ifd(EXIF_IFD_POINTER)
+                for tag in (DATETIME_ORIGINAL, DATETIME_DIGITIZED):
+                    dates[tag] = exif_ifd.get(tag)
+            return {tag: value for tag, value in dates.items() if value}
+
+    def get_output_filepath(self, job):
         """
         Determines filepath that the image will be copied to.
 
         Args:
-            self
+            job (ImageJob): image being processed
 
         Attributes:
-            output_filepath (path): Output path that the image will get saved to.
+            job.file_output_dir (path): Directory the image will get saved to.
+
+        Returns:
+            output_filepath (path): Output path that the image will get saved to (reserved).
 
         """
 
         dt = None
 
-        # Uses self.datetime_taken as date stamp for filename, and looks through metadata for datetime_original if non existant
-        if self.datetime_taken:
+        # Uses job.datetime_taken as date stamp for filename, and looks through metadata for datetime_original if non existant
+        if job.datetime_taken:
             # Format the datestamp for the image name
-            dt = datetime.strptime(self.datetime_taken, "%Y:%m:%d %H:%M:%S")
+            dt = datetime.strptime(job.datetime_taken, "%Y:%m:%d %H:%M:%S")
 
-        elif self.metadata != False:    # look for datetime_original
+        elif job.metadata != False:     # look for datetime_original
             # Format the datestamp for the image name
-            timestamp = int(self.metadata["photoTakenTime"]["timestamp"])
+            timestamp = int(job.metadata["photoTakenTime"]["timestamp"])
             dt = datetime.utcfromtimestamp(timestamp)  # Use utcfromtimestamp if it's in UTC
 
         # If dt is defined, datetime metadata exists for the image
         if dt:
             formatted_date = dt.strftime("%Y%m%d_%H%M%S")
             folder_year = formatted_date[:4] 
-            self.file_output_dir = os.path.join(self.output_dir_root, folder_year)            # Modify file_output_dir to include year folder
-            FileTools.ensure_folder_exists(self.file_output_dir)                               # ensure the output directory exists
+            job.file_output_dir = os.path.join(self.output_dir_root, folder_year)             # Modify file_output_dir to include year folder
 
-            if not self.filename.startswith(formatted_date[:8]):                                # Check if the filename already starts with the correct date string
+            if not job.filename.startswith(formatted_date[:8]):                                 # Check if the filename already starts with the correct date string
                 base_filename = f"{formatted_date}.jpg"                                         # get new base_filename based on date string
             else:                                                                               # filename already starts with correct date string
-                base_filename = self.filename
-            output_filepath = FileTools.get_unique_filename(os.path.join(self.file_output_dir, base_filename))    # ensure unique file path
+                base_filename = job.filename
 
         # If datetime taken metadata doesn't exist, save to "unsorted" folder
         else:                                                                           # no date meta data for .jpg
-            self.file_output_dir = os.path.join(self.output_dir_root, "unsorted")
-            output_filepath = self.filepath.replace(self.extension, ".jpg")             # keep original name and ensure .jpg file extnsion
-            output_filepath = FileTools.get_unique_filename(os.path.join(self.file_output_dir, self.filename))     # ensure unique name
+            job.file_output_dir = os.path.join(self.output_dir_root, "unsorted")
+            base_filename = job.filename                                                # keep original name
+
+        # Duplicates are archived instead of being added to the database
+        if job.duplicate is True:
+            job.file_output_dir = self.duplicateTracker.archive_path
+
+        output_filepath = self.name_allocator.reserve(os.path.join(job.file_output_dir, base_filename))    # ensure unique file path (creates the directory)
+        if not dt:
             self.logger.info(f"Saving to unsorted path: {output_filepath}")
 
+        job.output_filepath = output_filepath
         return output_filepath
 
-    def save_image(self, exif_data, output_filepath):
+    def save_image(self, job, output_filepath):
         """
-        - Checks if self.prevent_duplicate==True, and checks if img will be a duplicate if its enabled
+        - Writes the encoded image to output_filepath and deletes the original if enabled
+        - With verify_copies the written file is read back and compared against the digest of the encoded bytes,
+          the digest is recorded in media.db (file_digests)
         """
- 
-        # Check image for duplicates
-        try:
-            if self._prevent_duplicates_enabled is True:
-                duplicate_detected = self.duplicateTracker.check_image(self.filepath)
-                if duplicate_detected is True:
-                    self.file_output_dir = self.duplicateTracker.archive_path
-                    output_filepath = os.path.join(self.file_output_dir, os.path.basename(output_filepath))      # set output dir to archive
-        except Exception as e:
-            print(f"Error porcessing duplcate detection for {output_filepath}: {e}")
-            self.logger.info(f"error porcessing duplcate detection for output filepath {output_filepath}: {e}")
-            self.logger.info(f"Original IMG path that caused error: {self.filepath}")
 
         # Save the image 
-        if self.json_exists is True:                                # if json exists, apply metadata as new image is saved
-            exif_bytes = piexif.dump(exif_data)                     # Convert exif data into byte stream so it can be embeded into image
-            self.loaded_img.save(output_filepath, "jpeg", exif=exif_bytes)
-            self.loaded_img.close()
-        else:                                                       # if no metadata, save without
-            self.loaded_img.save(output_filepath, "jpeg")
-            self.loaded_img.close()
+        try:
+            if self.verify_copies:
+                job.digest = FileTools.write_verified(job.encoded_bytes, output_filepath,
+                                                      self.duplicateTracker.img_hash_db.algorithm)   # raises if the file doesn't read back the same
+            else:
+                with open(output_filepath, "wb") as file:
+                    file.write(job.encoded_bytes)
+            metrics.inc("image_written_bytes_total", len(job.encoded_bytes))
+            job.encoded_bytes = None
+            job.placed = True
+        except Exception:
+            self.name_allocator.release(output_filepath)            # don't leave the reserved (empty) filename behind
+            raise
 
         # Set date created once the image is saved
         try:
-            if self.datetime_taken:
-                dt = datetime.strptime(self.datetime_taken, "%Y:%m:%d %H:%M:%S")
+            if job.datetime_taken:
+                dt = datetime.strptime(job.datetime_taken, "%Y:%m:%d %H:%M:%S")
                 dt = int(dt.timestamp())                      # Get datetime taken if it exists
                 FileTools.set_file_creation_date(output_filepath, dt)     # Set file date created time
 
         except Exception as e:
             print(f"Failed to save EXIF data for {output_filepath}: {e}")
             self.logger.info(f"ERROR Failed to save EXIF data for {output_filepath}: {e}")
-            self.logger.info(f"Original IMG path that caused error: {self.filepath}")
-
-        # Delete the original file
-        if os.path.exists(output_filepath):                        # confirm the file saved file actually exists
-            file_size = os.path.getsize(output_filepath)           # confirm the saved file has a filsize 
-            if file_size > 250 and self.delete_orig_file == True:       # check that file size is > 500 bytes
-                try: 
-                    os.remove(self.filepath_orig)                           # Delete the original file if the copy was succesfull 
-                except FileNotFoundError as e:
-                    print(f"FileNotFoundError caught: {e}")
-                    self.logger.info(f"FileNotFoundError caught: {e}")
-            elif self.delete_orig_file == True:
-                self.image_saved = False
-                self.logger.info(f"File size too small. Failed to save image [{self.filepath}] to output directory [{output_filepath}]")
-                self.logger.info(f"File size: {file_size}")
-
-        # Delete the tmp file if it exists
-        try:
-            if self.tmp_file_exists == True:
-                file_size = os.path.getsize(output_filepath)           # confirm the saved file has a filsize 
-                if file_size > 250:                                         # check that file size is > 250 bytes
-                    tmp_filename = os.path.join(self.output_dir_root, ".tmp", self.filename.replace(self.extension, ".jpg"))
-                    os.remove(tmp_filename)                                 # Delete the tmp file
-                    self.tmp_file_exists = False                            # reset the flag
-                else:
-                    self.image_saved = False
-                    self.logger.info(f"File size too small. Failed to save image [{self.filepath}] to output directory [{output_filepath}]")
-                    self.logger.info(f"File size: {file_size}")
-
-        except Exception as e:
-            print(f"Failed to confirm {self.filepath} was deleted from tmp directory: {e}")
-            self.logger.info(f"Failed to confirm {self.filepath} was deleted from tmp directory: {e}")
-
-    def save_json(self, output_filepath):   
+            self.logger.info(f"Original IMG path that caused error: {job.filepath}")
+
+        if job.digest is not None:
+            self.duplicateTracker.img_hash_db.stage_digest(output_filepath, job.filepath, job.digest)
+        self.journal_mark(job.filepath, PLACED, output_filepath)
+
+        # Delete the original file, only reached once the copy is verified (verify_copies is on with delete_after_copy)
+        if self.delete_orig_file == True:
+            try: 
+                os.remove(job.filepath)                                 # Delete the original file if the copy was succesfull 
+                self.journal_mark(job.filepath, ORIGINAL_DELETED)
+            except FileNotFoundError as e:
+                print(f"FileNotFoundError caught: {e}")
+                self.logger.info(f"FileNotFoundError caught: {e}")
+
+    def save_json(self, job, output_filepath):   
         new_jpg_name = os.path.basename(output_filepath)
         new_json_name = new_jpg_name.replace(".jpg", ".json")
 
-        new_json_path = os.path.join(self.file_output_dir, "_json", new_json_name)
+        new_json_path = os.path.join(job.file_output_dir, "_json", new_json_name)
         
-        if self.json_exists == True:
-            FileTools.ensure_folder_exists(os.path.join(self.file_output_dir, "_json"))              # Ensure json output dir exists
-            shutil.copy(self.json_path, new_json_path)                                  # copy the json
+        if job.json_exists == True:
+            self.name_allocator.ensure_dir(os.path.join(job.file_output_dir, "_json"))               # Ensure json output dir exists
+            shutil.copy(job.json_path, new_json_path)                                   # copy the json
+            self.journal_mark(job.filepath, SIDECAR_COPIED)
 
             if os.path.exists(new_json_path):                                           # confirm the file saved file actually exists
                 file_size = os.path.getsize(new_json_path)                              # confirm the saved file has a filsize 
                 if file_size > 2:                                                       # check that file size is > 1 bytes
-                    if self.delete_orig_file: 
-                        os.remove(self.json_path)                                       # Delete the original file if the copy was succesfull 
+                    if self.delete_orig_file and not self.sidecar_index.is_shared(job.filepath):     # an -edited copy may still need it
+                        os.remove(job.json_path)                                        # Delete the original file if the copy was succesfull 
                 else:
-                    self.json_saved = False
+                    job.json_saved = False
                     self.logger.info(f"Failed to confirm json saved. Filesize less then 2 bytes: {new_json_path}")
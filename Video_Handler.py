@@ -1,35 +1,106 @@
 import os
 import json
+import atexit
 import shutil
+import threading
 import exiftool
 from datetime import datetime
-from utils.utils import FileTools, get_exif_datetime
-from DuplicateImageRemover import DuplicateImageRemover
+from utils.utils import FileTools, get_exif_datetime, DIGEST_ALGORITHM
+from utils.quicktime_reader import read_quicktime_dates, normalize_date
+from utils.video_fingerprint import video_fingerprint, full_file_hash
+from utils.name_allocator import NameAllocator
+from utils.sidecar_index import SidecarIndex
+from utils.import_journal import PLACED, ORIGINAL_DELETED, SIDECAR_COPIED, DONE
+from utils.metrics import metrics
+
+
+EXIFTOOL_PATHS = (r"C:\Tools\ExifTool\exiftool.exe",)       # checked when exiftool isn't on the PATH
+
+_exiftool = None                        # shared -stay_open exiftool process, see get_exiftool
+_exiftool_error = None                  # why exiftool couldn't be started, it isn't tried again
+_exiftool_lock = threading.Lock()
+
+
+def get_exiftool():
+    """
+    Returns the exiftool process shared by every VideoHandler.  It's started (-stay_open) on first use and kept
+    running for the rest of the import, instead of starting a new exiftool for every video.  If it can't be started
+    the error is remembered and raised again right away for every later video.
+    """
+    global _exiftool, _exiftool_error
+    if _exiftool_error is not None:
+        raise _exiftool_error
+    if _exiftool is None:
+        executable = shutil.which("exiftool") or next((path for path in EXIFTOOL_PATHS if os.path.isfile(path)), "exiftool")
+        try:
+            process = exiftool.ExifTool(executable=executable)
+            process.run()
+        except Exception as e:
+            _exiftool_error = e
+            raise
+        _exiftool = process
+        atexit.register(close_exiftool)
+    return _exiftool
+
+
+def close_exiftool():
+    """ Stops the shared exiftool process if it was started """
+    global _exiftool
+    if _exiftool is not None:
+        try:
+            _exiftool.terminate()
+        finally:
+            _exiftool = None
 
 
 class VideoHandler:
-    def __init__(self, filepath, output_directory, logger, remove_files=False):
+    def __init__(self, filepath, output_directory, logger, remove_files=False, verify_copies=False, hash_db=None,
+                 name_allocator=None, sidecar_index=None, journal=None):
         self.filepath = filepath
         self.output_directory = output_directory
         self.delete_orig_file = remove_files
+        self.verify_copies = verify_copies or remove_files == True     # originals are only deleted after a verified copy
+        self.name_allocator = name_allocator or NameAllocator()        # share one between videos so each directory is listed once
+        self.sidecar_index = sidecar_index or SidecarIndex()           # same for the .json sidecars
+        self.journal = journal                                          # import journal of the current run (utils.import_journal)
 
         self.filename = os.path.basename(filepath)
         self.extension = os.path.splitext(self.filename)[1]
         self.init_logger(logger)
 
         self.datetime_taken = None              # initialize to a default value
-        self.prevent_duplicates = False         # dont prevent duplicates with DuplicateImageRemover unless enabled
+        self._prevent_duplicates_enabled = False    # dont check for duplicates unless enabled (see prevent_duplicates)
+        self.hash_db = hash_db                  # FileHashDB, digests of verified copies are recorded here
+        self.duplicate_of = None                # path of the stored video this one duplicates
+        self.digest = None                      # content digest of the verified copy (see save_video)
+        self.placed = False                     # True once the output was written, a later failure isn't marked failed
 
+    @metrics.timed("video_import_seconds")
     def run(self):
         ## Starts the backup
 
-        self.load_video_json()                  # Load .json data if it exists
-        self.extract_video_metadata()           # Extract metadata
-        self.filepath_orig = self.filepath      # stupid variable needed because of self.heic_to_jpg saves a temp file and needs to update self.filepath
-
-        self.get_output_filepath()              # Determine output name of image
-        self.save_video()                       # Save image to new filepath with metadata
+        if self.check_duplicate():              # Skip videos already in the database, no copy
+            self.journal_mark(DONE)
+            return
+
+        try:
+            self.load_video_json()              # Load .json data if it exists
+            self.extract_video_metadata()       # Extract metadata
+            self.filepath_orig = self.filepath  # stupid variable needed because of self.heic_to_jpg saves a temp file and needs to update self.filepath
+            self.get_output_filepath()          # Determine output name of image
+            self.save_video()                   # Save image to new filepath with metadata
+        except Exception:
+            if self._prevent_duplicates_enabled:
+                self.hash_db.remove_videos([self.filepath])     # not imported, don't keep it registered
+            raise
+        self.placed = True
+        if self.digest is not None and self.hash_db is not None:
+            self.hash_db.stage_digest(self.output_filepath, self.filepath, self.digest)
+        if self._prevent_duplicates_enabled:
+            self.hash_db.move_video(self.filepath, self.output_filepath, full_hash=self.digest)     # registered under the imported copy
+        self.journal_mark(ORIGINAL_DELETED if self.delete_orig_file == True else PLACED, self.output_filepath)
         self.save_json()                        # Save json to new filepath
+        self.journal_mark(DONE)
 
         '''
         1. Find all movie files
@@ -38,29 +109,54 @@ class VideoHandler:
         4. Save json files to json folder
         '''
 
-    def prevent_duplicates(self, dir_trash=None, enable=True):
-        if enable == False:
-            self.prevent_duplicates = False
+    def journal_mark(self, state, output_filepath=None):
+        if self.journal is not None:
+            self.journal.mark(self.filepath, state, output_filepath)
+
+    def finish_import(self, output_filepath):
+        """
+        Completes a video whose output was written by an interrupted run (see import_media --resume): copies the
+        json sidecar if it's still there and marks the video done.  The video isn't copied again.
+        """
+        self.output_filepath = output_filepath
+        self.output_directory = os.path.dirname(output_filepath)
+        self.json_path = self.sidecar_index.lookup(self.filepath)
+        self.json_exists = self.json_path is not None and os.path.isfile(self.json_path)     # may be gone with delete_after_copy
+        self.save_json()
+        self.journal_mark(DONE)
+
+    def prevent_duplicates(self, hash_db, enable=True):
+        """
+        - Enable or disable duplicate checks against the video fingerprints in hash_db (FileHashDB)
+        """
+        self._prevent_duplicates_enabled = enable
+        self.hash_db = hash_db
+
+    @metrics.timed("video_stage_seconds", stage="duplicate_check")
+    def check_duplicate(self):
+        """
+        Fingerprints the video (size + sampled chunks, see utils.video_fingerprint) and registers it in media.db.
+        A full hash of the file is only computed when the fingerprint matches a stored video.
+
+        Returns:
+            True if the video is a duplicate of a stored video
+        """
+        if not self._prevent_duplicates_enabled:
+            return False
+
+        size, fingerprint = video_fingerprint(self.filepath)
+        self.duplicate_of = self.hash_db.register_video(
+            self.filepath, fingerprint, size, lambda path: full_file_hash(path, self.hash_db.algorithm))
 
-        dir_path = r"E:\meda_management"
-        archive_path = r"E:\trash"
-        self.duplicateTracker = DuplicateImageRemover(dir_path)
-        if self.dir_trash is not None:
-            self.duplicateTracker.archive(archive_path=dir_trash)
+        if self.duplicate_of is not None:
+            self.logger.info(f"Duplicate video: {self.filepath} matches {self.duplicate_of}.  Skipped")
+            return True
+        return False
 
     def load_video_json(self):
-        # Handle json file naming conventions
-        json_path_1 = self.filepath.replace(self.extension, ".json")
-        json_path_2 = self.filepath + ".json"
-
-        if os.path.exists(json_path_1):
-            self.json_path = json_path_1    
-            self.json_exists = True
-        elif os.path.exists(json_path_2):
-            self.json_path = json_path_2
-            self.json_exists = True
-        else:
-            self.json_exists = False
+        # Find the sidecar from the directory listing (see utils.sidecar_index), handles Takeout's naming
+        self.json_path = self.sidecar_index.lookup(self.filepath)
+        self.json_exists = self.json_path is not None
 
         # Process JSON metadata
         if self.json_exists == True:
@@ -69,6 +165,7 @@ class VideoHandler:
         else:
             self.metadata = False                               # Creates an empty JSON object
 
+    @metrics.timed("video_stage_seconds", stage="metadata")
     def extract_video_metadata(self):
         """
         Extracts metadat contgained in self.metadata to EXIF .
@@ -83,26 +180,28 @@ class VideoHandler:
 
         self.exif_new = {}  # no standard structure like image EXIF blocks
 
-        #with exiftool.ExifTool(r'C:\Tools\ExifTool\exiftool.exe') as et:
-        ##with exiftool.ExifTool() as et:
-        #    metadata = et.get_metadata(self.filepath)
-
-        with exiftool.ExifTool(executable=r"C:\Tools\ExifTool\exiftool.exe") as et:
-            
-            metadata = et.execute(b"-j", self.filepath.encode("utf-8"))          # -j gives JSON output
-            metadata = json.loads(metadata)[0]
-            #metadata = json.loads(metadata.decode("utf-8"))[0]              # Decode and parse JSON
-
-        # Example: Try to extract something like "DateTimeOriginal"
+        # Dates tried in order.  The QuickTime tags are read natively from the moov atom, exiftool is only
+        # used if none of them are found
         possible_date_tags = [
-            "QuickTime:CreateDate",         # Most common for .mov
+            "QuickTime:CreateDate",         # Most common for .mov (mvhd, UTC)
+            "QuickTime:CreationDate",       # Apple keys metadata (local time)
+            "QuickTime:ContentCreateDate",  # udta ©day
             "EXIF:DateTimeOriginal",        # Some phones/cameras may include this
             "Composite:DateTimeCreated"     # Fallback if others are missing
         ]
 
+        try:
+            metadata = read_quicktime_dates(self.filepath)
+        except ValueError as e:
+            self.logger.info(f"Native video metadata parser failed for {self.filepath}: {e}")
+            metadata = {}
+
+        if not any(tag in metadata for tag in possible_date_tags):
+            metadata.update(self.read_exiftool_metadata())
+
         for tag in possible_date_tags:
-            if tag in metadata:
-                self.datetime_taken = metadata[tag]
+            if normalize_date(metadata.get(tag)):
+                self.datetime_taken = normalize_date(metadata[tag])
                 break
 
         if self.datetime_taken:
@@ -112,6 +211,16 @@ class VideoHandler:
         else:
             print("No video metadata date found.")
 
+    def read_exiftool_metadata(self):
+        """ Reads all metadata with the shared exiftool process (see get_exiftool), {} if exiftool isn't available """
+        try:
+            with _exiftool_lock:
+                metadata = get_exiftool().execute(b"-j", self.filepath.encode("utf-8"))      # -j gives JSON output
+            return json.loads(metadata)[0]
+        except Exception as e:
+            self.logger.info(f"exiftool failed reading {self.filepath}: {e}")
+            return {}
+
     def get_output_filepath(self):
         """
         Determines filepath that the image will be copied to.
@@ -141,29 +250,30 @@ class VideoHandler:
             formatted_date = dt.strftime("%Y%m%d_%H%M%S")
             folder_year = formatted_date[:4] 
             self.output_directory = os.path.join(self.output_directory, folder_year)            # Modify output_directory to include year folder
-            FileTools.ensure_folder_exists(self.output_directory)                                         # ensure the output directory exists
 
             if not self.filename.startswith(formatted_date[:8]):                                # Check if the filename already starts with the correct date string
                 base_filename = f"{formatted_date}.mov"                                         # get new base_filename based on date string
-                self.output_filepath = FileTools.get_unique_filename(os.path.join(self.output_directory, base_filename))           # ensure unique file path
+                self.output_filepath = self.name_allocator.reserve(os.path.join(self.output_directory, base_filename))           # ensure unique file path
 
             else:                                                                               # filename already starts with correct date string
-                self.output_filepath = FileTools.get_unique_filename(os.path.join(self.output_directory, self.filename))           # ensure unique file path
+                self.output_filepath = self.name_allocator.reserve(os.path.join(self.output_directory, self.filename))           # ensure unique file path
 
         # If datetime taken metadata doesn't exist
         else:                                                                               # no date meta data for .jpg
             self.output_directory = os.path.join(self.output_directory, "unsorted")
-            FileTools.ensure_folder_exists(self.output_directory)                                     # ensure the output directory exists
             self.output_filepath = self.filepath.replace(self.extension, ".mov")            # keep original name and ensure .jpg file extnsion
-            self.output_filepath = FileTools.get_unique_filename(os.path.join(self.output_directory, self.filename))     # ensure unique name
+            self.output_filepath = self.name_allocator.reserve(os.path.join(self.output_directory, self.filename))     # ensure unique name
 
+    @metrics.timed("video_stage_seconds", stage="write")
     def save_video(self):
 
         file_size_orig = os.path.getsize(self.filepath)                     # get filesize of original file
-        if self.delete_orig_file == True:
-            shutil.move(self.filepath, self.output_filepath)                # execute the move
-        else:
-            shutil.copy2(self.filepath, self.output_filepath)               # execute the copy
+        algorithm = self.hash_db.algorithm if self.hash_db is not None else DIGEST_ALGORITHM
+        transfer = FileTools.transfer_file(self.filepath, self.output_filepath, move=self.delete_orig_file == True,
+                                           verify=self.verify_copies, algorithm=algorithm)     # execute the move/copy, raises if verification fails
+        self.digest = transfer.get("digest")
+        self.logger.info(f"Transferred {self.filepath} -> {self.output_filepath} ({transfer['method']}, "
+                         f"{transfer['bytes'] / 1024 / 1024:.1f} MB at {transfer['bytes_per_sec'] / 1024 / 1024:.1f} MB/s)")
         file_size_new = os.path.getsize(self.output_filepath)                      # get filesize of the new file
         
         # confirm transfer by checking the filesize
@@ -179,6 +289,7 @@ class VideoHandler:
             dt = int(dt.timestamp())                                        # Get datetime taken if it exists
             FileTools.set_file_creation_date(self.output_filepath, dt)                # Set file date created time
 
+    @metrics.timed("video_stage_seconds", stage="sidecar")
     def save_json(self):
         new_jpg_name = os.path.basename(self.output_filepath)
         new_json_name = new_jpg_name.replace(".mov", ".json")
@@ -186,13 +297,14 @@ class VideoHandler:
         new_json_path = os.path.join(self.output_directory, "_json", new_json_name)
         
         if self.json_exists == True:
-            FileTools.ensure_folder_exists(os.path.join(self.output_directory, "_json"))    # Ensure json output dir exists
+            self.name_allocator.ensure_dir(os.path.join(self.output_directory, "_json"))    # Ensure json output dir exists
             shutil.copy(self.json_path, new_json_path)                                      # Save the json
+            self.journal_mark(SIDECAR_COPIED)
 
             if os.path.exists(new_json_path):                                               # confirm the file saved file actually exists
                 file_size = os.path.getsize(new_json_path)                                  # confirm the saved file has a filsize 
                 if file_size > 2:
-                    if self.delete_orig_file:                                 # check that file size is > 1 bytes
+                    if self.delete_orig_file and not self.sidecar_index.is_shared(self.filepath):     # an -edited copy may still need it
                         os.remove(self.json_path)                                               # Delete the original file if the copy was succesfull 
                 else:
                     self.json_saved = False
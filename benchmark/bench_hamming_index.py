@@ -0,0 +1,65 @@
+"""
+Benchmarks near duplicate queries on HammingIndex as the number of stored hashes grows.
+
+Queries are stored hashes with a few random bits flipped (a re-compressed copy), plus random misses.
+
+    python benchmark/bench_hamming_index.py --sizes 10000 100000 1000000 --threshold 6
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.hamming_index import HammingIndex
+
+
+def bench_size(size, threshold, lookups):
+    rng = random.Random(size)
+    index = HammingIndex(threshold)
+    hashes = [rng.getrandbits(64) for _ in range(size)]
+    for value in hashes:
+        index.add(value)
+
+    queries = []
+    for n in range(lookups):
+        if n % 2:
+            value = hashes[rng.randrange(size)]
+            for bit in rng.sample(range(64), rng.randint(0, threshold)):
+                value ^= 1 << bit
+            queries.append(value)
+        else:
+            queries.append(rng.getrandbits(64))
+
+    timings = []
+    found = 0
+    for query in queries:
+        start = time.perf_counter()
+        found += index.has_match(query)
+        timings.append(time.perf_counter() - start)
+
+    timings.sort()
+    return {
+        "rows": size,
+        "found": found,
+        "mean_us": sum(timings) / len(timings) * 1e6,
+        "p99_us": timings[int(len(timings) * 0.99)] * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--threshold", type=int, default=6)
+    parser.add_argument("--lookups", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'rows':>10}  {'found':>6}  {'mean (us)':>10}  {'p99 (us)':>10}")
+    for size in args.sizes:
+        result = bench_size(size, args.threshold, args.lookups)
+        print(f"{result['rows']:>10}  {result['found']:>6}  {result['mean_us']:>10.1f}  {result['p99_us']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Benchmarks the jpg output path of ImgHandler.encode_stage: decode + re-encode (image_handling.jpeg_passthrough: false)
+against passthrough, which copies the original bytes and only splices in the new exif segment.
+
+"passthrough+hash" also decodes each image for its phash, the cost passthrough still pays with duplicate detection on.
+
+    python benchmark/bench_jpeg_passthrough.py --files 50 --size 4000 3000
+"""
+import io
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import piexif
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from DuplicateImageRemover import DuplicateImageRemover
+
+
+def make_jpegs(count, size, quality):
+    """ Synthetic camera-like jpgs: noise plus blocks, so they don't compress unrealistically well """
+    rng = random.Random(count)
+    width, height = size
+    exif = piexif.dump({"0th": {}, "Exif": {piexif.ExifIFD.DateTimeOriginal: b"2021:05:06 10:11:12"}, "GPS": {}, "1st": {}})
+    files = []
+    for _ in range(count):
+        img = Image.effect_noise((width, height), rng.randrange(10, 60)).convert("RGB")
+        for _ in range(40):
+            x, y = rng.randrange(width), rng.randrange(height)
+            img.paste((rng.randrange(256), rng.randrange(256), rng.randrange(256)), (x, y, x + width // 10, y + height // 10))
+        buffer = io.BytesIO()
+        img.save(buffer, "jpeg", quality=quality, exif=exif)
+        files.append(buffer.getvalue())
+    return files
+
+
+def reencode(raw_bytes, exif_bytes, hasher):
+    img = Image.open(io.BytesIO(raw_bytes))
+    img.load()
+    if hasher is not None:
+        hasher.hash_image(img)
+    buffer = io.BytesIO()
+    img.save(buffer, "jpeg", exif=exif_bytes)
+    return buffer.getvalue()
+
+
+def passthrough(raw_bytes, exif_bytes, hasher):
+    if hasher is not None:
+        hasher.hash_image(Image.open(io.BytesIO(raw_bytes)))
+    buffer = io.BytesIO()
+    piexif.insert(exif_bytes, raw_bytes, buffer)
+    return buffer.getvalue()
+
+
+def bench_mode(name, func, files, exif_bytes, hasher=None):
+    start = time.perf_counter()
+    output_bytes = sum(len(func(raw_bytes, exif_bytes, hasher)) for raw_bytes in files)
+    elapsed = time.perf_counter() - start
+    input_bytes = sum(len(raw_bytes) for raw_bytes in files)
+    return {
+        "mode": name,
+        "files_per_s": len(files) / elapsed,
+        "mb_per_s": input_bytes / elapsed / 1024 / 1024,
+        "output_ratio": output_bytes / input_bytes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=30)
+    parser.add_argument("--size", type=int, nargs=2, default=[4000, 3000], metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--quality", type=int, default=92, help="quality of the synthetic source jpgs")
+    parser.add_argument("--hash-method", default="fast", choices=DuplicateImageRemover.HASH_METHODS)
+    args = parser.parse_args()
+
+    files = make_jpegs(args.files, args.size, args.quality)
+    exif_bytes = piexif.dump({"0th": {}, "Exif": {piexif.ExifIFD.DateTimeOriginal: b"2020:01:02 03:04:05"}, "GPS": {}, "1st": {}})
+
+    hasher = DuplicateImageRemover("", logging.getLogger("bench"))
+    hasher.hash_method = args.hash_method
+
+    results = [
+        bench_mode("reencode", reencode, files, exif_bytes),
+        bench_mode("reencode+hash", reencode, files, exif_bytes, hasher),
+        bench_mode("passthrough", passthrough, files, exif_bytes),
+        bench_mode("passthrough+hash", passthrough, files, exif_bytes, hasher),
+    ]
+
+    print(f"{'mode':>18}  {'files/s':>9}  {'MB/s':>9}  {'output/input':>12}")
+    for result in results:
+        print(f"{result['mode']:>18}  {result['files_per_s']:>9.1f}  {result['mb_per_s']:>9.1f}  {result['output_ratio']:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
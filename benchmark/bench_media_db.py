@@ -0,0 +1,67 @@
+"""
+Benchmarks FileHashDB.hash_exists lookup latency as the file_hashes table grows.
+
+Builds a throwaway database for each size, fills it with synthetic hashes and times random lookups
+(half hits, half misses).  Run with --no-index to compare against the pre-migration schema.
+
+    python benchmark/bench_media_db.py --sizes 10000 100000 1000000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.media_db import FileHashDB
+
+
+def fake_hash(i):
+    """ 16 hex character string, same shape as str(imagehash.phash(img)) """
+    return f"{(i * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF:016x}"
+
+
+def bench_size(directory, size, lookups, index=True):
+    db_path = os.path.join(directory, f"bench_{size}.db")
+    db = FileHashDB(db_path, batch_size=10000)
+    db.add_files((f"/library/{i // 1000}/{i}.jpg", fake_hash(i), 0.0, 0) for i in range(size))
+    if not index:
+        db.conn.execute("DROP INDEX IF EXISTS idx_file_hashes_hash")
+
+    rng = random.Random(size)
+    queries = [fake_hash(rng.randrange(size)) if n % 2 else fake_hash(size + n) for n in range(lookups)]
+
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        db.hash_exists(query)
+        timings.append(time.perf_counter() - start)
+    db.close()
+    os.remove(db_path)
+
+    timings.sort()
+    return {
+        "rows": size,
+        "mean_us": sum(timings) / len(timings) * 1e6,
+        "p50_us": timings[len(timings) // 2] * 1e6,
+        "p99_us": timings[int(len(timings) * 0.99)] * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--lookups", type=int, default=2000)
+    parser.add_argument("--no-index", action="store_true", help="drop the hash index before timing")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'rows':>10}  {'mean (us)':>10}  {'p50 (us)':>10}  {'p99 (us)':>10}")
+        for size in args.sizes:
+            result = bench_size(directory, size, args.lookups, index=not args.no_index)
+            print(f"{result['rows']:>10}  {result['mean_us']:>10.1f}  {result['p50_us']:>10.1f}  {result['p99_us']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
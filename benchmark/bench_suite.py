@@ -0,0 +1,287 @@
+"""
+End to end benchmark suite.  Generates a deterministic corpus (benchmark/corpus.py), builds throwaway libraries
+from it and times:
+- process_img       ImgHandler.process_img per image (duplicate detection on)
+- scan_images       DuplicateImageRemover.scan_images of a library, full and incremental rescan
+- check_image       DuplicateImageRemover.check_image of every image against the scanned library
+- file_hash_db      FileHashDB add_files, hash_exists, register_hash and get_file_states
+- import_media      full import_media.py runs (serial, --workers, --pipeline, --async), as subprocesses
+
+Results are written as json (--output), compare two versions with --compare:
+
+    python benchmark/bench_suite.py --images 200 --output before.json
+    python benchmark/bench_suite.py --images 200 --output after.json --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmark.corpus import generate_corpus
+from utils.confighandler import AppProperties
+from utils.media_db import FileHashDB
+from DuplicateImageRemover import DuplicateImageRemover
+from Image_Handler import ImgHandler
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS = ("process_img", "scan_images", "check_image", "file_hash_db", "import_media")
+IMPORT_MODES = {
+    "serial": [],
+    "workers": ["--workers", "4"],
+    "pipeline": ["--pipeline"],
+    "async": ["--async"],
+}
+IMAGE_KINDS = ("jpg_exif", "jpg_takeout", "png", "heic", "duplicate_exact", "duplicate_resized")
+
+
+@contextlib.contextmanager
+def quiet():
+    """ Hides the progress bars and prints of the code under test """
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        yield
+
+
+def summarize(timings, **info):
+    """ Result entry from per item timings (seconds) """
+    total = sum(timings)
+    ordered = sorted(timings)
+    result = {"items": len(timings), "seconds": total, "items_per_s": len(timings) / total if total else None}
+    if ordered:
+        result.update(mean_ms=total / len(ordered) * 1e3, p50_ms=ordered[len(ordered) // 2] * 1e3,
+                      p95_ms=ordered[int(len(ordered) * 0.95)] * 1e3)
+    result.update(info)
+    return result
+
+
+def make_library(directory, import_from=None, **settings):
+    """
+    Throwaway library in directory: lib/ with its .config/properties.yaml (the repo config with the paths replaced),
+    an empty media.db and a copy of import_from as the import directory.  settings are extra config keys.
+    """
+    shutil.rmtree(directory, ignore_errors=True)
+    library = {
+        "root": os.path.join(directory, "lib"),
+        "db_path": os.path.join(directory, "media.db"),
+        "trash": os.path.join(directory, "trash"),
+        "import": os.path.join(directory, "import"),
+    }
+    config_path = os.path.join(library["root"], ".config", "properties.yaml")
+    os.makedirs(os.path.dirname(config_path))
+    shutil.copyfile(os.path.join(REPO_DIR, "config", "properties.yaml"), config_path)
+
+    app_properties = AppProperties(config_path)
+    app_properties.set("database.directory", library["root"])
+    app_properties.set("database.db_path", library["db_path"])
+    app_properties.set("image_handling.trash_directory", library["trash"])
+    app_properties.set("image_handling.duplicate_detection.exclusion_directories",
+                       [os.path.join(library["root"], "unsorted"), os.path.join(library["root"], ".archive")])
+    for key, value in settings.items():
+        app_properties.set(key, value)
+    app_properties.save()
+    library["config"] = config_path
+
+    open(library["db_path"], "w").close()                  # an existing db, load_image_hash_db asks before creating one
+    if import_from is not None:
+        shutil.copytree(import_from, library["import"])
+    return library
+
+
+def image_paths(corpus_dir, manifest):
+    return [os.path.join(corpus_dir, entry["path"]) for entry in manifest["files"] if entry["kind"] in IMAGE_KINDS]
+
+
+def bench_process_img(workdir, corpus_dir, manifest, logger):
+    library = make_library(os.path.join(workdir, "process_img"), corpus_dir)
+    timings, failures = [], 0
+    with quiet():
+        handler = ImgHandler(logger, library["config"])
+        handler.prevent_duplicates(True, [os.path.join(library["root"], "unsorted")])
+        handler.archive_path(library["trash"], True)
+        for path in image_paths(library["import"], manifest):
+            start = time.perf_counter()
+            try:
+                handler.process_img(path)
+            except Exception as e:
+                failures += 1
+                logger.info(f"process_img failed for {path}: {e}")
+            timings.append(time.perf_counter() - start)
+        handler.close()
+    return {"process_img": summarize(timings, failures=failures)}
+
+
+def bench_scan_and_check(workdir, corpus_dir, manifest, logger):
+    library = make_library(os.path.join(workdir, "scan"))
+    shutil.copytree(corpus_dir, os.path.join(library["root"], "photos"))
+    extensions = (".jpg", ".jpeg", ".JPG", ".JPEG", ".png", ".PNG", ".heic", ".HEIC")
+    images = len([path for path in image_paths(corpus_dir, manifest) if path.endswith(extensions)])
+
+    remover = DuplicateImageRemover(library["root"], logger, extensions=extensions)
+    results = {}
+    with quiet():
+        remover.load_image_hash_db(library["db_path"])
+        for name, incremental in (("scan_images_full", False), ("scan_images_incremental", True)):
+            start = time.perf_counter()
+            remover.scan_images(library["root"], incremental=incremental)
+            elapsed = time.perf_counter() - start
+            results[name] = {"items": images, "seconds": elapsed, "items_per_s": images / elapsed}
+
+        # every image is in the db now.  The corpus copies aren't, so check_image hashes each one and finds it as a duplicate
+        timings, duplicates = [], 0
+        for path in image_paths(corpus_dir, manifest):
+            start = time.perf_counter()
+            duplicates += bool(remover.check_image(path))
+            timings.append(time.perf_counter() - start)
+        remover.img_hash_db.close()
+    results["check_image"] = summarize(timings, duplicates=duplicates)
+    return results
+
+
+def bench_file_hash_db(workdir, corpus_dir, manifest, rows, lookups):
+    db_path = os.path.join(workdir, "file_hash_db.db")
+    db = FileHashDB(db_path, batch_size=10000)
+    results = {}
+
+    def fake_hash(i):
+        return f"{(i * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF:016x}"
+
+    start = time.perf_counter()
+    db.add_files((f"/library/{i // 1000}/{i}.jpg", fake_hash(i), 0.0, 0) for i in range(rows))
+    elapsed = time.perf_counter() - start
+    results["file_hash_db_add_files"] = {"items": rows, "seconds": elapsed, "items_per_s": rows / elapsed}
+
+    timings = []
+    for n in range(lookups):
+        query = fake_hash(n * 7919 % rows) if n % 2 else fake_hash(rows + n)       # half hits, half misses
+        start = time.perf_counter()
+        db.hash_exists(query)
+        timings.append(time.perf_counter() - start)
+    results["file_hash_db_hash_exists"] = summarize(timings)
+
+    # register_hash stats the file, so it runs on the corpus images: new hashes first, then the same hashes again
+    paths = image_paths(corpus_dir, manifest)
+    for name in ("file_hash_db_register_new", "file_hash_db_register_duplicate"):
+        timings = []
+        for i, path in enumerate(paths):
+            start = time.perf_counter()
+            db.register_hash(path, fake_hash(rows + lookups + i))
+            timings.append(time.perf_counter() - start)
+        results[name] = summarize(timings)
+
+    start = time.perf_counter()
+    states = db.get_file_states("/library")
+    elapsed = time.perf_counter() - start
+    results["file_hash_db_get_file_states"] = {"items": len(states), "seconds": elapsed, "items_per_s": len(states) / elapsed}
+    db.close()
+    return results
+
+
+def bench_import_media(workdir, corpus_dir, manifest, modes):
+    files = len([entry for entry in manifest["files"] if entry["kind"] != "sidecar"])
+    results = {}
+    for mode in modes:
+        library = make_library(os.path.join(workdir, f"import_{mode}"), corpus_dir)
+        answers = f"{library['import']}\nyes\nno\nyes\n"       # import directory, settings, no library rescan, transfer
+        env = dict(os.environ, MEDIA_DB=library["root"])
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, os.path.join(REPO_DIR, "import_media.py")] + IMPORT_MODES[mode],
+                                 input=answers, env=env, cwd=REPO_DIR, capture_output=True, text=True)
+        elapsed = time.perf_counter() - start
+        imported = sum(len([name for name in names if not name.endswith((".json", ".yaml", ".log"))])
+                       for dirpath, _, names in os.walk(library["root"]) if "/." not in dirpath)
+        results[f"import_media_{mode}"] = {"items": files, "seconds": elapsed, "items_per_s": files / elapsed,
+                                           "imported": imported, "returncode": process.returncode}
+        if process.returncode != 0:
+            print(f"import_media {mode} exited with {process.returncode}:\n{process.stderr[-2000:]}", file=sys.stderr)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline_path):
+    """ Prints the throughput of results relative to a results file of an earlier run """
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+    print(f"\ncompared to {baseline_path} ({baseline.get('commit')})")
+    print(f"{'benchmark':>34}  {'before/s':>10}  {'after/s':>10}  {'change':>8}")
+    for name, result in results.items():
+        before = baseline["results"].get(name, {}).get("items_per_s")
+        after = result.get("items_per_s")
+        if before and after:
+            print(f"{name:>34}  {before:>10.1f}  {after:>10.1f}  {(after / before - 1) * 100:>+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=100, help="distinct images in the corpus")
+    parser.add_argument("--videos", type=int, default=10)
+    parser.add_argument("--size", type=int, nargs=2, default=[1024, 768], metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rows", type=int, default=100000, help="rows added to the FileHashDB benchmark database")
+    parser.add_argument("--lookups", type=int, default=5000)
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument("--modes", nargs="+", choices=IMPORT_MODES, default=list(IMPORT_MODES), help="import_media modes")
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--compare", metavar="RESULTS", help="json results of an earlier run to compare against")
+    parser.add_argument("--keep", action="store_true", help="keep the working directory")
+    args = parser.parse_args()
+
+    logger = logging.getLogger("bench")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    workdir = tempfile.mkdtemp(prefix="media_bench_")
+    corpus_dir = os.path.join(workdir, "corpus")
+    try:
+        manifest = generate_corpus(corpus_dir, args.images, args.videos, args.seed, tuple(args.size))
+        results = {}
+        if "process_img" in args.only:
+            results.update(bench_process_img(workdir, corpus_dir, manifest, logger))
+        if "scan_images" in args.only or "check_image" in args.only:
+            results.update(bench_scan_and_check(workdir, corpus_dir, manifest, logger))
+        if "file_hash_db" in args.only:
+            results.update(bench_file_hash_db(workdir, corpus_dir, manifest, args.rows, args.lookups))
+        if "import_media" in args.only:
+            results.update(bench_import_media(workdir, corpus_dir, manifest, args.modes))
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'benchmark':>34}  {'items':>7}  {'seconds':>9}  {'items/s':>10}  {'p50 (ms)':>9}  {'p95 (ms)':>9}")
+    for name, result in results.items():
+        p50, p95 = result.get("p50_ms"), result.get("p95_ms")
+        print(f"{name:>34}  {result['items']:>7}  {result['seconds']:>9.3f}  {result['items_per_s'] or 0:>10.1f}  "
+              f"{'' if p50 is None else f'{p50:.2f}':>9}  {'' if p95 is None else f'{p95:.2f}':>9}")
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "corpus": {key: manifest[key] for key in ("seed", "images", "videos", "size", "heic", "counts")},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"\nResults written to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""
+Deterministic synthetic media corpus for the benchmarks.  The same seed always gives the same files, so results of
+different versions are measured on identical input.
+
+The corpus mixes what a real import directory contains:
+- jpgs with exif dates and jpgs without exif, dated by a Google Takeout .json sidecar
+- pngs (.PNG) and heics (only if pillow_heif can encode on this machine)
+- small .MOV/.mp4 stubs (valid ftyp/moov/mvhd atoms around a padding mdat, enough for the metadata readers)
+- Takeout sidecar names: name.ext.json, names cut to 46 characters, "(1)" duplicates and .supplemental-metadata
+- planted duplicates: byte identical copies and re-encoded (resized) copies of earlier images
+
+A corpus.json manifest describing every file is written to the output directory.
+
+    python benchmark/corpus.py /tmp/corpus --images 500 --videos 20 --seed 1
+"""
+import io
+import os
+import sys
+import json
+import shutil
+import struct
+import random
+import argparse
+from datetime import datetime, timedelta, timezone
+
+import piexif
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.sidecar_index import TAKEOUT_NAME_LIMIT, SUPPLEMENTAL_SUFFIX
+
+MANIFEST_NAME = "corpus.json"
+QUICKTIME_EPOCH = datetime(1904, 1, 1, tzinfo=timezone.utc)
+FOLDERS = ("DCIM/100APPLE", "DCIM/101APPLE", "Takeout/Google Photos/Photos from 2019", "Takeout/Google Photos/Photos from 2021")
+
+
+def heic_supported():
+    """ True if pillow_heif is installed and can encode (some builds only decode) """
+    try:
+        from pillow_heif import register_heif_opener
+        register_heif_opener()
+        Image.new("RGB", (16, 16)).save(io.BytesIO(), "HEIF")
+        return True
+    except Exception:
+        return False
+
+
+def make_image(rng, size):
+    """
+    Camera-like content: smoothed noise plus coloured blocks, so it doesn't compress unrealistically well.  The noise
+    comes from rng (Image.effect_noise isn't seedable)
+    """
+    width, height = size
+    noise_size = (max(1, width // 4), max(1, height // 4))
+    img = Image.frombytes("RGB", noise_size, rng.randbytes(noise_size[0] * noise_size[1] * 3)).resize(size, Image.BILINEAR)
+    for _ in range(30):
+        x, y = rng.randrange(width), rng.randrange(height)
+        img.paste((rng.randrange(256), rng.randrange(256), rng.randrange(256)), (x, y, x + width // 8, y + height // 8))
+    return img
+
+
+def exif_bytes(taken):
+    stamp = taken.strftime("%Y:%m:%d %H:%M:%S").encode()
+    return piexif.dump({"0th": {piexif.ImageIFD.DateTime: stamp}, "GPS": {}, "1st": {},
+                        "Exif": {piexif.ExifIFD.DateTimeOriginal: stamp, piexif.ExifIFD.DateTimeDigitized: stamp}})
+
+
+def takeout_json(title, taken, rng):
+    """ Sidecar in the format of a Google Photos Takeout export """
+    timestamp = str(int(taken.replace(tzinfo=timezone.utc).timestamp()))
+    return {
+        "title": title,
+        "creationTime": {"timestamp": timestamp},
+        "photoTakenTime": {"timestamp": timestamp},
+        "geoData": {"latitude": round(rng.uniform(-60, 60), 6), "longitude": round(rng.uniform(-170, 170), 6),
+                    "altitude": 0.0, "latitudeSpan": 0.0, "longitudeSpan": 0.0},
+    }
+
+
+def sidecar_name(name, rng):
+    """ Takeout sidecar name of a media file, see utils/sidecar_index.py for the forms """
+    base, ext = os.path.splitext(name)
+    counter = ""
+    if base.endswith(")") and "(" in base:
+        base, counter = base[:base.rindex("(")], base[base.rindex("("):]
+    stem = base + ext + (SUPPLEMENTAL_SUFFIX if rng.random() < 0.3 else "")
+    return stem[:TAKEOUT_NAME_LIMIT] + counter + ".json"
+
+
+def _atom(kind, payload):
+    return struct.pack(">I", 8 + len(payload)) + kind + payload
+
+
+def write_video_stub(path, taken, brand=b"qt  ", mdat_size=4096):
+    """ Minimal QuickTime/MP4 file: ftyp, moov with an mvhd creation time, and an mdat of padding """
+    seconds = int((taken.replace(tzinfo=timezone.utc) - QUICKTIME_EPOCH).total_seconds())
+    mvhd = _atom(b"mvhd", b"\0\0\0\0" + struct.pack(">IIII", seconds, seconds, 600, 600) + b"\0" * 80)
+    ftyp = _atom(b"ftyp", brand + b"\0\0\0\0" + brand)
+    with open(path, "wb") as file:
+        file.write(ftyp + _atom(b"moov", mvhd) + _atom(b"mdat", b"\0" * mdat_size))
+
+
+def generate_corpus(directory, images=200, videos=10, seed=0, size=(1024, 768), duplicate_rate=0.1, heic=None):
+    """
+    Writes the corpus to directory (emptied first) and returns the manifest.
+
+    Args:
+        images: number of distinct images, duplicates are planted on top of these
+        videos: number of .MOV/.mp4 stubs
+        duplicate_rate: fraction of images that get a planted duplicate
+        heic: include heics, None = if pillow_heif can encode
+    """
+    rng = random.Random(seed)
+    heic = heic_supported() if heic is None else heic
+    shutil.rmtree(directory, ignore_errors=True)
+    for folder in FOLDERS + ("duplicates",):
+        os.makedirs(os.path.join(directory, folder))
+
+    files = []
+    start = datetime(2015, 1, 1)
+
+    def add(path, kind, **info):
+        files.append(dict(info, path=os.path.relpath(path, directory), kind=kind, size=os.path.getsize(path)))
+
+    def write_sidecar(path, taken):
+        folder, name = os.path.split(path)
+        json_path = os.path.join(folder, sidecar_name(name, rng))
+        with open(json_path, "w") as file:
+            json.dump(takeout_json(name, taken, rng), file)
+        add(json_path, "sidecar", media=os.path.relpath(path, directory))
+        return os.path.relpath(json_path, directory)
+
+    originals = []
+    for i in range(images):
+        taken = start + timedelta(seconds=rng.randrange(10 * 365 * 24 * 3600))
+        folder = os.path.join(directory, rng.choice(FOLDERS))
+        img = make_image(rng, size)
+
+        roll = rng.random()
+        if roll < 0.45:
+            kind, name = "jpg_exif", f"IMG_{i:05d}.jpg"
+        elif roll < 0.70:
+            kind, name = "jpg_takeout", rng.choice((f"IMG_{i:05d}.jpg", f"IMG_{i:05d}(1).jpg",
+                                                    f"PXL_{taken:%Y%m%d_%H%M%S}{i:03d}_a_long_takeout_file_name.jpg"))
+        elif roll < 0.85:
+            kind, name = "png", f"Screenshot_{i:05d}.PNG"
+        elif heic:
+            kind, name = "heic", f"IMG_{i:05d}.heic"
+        else:
+            kind, name = "jpg_exif", f"IMG_{i:05d}.jpg"
+
+        path = os.path.join(folder, name)
+        if kind == "jpg_exif":
+            img.save(path, "jpeg", quality=90, exif=exif_bytes(taken))
+        elif kind == "jpg_takeout":
+            img.save(path, "jpeg", quality=90)
+        elif kind == "png":
+            img.save(path, "png", compress_level=1)
+        else:
+            img.save(path, "HEIF", quality=80, exif=exif_bytes(taken))
+
+        sidecar = write_sidecar(path, taken) if kind in ("jpg_takeout", "png") else None
+        add(path, kind, taken=taken.isoformat(), sidecar=sidecar)
+        originals.append((path, img, taken))
+
+    # Planted duplicates: identical bytes under a new name, or the same picture re-encoded at a smaller size
+    for n, (path, img, taken) in enumerate(rng.sample(originals, int(len(originals) * duplicate_rate))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        if n % 2 == 0:
+            duplicate = os.path.join(directory, "duplicates", f"{name}_copy{os.path.splitext(path)[1]}")
+            shutil.copyfile(path, duplicate)
+            add(duplicate, "duplicate_exact", duplicate_of=os.path.relpath(path, directory))
+        else:
+            duplicate = os.path.join(directory, "duplicates", f"{name}_resized.jpg")
+            img.resize((img.width // 2, img.height // 2)).save(duplicate, "jpeg", quality=80, exif=exif_bytes(taken))
+            add(duplicate, "duplicate_resized", duplicate_of=os.path.relpath(path, directory))
+
+    for i in range(videos):
+        taken = start + timedelta(seconds=rng.randrange(10 * 365 * 24 * 3600))
+        folder = os.path.join(directory, rng.choice(FOLDERS))
+        if i % 2 == 0:
+            path, brand = os.path.join(folder, f"IMG_{i:05d}.MOV"), b"qt  "
+        else:
+            path, brand = os.path.join(folder, f"VID_{taken:%Y%m%d_%H%M%S}.mp4"), b"isom"
+        write_video_stub(path, taken, brand, mdat_size=rng.randrange(4096, 65536))
+        sidecar = write_sidecar(path, taken) if "Takeout" in folder else None
+        add(path, "video", taken=taken.isoformat(), sidecar=sidecar)
+
+    counts = {}
+    for entry in files:
+        counts[entry["kind"]] = counts.get(entry["kind"], 0) + 1
+    manifest = {"seed": seed, "images": images, "videos": videos, "size": list(size), "heic": heic,
+                "counts": counts, "files": files}
+    with open(os.path.join(directory, MANIFEST_NAME), "w") as file:
+        json.dump(manifest, file, indent=1)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory", help="output directory, emptied first")
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--videos", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--size", type=int, nargs=2, default=[1024, 768], metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--duplicate-rate", type=float, default=0.1)
+    parser.add_argument("--no-heic", action="store_true", help="don't generate heics even if pillow_heif can encode")
+    args = parser.parse_args()
+
+    manifest = generate_corpus(args.directory, args.images, args.videos, args.seed, tuple(args.size),
+                               args.duplicate_rate, heic=False if args.no_heic else None)
+    for kind, count in sorted(manifest["counts"].items()):
+        print(f"{kind:>18}  {count:>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,196 @@
 import os
 import sys
+import json
+import queue
+import shutil
+import tempfile
+import asyncio
+import logging
+import threading
+import argparse
+import multiprocessing
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 from Image_Handler import ImgHandler
 from Video_Handler import VideoHandler
 from colorama import Fore, Style, init
 from utils.confighandler import AppProperties
-from utils.utils import setup_logger, FileTools
+from utils.utils import setup_logger
+from utils.media_scanner import MediaScanner
+from utils.import_journal import ImportJournal, DONE, FAILED, SIDECAR_COPIED, PARTIAL_STATES
+from utils.retry import RetryScheduler, describe_error
+from utils.metrics import metrics
+
+
+IMG_EXTENSIONS = (".heic", "HEIC", ".jpg", ".JPG", ".jpeg", ".PNG")
+VIDEO_EXTENSIONS = ('.MOV', '.mov', '.mp4', '.MP4')
+MAX_COPY_ATTEMPTS = 4                # default of import_handling.retry.max_attempts
+
+_worker_image_handler = None        # per process ImgHandler, created by _init_worker
+_worker_root_path = None
+_worker_logger = None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Imports media files into the media database")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of worker processes used to import files (default: import_handling.workers or 1)")
+    parser.add_argument("--pipeline", action="store_true", default=None,
+                        help="Import images through the staged read/decode/encode/write pipeline (default: import_handling.pipeline)")
+    parser.add_argument("--async", dest="async_mode", action="store_true", default=None,
+                        help="Import files concurrently with asyncio, for high latency mounts (default: import_handling.async.enabled)")
+    parser.add_argument("--resume", metavar="RUN_ID", default=None,
+                        help="Resume an interrupted import run, files it already imported are skipped")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve live import metrics in the Prometheus text format on this port (default: import_handling.metrics.prometheus_port)")
+    return parser.parse_args()
+
+
+def media_type_of(file):
+    """ "image", "video" or None if file isn't a supported media file """
+    if file.endswith(IMG_EXTENSIONS):
+        return "image"
+    if file.endswith(VIDEO_EXTENSIONS):
+        return "video"
+    return None
+
+
+def import_file(file, image_handler, root_path, logger):
+    """
+    Imports a single media file, a single attempt (retries are scheduled by the caller, see utils.retry).
+
+    Returns:
+        failure: None on success, otherwise a utils.retry.describe_error dict (kind is "permanent" or "transient")
+    """
+    media_type = media_type_of(file)
+    video = None
+    try:
+        if media_type == "image":
+            image_handler.process_img(file)
+
+        elif media_type == "video":                                             # video processing
+            video = VideoHandler(file, root_path, logger, remove_files=False, verify_copies=image_handler.verify_copies,
+                                 hash_db=image_handler.duplicateTracker.img_hash_db, name_allocator=image_handler.name_allocator,
+                                 sidecar_index=image_handler.sidecar_index, journal=image_handler.journal)
+            video.prevent_duplicates(image_handler.duplicateTracker.img_hash_db, enable=image_handler._prevent_duplicates_enabled)
+            video.run()
+
+    except Exception as e:
+        logger.info(f"Failed processing {media_type} [{file}]: {e}")
+        if media_type == "video" and (video is None or not video.placed):     # images are marked by ImgHandler.release_job
+            image_handler.journal_mark(file, FAILED)
+        return describe_error(e)
+    return None
+
+
+async def import_async(files, image_handler, root_path, logger, settings, report):
+    """
+    Imports files concurrently on an asyncio event loop, so a high latency mount (NAS) is kept busy instead of
+    waiting on one stat/read/write at a time.  report(file, failure) is called as each file finishes.
+
+    - Filesystem and media.db work (reads, sidecars, writes, video copies) runs on a thread pool of io_workers
+    - Decode and encode run on a separate pool of cpu_workers (Pillow releases the GIL while it works)
+    - At most max_in_flight files are imported at once, which bounds the memory held by file contents
+    """
+    io_executor = ThreadPoolExecutor(settings.get("io_workers", 16), thread_name_prefix="import-io")
+    cpu_executor = ThreadPoolExecutor(settings.get("cpu_workers") or os.cpu_count() or 1, thread_name_prefix="import-cpu")
+    max_in_flight = max(1, settings.get("max_in_flight", 32))
+    loop = asyncio.get_running_loop()
+    pending = asyncio.Queue()
+    for file in files:
+        pending.put_nowait(file)
+
+    async def consumer():
+        # each consumer starts its next file as soon as its current one is done, a slow file only holds one slot
+        while not pending.empty():
+            file = pending.get_nowait()
+            if media_type_of(file) == "image":
+                _, error = await image_handler.process_img_async(file, io_executor, cpu_executor)
+                failure = describe_error(error) if error is not None else None
+            else:
+                failure = await loop.run_in_executor(io_executor, import_file, file, image_handler, root_path, logger)
+            report(file, failure)
+
+    try:
+        await asyncio.gather(*(consumer() for _ in range(min(max_in_flight, len(files)))))
+    finally:
+        io_executor.shutdown(wait=True)
+        cpu_executor.shutdown(wait=True)
+
+
+def resume_partial_imports(manifest, journal, image_handler, root_path, logger):
+    """
+    Applies the journal of a resumed run to the manifest (see --resume).  Files marked done are dropped, files
+    whose output was already written are completed without importing them again.  Hashes the interrupted run
+    registered for the files left to import are removed, they'd make the files duplicates of themselves.
+
+    Returns:
+        (files left to import, number of files skipped)
+    """
+    states = journal.states()                                           # one indexed query for the whole run
+    remaining = []
+    skipped = 0
+    for entry in manifest:
+        state, output_path = states.get(entry.path, (None, None))
+        if state == DONE:
+            skipped += 1
+        elif state in PARTIAL_STATES and output_path and os.path.isfile(output_path):
+            if entry.kind == "image":
+                image_handler.finish_import(entry.path, output_path, state)
+            elif state == SIDECAR_COPIED:
+                journal.mark(entry.path, DONE)
+            else:
+                VideoHandler(entry.path, root_path, logger, sidecar_index=image_handler.sidecar_index,
+                             journal=journal).finish_import(output_path)
+            skipped += 1
+        else:
+            remaining.append(entry)                                     # pending, failed or output missing
+    image_handler.forget_hashes([entry.path for entry in remaining if entry.kind == "image"])
+    journal.flush()
+    return remaining, skipped
+
+
+def _init_worker(app_properties_filepath, root_path, prevent_duplicates, exclusion_directories, archive_directory, archive_enabled,
+                 journal_path=None, run_id=None, metrics_dir=None, journal_settings=None):
+    """
+    Pool initializer.  Each worker process owns its own ImgHandler (and DB connection), since the
+    handler keeps per file state and can't be shared between processes.
+    - metrics_dir: the worker writes its metrics there when it exits, the parent merges them.  None disables metrics
+    - journal_settings: ImportJournal keyword arguments (batch_size, flush_interval, journal_mode) the parent uses
+    """
+    global _worker_image_handler, _worker_root_path, _worker_logger
+
+    logger = logging.getLogger("history.log")
+    if not logger.handlers:                                 # forked workers already inherit the parents handler
+        logger = setup_logger("history.log", "history.log", root_path)
+
+    _worker_logger = logger
+    _worker_root_path = root_path
+    metrics.reset()                                         # start empty, a forked worker inherits the parent's metrics
+    metrics.enabled = metrics_dir is not None
+    if metrics_dir is not None:
+        multiprocessing.util.Finalize(None, metrics.write_json, args=(os.path.join(metrics_dir, f"worker_{os.getpid()}.json"),),
+                                      exitpriority=5)         # after the handler's close, so its last flush is recorded
+    _worker_image_handler = ImgHandler(logger, app_properties_filepath)
+    _worker_image_handler.duplicateTracker.atomic_registration = True      # other workers write to the same db
+    _worker_image_handler.prevent_duplicates(prevent_duplicates, exclusion_directories)
+    _worker_image_handler.archive_path(archive_directory, archive_enabled)
+    if journal_path is not None:
+        journal = ImportJournal(journal_path, **(journal_settings or {}))      # journal of the parent's run, see ImportJournal.open_run
+        journal.open_run(run_id)
+        _worker_image_handler.use_journal(journal)
+        multiprocessing.util.Finalize(None, journal.close, exitpriority=10)
+    multiprocessing.util.Finalize(None, _worker_image_handler.close, exitpriority=10)     # write staged rows when the worker exits
+
+
+def _import_file_worker(file):
+    return file, import_file(file, _worker_image_handler, _worker_root_path, _worker_logger)
 
 
 def main():
+    args = parse_args()
 
     # Get database path from env variable 
     DB_DIR = Path(os.environ["MEDIA_DB"])
@@ -19,7 +199,20 @@ def main():
     # load app properties
     app_properties = AppProperties(CONFIG_DIR)
 
-    import_directory = input(Fore.YELLOW+"Provide Directory to import media from: "+Fore.RESET).strip()
+    journal_settings = {"batch_size": app_properties.get("import_handling.journal.batch_size", 200),
+                        "flush_interval": app_properties.get("import_handling.journal.flush_interval", 2.0),
+                        "journal_mode": app_properties.get("database.journal_mode", "WAL")}       # used by the import workers too
+    journal = ImportJournal(ImportJournal.path_for(app_properties.get("database.db_path")), **journal_settings)
+    if args.resume:
+        try:
+            import_directory = journal.resume_run(args.resume)
+        except KeyError:
+            print(Fore.RED + f"Unknown import run: {args.resume}" + Fore.RESET)
+            journal.close()
+            sys.exit(1)
+        print(Fore.YELLOW+f"Resuming import run {args.resume} from: {import_directory}"+Fore.RESET)
+    else:
+        import_directory = input(Fore.YELLOW+"Provide Directory to import media from: "+Fore.RESET).strip()
 
     root_path = app_properties.get("database.directory")                        # root path of database
     archive_enabled = app_properties.get("image_handling.archive")              # archive enabled bool
@@ -29,6 +222,14 @@ def main():
     archive_directory = app_properties.get("image_handling.trash_directory")                                    # archive/trash folder
     exclusion_directories = app_properties.get("image_handling.duplicate_detection.exclusion_directories")      # exclusion directories
 
+    workers = args.workers or app_properties.get("import_handling.workers", 1)   # number of import worker processes
+    pipeline_enabled = args.pipeline or app_properties.get("import_handling.pipeline", False)  # staged image pipeline
+    async_settings = app_properties.get("import_handling.async", {}) or {}
+    async_enabled = args.async_mode or async_settings.get("enabled", False)    # asyncio import for high latency mounts
+    metrics_settings = app_properties.get("import_handling.metrics", {}) or {}
+    metrics.enabled = metrics_settings.get("enabled", True)                     # stage timings and counters
+    metrics_port = args.metrics_port or metrics_settings.get("prometheus_port")
+
     # Setup debug logger
     print(root_path)
     logger = setup_logger("history.log", "history.log", root_path)
@@ -36,18 +237,30 @@ def main():
     logger.info(f"Database root path: {root_path}")
     logger.info(f"Importing files from: {import_directory}")
 
-    img_extensions = (".heic", "HEIC", ".jpg", ".JPG", ".jpeg", ".PNG")
-    video_extensions = ('.MOV', '.mov', '.mp4', '.MP4')
+    # Live metrics for Prometheus (only the parent's metrics, import workers report theirs when they exit)
+    metrics_server = None
+    if metrics.enabled and metrics_port:
+        metrics_host = metrics_settings.get("prometheus_host", "127.0.0.1")
+        metrics_server = metrics.serve(int(metrics_port), metrics_host)
+        print(f"Serving import metrics on http://{metrics_host}:{metrics_port}/metrics")
+        logger.info(f"Serving import metrics on {metrics_host}:{metrics_port}")
+
+    img_extensions = IMG_EXTENSIONS
+    video_extensions = VIDEO_EXTENSIONS
 
-    # Get statistics
+    # Get statistics.  Single scan of the import directory, the manifest is reused for the transfer
     start_time = datetime.now()
-    number_images = FileTools.count_media_files(import_directory, img_extensions)
-    number_videos = FileTools.count_media_files(import_directory, video_extensions)
+    scanner = MediaScanner(img_extensions, video_extensions)
+    with metrics.timer("import_scan_seconds"):
+        manifest = list(scanner.scan(import_directory))
+    number_images = scanner.counts["image"]
+    number_videos = scanner.counts["video"]
 
 
     print(Fore.WHITE + "\nImport Directory File Counts:"+Fore.RESET)
     print(f"{'Number of VIDEO files in Copy Directory':<40} - {number_videos}")
     print(f"{'Number of IMAGE files in Copy Directory':<40} - {number_images}")
+    print(f"{'Number of JSON sidecars in Copy Directory':<40} - {scanner.counts['sidecar']}")
 
     # init colorama 
     init(autoreset=True)
@@ -70,6 +283,8 @@ def main():
     print_setting("Database Root", "Path to the root database folder to import media files to", root_path)
     print_setting("Archive directory", "Directory where archives are stored when a duplicate is detected", archive_directory)
     print_setting("Exclusion directories", "Directories to exclude from duplicate checking", exclusion_directories)
+    print_setting("Import workers", "Number of processes used to import files in parallel", workers)
+    print_setting("Pipeline mode", "Overlap image reads, decode/encode and writes (ignores import workers)", pipeline_enabled)
 
     # confirm settings
     user_accepted = input (Fore.YELLOW + f"\n[yes/no]:  "+Fore.RESET)
@@ -97,13 +312,11 @@ def main():
     image_handler = ImgHandler(logger, app_properties.filepath)
     image_handler.prevent_duplicates(prevent_duplicates, exclusion_directories)
     image_handler.archive_path(archive_directory, archive_enabled)
+    image_handler.use_sidecar_index(scanner.sidecar_index)                 # sidecars matched by the import scan
     if scan_images:
         logger.info(f"Scanning images and updating database")
         image_handler.update_db(root_path)
 
-    os.makedirs(os.path.join(root_path, "tmp"), exist_ok=True)       # Ensure tmp output directory exists (directory that ProcessImage.heic_to_jpg uses to temp save files to)
-    max_copy_attempts = 10
-
     
     # confirm settings
     for i in range(2):
@@ -119,44 +332,109 @@ def main():
     num_images_failed = 0
     num_videos_failed = 0 
 
-    print(f"Starting transfer. \n")
-    logger.info("Starting Transfer")
-
-    # 1️⃣ Collect all files to process
-    all_files = []
-    for root, dirs, files in os.walk(import_directory):
-        for file in files:
-            if file.endswith(img_extensions) or file.endswith(video_extensions):
-                all_files.append(os.path.join(root, file))
-
-    # image processing
-    for file in tqdm(all_files, desc="Importing Images", unit="file"):
-        if file.endswith(img_extensions):
-            for attempt in range(1, max_copy_attempts+1):
+    # Journal of this run, so it can be resumed if interrupted
+    run_id = args.resume or journal.start_run(import_directory)
+    image_handler.use_journal(journal)
+    if args.resume:
+        manifest, skipped = resume_partial_imports(manifest, journal, image_handler, root_path, logger)
+        print(f"Skipping {skipped} files completed by the interrupted run")
+        logger.info(f"Resuming run {run_id}, {skipped} files already imported")
+    journal.add_files([entry.path for entry in manifest])
+
+    print(f"Starting transfer.  Import run: {run_id}  (resume with --resume {run_id})\n")
+    logger.info(f"Starting Transfer, run {run_id}")
+
+    # 1️⃣ Files to process, from the manifest collected with the statistics
+    all_files = [entry.path for entry in manifest]
+
+    def tally(media_type, success):
+        nonlocal number_images_processed, number_videos_processed, num_images_failed, num_videos_failed
+        metrics.inc("import_files_total", media=media_type, result="imported" if success else "failed")
+        if media_type == "image":
+            if success:
+                number_images_processed += 1
+            else:
+                num_images_failed += 1
+        elif media_type == "video":
+            if success:
+                number_videos_processed += 1
+            else:
+                num_videos_failed += 1
+
+    # Failed files are classified, permanent failures aren't retried and transient ones are retried after the
+    # rest of the batch with a backoff (see utils.retry.RetryScheduler)
+    retry_settings = app_properties.get("import_handling.retry", {}) or {}
+    scheduler = RetryScheduler(retry_settings.get("max_attempts", MAX_COPY_ATTEMPTS), retry_settings.get("base_delay", 2.0),
+                               retry_settings.get("max_delay", 60.0), logger=logger)
+
+    def run_scheduled(attempt_batch):
+        for file, failure in tqdm(scheduler.run(all_files, attempt_batch), total=len(all_files), desc="Importing Images", unit="file"):
+            tally(media_type_of(file), failure is None)
+
+    if async_enabled:
+        # asyncio import, many files in flight at once (see import_async)
+        logger.info(f"Importing with asyncio, {async_settings.get('max_in_flight', 32)} files in flight")
+
+        def attempt_async(files):
+            # the event loop runs on its own thread, results are handed over as each file finishes
+            results = queue.Queue()
+            errors = []
+
+            def run_loop():
                 try:
-                    image_handler.process_img(file)
-                    number_images_processed += 1
-                    break     # success
-
+                    asyncio.run(import_async(files, image_handler, root_path, logger, async_settings,
+                                             lambda file, failure: results.put((file, failure))))
                 except Exception as e:
-                    if attempt == max_copy_attempts:
-                        logger.info(f"Failed processing Image: [{file}]")
-                        num_images_failed += 1
-                        break                            
-
-        elif file.endswith(video_extensions):                                   # video processing
-            for attempt in range(1, max_copy_attempts):
-                try:
-                    video = VideoHandler(file_path, root_path, logger, remove_files=False)
-                    video.run()
-                    number_videos_processed += 1
-                    break  # success
+                    errors.append(e)
+                finally:
+                    results.put(None)
+
+            thread = threading.Thread(target=run_loop, name="import-async")
+            thread.start()
+            while (result := results.get()) is not None:
+                yield result
+            thread.join()
+            if errors:
+                raise errors[0]
+
+        run_scheduled(attempt_async)
+
+    elif pipeline_enabled:
+        # staged pipeline for images (see ImgHandler.process_imgs_pipelined), videos are imported afterwards
+        logger.info("Importing images with the staged pipeline")
+
+        def attempt_pipelined(files):
+            image_files = [file for file in files if media_type_of(file) == "image"]
+            for file, error in image_handler.process_imgs_pipelined(image_files):
+                yield file, describe_error(error) if error is not None else None
+            for file in files:
+                if media_type_of(file) != "image":
+                    yield file, import_file(file, image_handler, root_path, logger)
+
+        run_scheduled(attempt_pipelined)
+
+    elif workers > 1:
+        # parallel processing.  Each worker owns its own ImgHandler, the parent aggregates the results
+        logger.info(f"Importing with {workers} worker processes")
+        metrics_dir = tempfile.mkdtemp(prefix="import_metrics_") if metrics.enabled else None
+        initargs = (app_properties.filepath, root_path, prevent_duplicates, exclusion_directories, archive_directory, archive_enabled,
+                    journal.db_name, run_id, metrics_dir, journal_settings)
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+            run_scheduled(lambda files: pool.imap_unordered(_import_file_worker, files, chunksize=4))
+            pool.close()
+            pool.join()                                                 # let the workers exit normally, so they flush their rows
+        if metrics_dir is not None:
+            for name in os.listdir(metrics_dir):                        # metrics of each worker, see _init_worker
+                with open(os.path.join(metrics_dir, name)) as file:
+                    metrics.merge(json.load(file))
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+    else:
+        # image processing
+        run_scheduled(lambda files: ((file, import_file(file, image_handler, root_path, logger)) for file in files))
 
-                except Exception as e:
-                    if attempt == max_copy_attempts:
-                        logger.info(f"Failed processing Video [{file}]")
-                        num_videos_failed += 1
-                        break
+    image_handler.close()                                               # write the remaining batch of hashes
+    journal.finish_run()
+    journal.close()
 
     logger.info("Transfer Complete!!")
     print(f"\nTransfer Complete!!")
@@ -178,5 +456,22 @@ def main():
     print(f"    failed Image files: {num_images_failed}")
     print(f"    failed Video files: {num_videos_failed}")
 
-
-main()
+    report_path = scheduler.write_report(os.path.join(root_path, f"import_failures_{run_id}.json"),
+                                         run_id=run_id, import_directory=import_directory)
+    if report_path:
+        print(f"    failure report: {report_path}")
+
+    if metrics.enabled:
+        print(f"\nSlowest stages:\n{metrics.format_table()}")
+        if metrics_settings.get("export_json", True):
+            mode = "async" if async_enabled else "pipeline" if pipeline_enabled else f"workers={workers}" if workers > 1 else "serial"
+            metrics_path = metrics.write_json(os.path.join(root_path, f"import_metrics_{run_id}.json"), run_id=run_id,
+                                              import_directory=import_directory, mode=mode,
+                                              elapsed_seconds=elapsed_time.total_seconds())
+            print(f"Metrics: {metrics_path}")
+    if metrics_server is not None:
+        metrics_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import os
+import sys
+from pathlib import Path
+from colorama import Fore, Style, init
+from DuplicateImageRemover import DuplicateImageRemover
+from utils.confighandler import AppProperties
+from utils.utils import setup_logger
+
+
+def main():
+    """
+    Checks the hashes stored in media.db against the configured hash method
+    (image_handling.duplicate_detection.hash_method) and migrates them if they don't match.
+    """
+
+    # Get database path from env variable
+    DB_DIR = Path(os.environ["MEDIA_DB"])
+    CONFIG_DIR = DB_DIR / ".config/properties.yaml"
+    app_properties = AppProperties(CONFIG_DIR)
+
+    root_path = app_properties.get("database.directory")
+    db_path = app_properties.get("database.db_path")
+    hash_method = app_properties.get("image_handling.duplicate_detection.hash_method", "full")
+
+    init(autoreset=True)
+    logger = setup_logger("history.log", "history.log", root_path)
+    logger.info(f"\nStarting rehash_database.py.  Hash method: {hash_method}")
+
+    remover = DuplicateImageRemover(root_path, logger)
+    remover.load_image_hash_db(db_path)
+    remover.set_hash_method(hash_method)
+
+    counts = remover.img_hash_db.hash_method_counts()
+    print(Fore.WHITE + "\nStored hashes by method:")
+    for method, count in counts.items():
+        print(f"    {method:<10} - {count}")
+
+    pending = sum(count for method, count in counts.items() if method != hash_method)
+    if pending == 0:
+        print(Fore.GREEN + f"\nAll hashes already use the '{hash_method}' method.  Nothing to do")
+        return
+
+    # Compare a sample so the user can decide if a migration is needed
+    result = remover.check_hash_compatibility(hash_method)
+    print(Fore.WHITE + f"\nCompatibility of '{hash_method}' hashes with the stored hashes (sample of {result['compared']} files):")
+    print(f"    {'exact matches':<20} - {result['exact']}")
+    print(f"    {'max bit distance':<20} - {result['max_distance']}")
+    print(f"    {'mean bit distance':<20} - {result['mean_distance']:.2f}")
+
+    if result["compatible"]:
+        print(Fore.GREEN + "\nHashes are identical for the sample, migrating only updates the stored hash method.")
+    else:
+        print(Fore.YELLOW + f"\nHashes differ.  Without a migration exact duplicate checks against the {pending} stored rows will miss,"
+              f" unless hamming_threshold is at least {result['max_distance']}.")
+
+    user_accepted = input(Fore.YELLOW + f"\nRe-hash {pending} stored rows with the '{hash_method}' method? [yes/no]:  " + Fore.RESET)
+    if user_accepted not in ("yes", "y", "YES"):
+        print(Fore.RED + "Exiting")
+        sys.exit(1)
+
+    migrated, skipped = remover.migrate_hashes(hash_method)
+    remover.img_hash_db.close()
+    print(Fore.GREEN + f"\nMigrated {migrated} hashes" + Style.RESET_ALL + f"  ({skipped} skipped, file missing or unreadable)")
+
+
+if __name__ == "__main__":
+    main()
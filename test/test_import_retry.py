@@ -0,0 +1,108 @@
+"""
+A transient write failure must not leave the image's hash registered: the retry has to import the image into the
+library, not archive it as a duplicate of itself.
+
+    python -m pytest test/test_import_retry.py
+"""
+import os
+import sys
+import errno
+import logging
+
+import piexif
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Image_Handler import ImgHandler
+from import_media import import_file, resume_partial_imports
+from utils.import_journal import ImportJournal, PLACED, DONE
+from utils.media_scanner import MediaEntry
+from utils.retry import RetryScheduler
+from utils.utils import FileTools, CopyVerificationError
+
+CONFIG = """
+database:
+  directory: {root}
+  db_path: {db_path}
+image_handling:
+  trash_directory: {trash}
+  delete_after_copy: false
+  verify_copies: true
+  archive: true
+  duplicate_detection:
+    prevent_duplicates: true
+"""
+
+
+@pytest.fixture
+def library(tmp_path):
+    root, trash, source = tmp_path / "lib", tmp_path / "trash", tmp_path / "import"
+    (root / ".config").mkdir(parents=True)
+    source.mkdir()
+    db_path = tmp_path / "media.db"
+    db_path.touch()                                         # an existing db, load_image_hash_db asks before creating one
+    config = root / ".config" / "properties.yaml"
+    config.write_text(CONFIG.format(root=root, db_path=db_path, trash=trash))
+
+    image = source / "IMG_0001.jpg"
+    exif = piexif.dump({"0th": {}, "Exif": {piexif.ExifIFD.DateTimeOriginal: b"2020:01:02 03:04:05"}, "GPS": {}, "1st": {}})
+    Image.effect_noise((320, 240), 40).convert("RGB").save(image, "jpeg", exif=exif)
+    return {"root": root, "trash": trash, "config": config, "image": str(image)}
+
+
+def failing_once(func, error):
+    """ Wraps func (FileTools.write_verified, ImgHandler.save_json) so the first call raises error """
+    calls = []
+
+    def wrapper(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 1:
+            raise error
+        return func(*args, **kwargs)
+    return wrapper
+
+
+@pytest.mark.parametrize("error", [OSError(errno.EIO, "Input/output error"), CopyVerificationError("digest mismatch")])
+@pytest.mark.parametrize("atomic_registration", [False, True])          # serial import, import workers
+def test_retried_image_lands_in_library(library, monkeypatch, error, atomic_registration):
+    logger = logging.getLogger("test_import_retry")
+    handler = ImgHandler(logger, str(library["config"]))
+    handler.duplicateTracker.atomic_registration = atomic_registration
+    handler.prevent_duplicates(True)
+    handler.archive_path(str(library["trash"]), True)
+    monkeypatch.setattr(FileTools, "write_verified", failing_once(FileTools.write_verified, error))
+
+    scheduler = RetryScheduler(max_attempts=2, base_delay=0)
+    attempt = lambda files: ((file, import_file(file, handler, str(library["root"]), logger)) for file in files)
+    results = list(scheduler.run([library["image"]], attempt))
+    handler.close()
+
+    assert results == [(library["image"], None)]
+    imported = [name for _, _, names in os.walk(library["root"]) for name in names if name.endswith(".jpg")]
+    assert imported == ["20200102_030405.jpg"]
+    assert not library["trash"].exists() or not any(library["trash"].rglob("*.jpg"))
+
+
+def test_failure_after_placing_is_resumed(library, monkeypatch, tmp_path):
+    logger = logging.getLogger("test_import_retry")
+    handler = ImgHandler(logger, str(library["config"]))
+    handler.prevent_duplicates(True)
+    journal = ImportJournal(str(tmp_path / "import_journal.db"))
+    journal.start_run(str(tmp_path / "import"))
+    journal.add_files([library["image"]])
+    handler.use_journal(journal)
+    monkeypatch.setattr(ImgHandler, "save_json", failing_once(ImgHandler.save_json, OSError(errno.EIO, "Input/output error")))
+
+    assert import_file(library["image"], handler, str(library["root"]), logger) is not None
+    state, output_path = journal.states()[library["image"]]
+    assert state == PLACED                                  # the output was written, it isn't marked failed
+
+    manifest = [MediaEntry(library["image"], os.path.basename(library["image"]), "image", 0, 0.0, None)]
+    assert resume_partial_imports(manifest, journal, handler, str(library["root"]), logger) == ([], 1)
+    assert journal.states()[library["image"]] == (DONE, output_path)
+    handler.close()
+    journal.close()
+
+    imported = [name for _, _, names in os.walk(library["root"]) for name in names if name.endswith(".jpg")]
+    assert imported == ["20200102_030405.jpg"]
@@ -0,0 +1,35 @@
+"""
+Malformed QuickTime/MP4 files must raise ValueError, so VideoHandler.extract_video_metadata falls back to exiftool.
+
+    python -m pytest test/test_quicktime_reader.py
+"""
+import io
+import os
+import sys
+import struct
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.quicktime_reader import read_quicktime_dates
+
+
+def atom(kind, payload):
+    return struct.pack(">I", 8 + len(payload)) + kind + payload
+
+
+def movie(mvhd_payload):
+    return io.BytesIO(atom(b"ftyp", b"qt  \0\0\0\0qt  ") + atom(b"moov", atom(b"mvhd", mvhd_payload)) + atom(b"mdat", b"\0" * 64))
+
+
+def test_mvhd_create_date():
+    seconds = 3600 * 24 * 365 * 100                         # 100 (non leap) years after 1904
+    dates = read_quicktime_dates(movie(b"\0\0\0\0" + struct.pack(">II", seconds, seconds) + b"\0" * 88))
+    assert dates == {"QuickTime:CreateDate": "2003:12:07 00:00:00"}
+
+
+@pytest.mark.parametrize("payload", [b"", b"\0", b"\0\0\0\0\0\0", b"\1\0\0\0\0\0\0\0\0"],
+                         ids=["empty", "version only", "truncated v0", "truncated v1"])
+def test_truncated_mvhd_raises_value_error(payload):
+    with pytest.raises(ValueError):
+        read_quicktime_dates(movie(payload))
@@ -0,0 +1,64 @@
+"""
+An original and its -edited copy share one Takeout sidecar.  With delete_after_copy the sidecar may only be deleted
+once both were imported, whichever of them comes first.
+
+    python -m pytest test/test_sidecar_delete.py
+"""
+import os
+import sys
+import json
+import logging
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Image_Handler import ImgHandler
+from import_media import import_file
+
+CONFIG = """
+database:
+  directory: {root}
+  db_path: {db_path}
+image_handling:
+  trash_directory: {trash}
+  delete_after_copy: true
+  verify_copies: true
+  archive: true
+  duplicate_detection:
+    prevent_duplicates: true
+"""
+
+
+@pytest.fixture
+def library(tmp_path):
+    root, trash, source = tmp_path / "lib", tmp_path / "trash", tmp_path / "import"
+    (root / ".config").mkdir(parents=True)
+    source.mkdir()
+    db_path = tmp_path / "media.db"
+    db_path.touch()                                         # an existing db, load_image_hash_db asks before creating one
+    config = root / ".config" / "properties.yaml"
+    config.write_text(CONFIG.format(root=root, db_path=db_path, trash=trash))
+
+    Image.effect_noise((320, 240), 40).convert("RGB").save(source / "IMG_0001.jpg", "jpeg")
+    Image.effect_noise((320, 240), 90).convert("RGB").save(source / "IMG_0001-edited.jpg", "jpeg")
+    taken = {"timestamp": "1577934245"}                     # 2020-01-02 03:04:05 UTC
+    (source / "IMG_0001.jpg.json").write_text(json.dumps({"title": "IMG_0001.jpg", "photoTakenTime": taken}))
+    return {"root": root, "config": config, "source": source}
+
+
+@pytest.mark.parametrize("order", [("IMG_0001.jpg", "IMG_0001-edited.jpg"), ("IMG_0001-edited.jpg", "IMG_0001.jpg")],
+                         ids=["original first", "edited first"])
+def test_shared_sidecar_deleted_after_both(library, order):
+    logger = logging.getLogger("test_sidecar_delete")
+    handler = ImgHandler(logger, str(library["config"]))
+    handler.prevent_duplicates(True)
+    assert handler.delete_orig_file
+
+    results = [import_file(str(library["source"] / name), handler, str(library["root"]), logger) for name in order]
+    handler.close()
+
+    assert results == [None, None]
+    imported = sorted(name for _, _, names in os.walk(library["root"]) for name in names if name.endswith((".jpg", ".json")))
+    assert imported == ["20200102_030405-01.jpg", "20200102_030405-01.json", "20200102_030405.jpg", "20200102_030405.json"]
+    assert os.listdir(library["source"]) == []
@@ -0,0 +1,75 @@
+"""
+A video that fails after it was registered in media.db (e.g. an unreadable .json sidecar) must be deregistered, so an
+identical copy is still imported instead of being skipped as a duplicate of a video that was never stored.
+
+    python -m pytest test/test_video_import.py
+"""
+import os
+import sys
+import struct
+import logging
+from datetime import datetime, timezone
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Image_Handler import ImgHandler
+from import_media import import_file
+
+CONFIG = """
+database:
+  directory: {root}
+  db_path: {db_path}
+image_handling:
+  trash_directory: {trash}
+  delete_after_copy: false
+  verify_copies: true
+  archive: true
+  duplicate_detection:
+    prevent_duplicates: true
+"""
+
+
+def atom(kind, payload):
+    return struct.pack(">I", 8 + len(payload)) + kind + payload
+
+
+def write_movie(path, taken):
+    """ Minimal QuickTime file: ftyp, moov with an mvhd creation time, and an mdat of padding """
+    seconds = int((taken - datetime(1904, 1, 1, tzinfo=timezone.utc)).total_seconds())
+    mvhd = atom(b"mvhd", b"\0\0\0\0" + struct.pack(">IIII", seconds, seconds, 600, 600) + b"\0" * 80)
+    path.write_bytes(atom(b"ftyp", b"qt  \0\0\0\0qt  ") + atom(b"moov", mvhd) + atom(b"mdat", b"\0" * 4096))
+
+
+@pytest.fixture
+def library(tmp_path):
+    root, trash, source = tmp_path / "lib", tmp_path / "trash", tmp_path / "import"
+    (root / ".config").mkdir(parents=True)
+    (source / "a").mkdir(parents=True)
+    (source / "b").mkdir()
+    db_path = tmp_path / "media.db"
+    db_path.touch()                                         # an existing db, load_image_hash_db asks before creating one
+    config = root / ".config" / "properties.yaml"
+    config.write_text(CONFIG.format(root=root, db_path=db_path, trash=trash))
+    return {"root": root, "config": config, "source": source}
+
+
+def test_failed_video_does_not_shadow_its_copy(library):
+    logger = logging.getLogger("test_video_import")
+    handler = ImgHandler(logger, str(library["config"]))
+    handler.prevent_duplicates(True)
+
+    first, second = library["source"] / "a" / "IMG_0001.MOV", library["source"] / "b" / "IMG_0001.MOV"
+    write_movie(first, datetime(2020, 1, 2, 3, 4, 5, tzinfo=timezone.utc))
+    second.write_bytes(first.read_bytes())
+    sidecar = library["source"] / "a" / "IMG_0001.MOV.json"
+    sidecar.write_text("{ not json")                        # load_video_json fails on the first copy
+    handler.sidecar_index.add(str(first), str(sidecar))
+    handler.sidecar_index.add(str(second), None)
+
+    assert import_file(str(first), handler, str(library["root"]), logger) is not None
+    assert import_file(str(second), handler, str(library["root"]), logger) is None
+    handler.close()
+
+    imported = [name for _, _, names in os.walk(library["root"]) for name in names if name.endswith(".mov")]
+    assert imported == ["20200102_030405.mov"]
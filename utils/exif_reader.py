@@ -0,0 +1,273 @@
+"""
+Header only EXIF reader.  Finds the EXIF block of a .jpg (APP1 segment) or .heic (Exif item of the HEIF
+container) and reads the date tags from it, without decoding any pixels or parsing the rest of the file.
+Only the boxes/segments in front of the EXIF block and the block itself are read, usually the first few KB.
+"""
+import io
+import struct
+
+DATETIME = 306                      # IFD0 DateTime (last modified)
+DATETIME_ORIGINAL = 36867           # Exif DateTimeOriginal ("date taken")
+DATETIME_DIGITIZED = 36868          # Exif DateTimeDigitized
+EXIF_IFD_POINTER = 34665
+
+DATE_TAGS = (DATETIME, DATETIME_ORIGINAL, DATETIME_DIGITIZED)
+MAX_EXIF_BYTES = 1024 * 1024        # never read more than this for an exif block
+
+
+def read_exif_dates(source):
+    """
+    Returns {tag: "YYYY:MM:DD HH:MM:SS"} for the date tags (DATE_TAGS) found in the file's EXIF.
+    - source: filepath, bytes or a seekable binary file object
+    - {} if the file has no EXIF, raises ValueError if the file isn't a .jpg/.heic or is malformed
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return _read_exif_dates(io.BytesIO(source))
+    if isinstance(source, str):
+        with open(source, "rb") as file:
+            return _read_exif_dates(file)
+    return _read_exif_dates(source)
+
+
+def _read_exif_dates(file):
+    start = file.read(12)
+    file.seek(0)
+    try:
+        if start[:2] == b"\xff\xd8":
+            tiff = _jpeg_exif(file)
+        elif start[4:8] == b"ftyp":
+            tiff = _heif_exif(file)
+        else:
+            raise ValueError("Not a jpg or heif file")
+        return _tiff_dates(tiff) if tiff else {}
+    except (struct.error, IndexError) as e:
+        raise ValueError(f"Malformed EXIF: {e}")
+
+
+def _read_exact(file, size):
+    data = file.read(size)
+    if len(data) != size:
+        raise ValueError("Unexpected end of file")
+    return data
+
+
+# ---- JPEG -----------------------------------------------------------------------------------------------
+
+def _jpeg_exif(file):
+    """ Returns the TIFF block of the first APP1 Exif segment, or None """
+    file.seek(2)
+    while True:
+        byte = file.read(1)
+        if not byte:
+            return None
+        if byte != b"\xff":
+            raise ValueError("Malformed JPEG marker")
+        marker = file.read(1)
+        while marker == b"\xff":                                    # fill bytes
+            marker = file.read(1)
+        if not marker:
+            return None
+        code = marker[0]
+        if code == 0xD8 or code == 0x01 or 0xD0 <= code <= 0xD7:    # markers without a length
+            continue
+        if code in (0xDA, 0xD9):                                    # start of scan / end of image, no exif before the pixels
+            return None
+
+        length = struct.unpack(">H", _read_exact(file, 2))[0] - 2
+        if code == 0xE1:
+            payload = _read_exact(file, min(length, MAX_EXIF_BYTES))
+            if payload.startswith(b"Exif\x00\x00"):
+                return payload[6:]
+            file.seek(length - len(payload), io.SEEK_CUR)          # APP1 XMP segment
+        else:
+            file.seek(length, io.SEEK_CUR)
+
+
+# ---- HEIF -----------------------------------------------------------------------------------------------
+
+def _boxes(file, end):
+    """ Yields (box type, payload start, payload end) for the ISO BMFF boxes between the current position and end """
+    while end is None or file.tell() + 8 <= end:
+        header = file.read(8)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack(">I4s", header)
+        start = file.tell()
+        if size == 1:
+            size = struct.unpack(">Q", _read_exact(file, 8))[0]
+            start += 8
+            box_end = start - 16 + size
+        elif size == 0:
+            file.seek(0, io.SEEK_END)
+            box_end = file.tell()
+        else:
+            box_end = start - 8 + size
+        if box_end < start:
+            raise ValueError("Malformed box size")
+        yield box_type, start, box_end
+        file.seek(box_end)
+
+
+def _uint(data, offset, size):
+    """ Big endian unsigned int of size bytes (0, 4 or 8) at offset """
+    if size == 0:
+        return 0, offset
+    return int.from_bytes(data[offset:offset + size], "big"), offset + size
+
+
+def _heif_exif(file):
+    """ Returns the TIFF block of the Exif item in the HEIF meta box, or None """
+    for box_type, start, end in _boxes(file, None):
+        if box_type == b"meta":
+            file.seek(start + 4)                                    # full box, skip version/flags
+            return _heif_meta_exif(file, end)
+    return None
+
+
+def _heif_meta_exif(file, meta_end):
+    exif_ids = set()
+    locations = {}
+    idat_start = None
+
+    for box_type, start, end in _boxes(file, meta_end):
+        if box_type == b"iinf":
+            data = _read_exact(file, end - start)
+            exif_ids = _parse_iinf(data)
+        elif box_type == b"iloc":
+            data = _read_exact(file, end - start)
+            locations = _parse_iloc(data)
+        elif box_type == b"idat":
+            idat_start = start
+
+    for item_id in exif_ids:
+        if item_id not in locations:
+            continue
+        construction_method, extents = locations[item_id]
+        if construction_method == 1:
+            if idat_start is None:
+                continue
+            base = idat_start
+        elif construction_method == 0:
+            base = 0
+        else:
+            continue                                                # item references aren't used for exif
+
+        data = b""
+        for offset, length in extents:
+            file.seek(base + offset)
+            data += file.read(min(length, MAX_EXIF_BYTES - len(data)))
+
+        # payload is a 4 byte offset to the TIFF header, usually past an "Exif\0\0" prefix
+        if len(data) < 4:
+            continue
+        tiff_offset = struct.unpack(">I", data[:4])[0]
+        tiff = data[4 + tiff_offset:]
+        if tiff.startswith(b"Exif\x00\x00"):
+            tiff = tiff[6:]
+        return tiff
+    return None
+
+
+def _parse_iinf(data):
+    """ Returns the item ids of the Exif items in an iinf box payload """
+    version = data[0]
+    offset = 4
+    count_size = 2 if version == 0 else 4
+    count, offset = _uint(data, offset, count_size)
+
+    exif_ids = set()
+    for _ in range(count):
+        size, box_type = struct.unpack(">I4s", data[offset:offset + 8])
+        if size < 8:
+            raise ValueError("Malformed infe box")
+        if box_type == b"infe":
+            infe = data[offset + 8:offset + size]
+            infe_version = infe[0]
+            if infe_version >= 2:
+                id_size = 2 if infe_version == 2 else 4
+                item_id, pos = _uint(infe, 4, id_size)
+                item_type = infe[pos + 2:pos + 6]                   # skip item_protection_index
+                if item_type == b"Exif":
+                    exif_ids.add(item_id)
+        offset += size
+    return exif_ids
+
+
+def _parse_iloc(data):
+    """ Returns {item id: (construction method, [(offset, length), ...])} from an iloc box payload """
+    version = data[0]
+    offset_size = data[4] >> 4
+    length_size = data[4] & 0x0F
+    base_offset_size = data[5] >> 4
+    index_size = data[5] & 0x0F if version in (1, 2) else 0
+    pos = 6
+    count, pos = _uint(data, pos, 2 if version < 2 else 4)
+
+    locations = {}
+    for _ in range(count):
+        item_id, pos = _uint(data, pos, 2 if version < 2 else 4)
+        construction_method = 0
+        if version in (1, 2):
+            construction_method, pos = _uint(data, pos, 2)
+            construction_method &= 0x0F
+        pos += 2                                                    # data_reference_index
+        base_offset, pos = _uint(data, pos, base_offset_size)
+        extent_count, pos = _uint(data, pos, 2)
+        extents = []
+        for _ in range(extent_count):
+            if index_size:
+                pos += index_size
+            extent_offset, pos = _uint(data, pos, offset_size)
+            extent_length, pos = _uint(data, pos, length_size)
+            extents.append((base_offset + extent_offset, extent_length))
+        locations[item_id] = (construction_method, extents)
+    return locations
+
+
+# ---- TIFF -----------------------------------------------------------------------------------------------
+
+def _tiff_dates(tiff):
+    """ Reads the date tags from IFD0 and the Exif sub IFD of a TIFF block """
+    if tiff[:2] == b"II":
+        endian = "<"
+    elif tiff[:2] == b"MM":
+        endian = ">"
+    else:
+        raise ValueError("Malformed TIFF header")
+    ifd0 = struct.unpack(endian + "I", tiff[4:8])[0]
+
+    dates = {}
+    entries = _ifd_entries(tiff, ifd0, endian)
+    for tag in (DATETIME,):
+        if tag in entries:
+            dates[tag] = _ascii(tiff, entries[tag], endian)
+    if EXIF_IFD_POINTER in entries:
+        exif_offset = struct.unpack(endian + "I", entries[EXIF_IFD_POINTER][2])[0]
+        exif_entries = _ifd_entries(tiff, exif_offset, endian)
+        for tag in (DATETIME_ORIGINAL, DATETIME_DIGITIZED):
+            if tag in exif_entries:
+                dates[tag] = _ascii(tiff, exif_entries[tag], endian)
+    return {tag: value for tag, value in dates.items() if value}
+
+
+def _ifd_entries(tiff, offset, endian):
+    """ Returns {tag: (type, count, raw 4 byte value/offset)} for the entries of the IFD at offset """
+    count = struct.unpack(endian + "H", tiff[offset:offset + 2])[0]
+    entries = {}
+    for i in range(count):
+        entry = tiff[offset + 2 + i * 12:offset + 14 + i * 12]
+        tag, value_type, value_count = struct.unpack(endian + "HHI", entry[:8])
+        entries[tag] = (value_type, value_count, entry[8:12])
+    return entries
+
+
+def _ascii(tiff, entry, endian):
+    value_type, count, raw = entry
+    if value_type != 2:                                             # not ASCII
+        return None
+    if count <= 4:
+        value = raw[:count]
+    else:
+        offset = struct.unpack(endian + "I", raw)[0]
+        value = tiff[offset:offset + count]
+    return value.split(b"\x00", 1)[0].decode("ascii", "replace").strip() or None
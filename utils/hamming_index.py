@@ -0,0 +1,100 @@
+from itertools import combinations
+
+
+class HammingIndex():
+    """
+    Multi-index hashing over 64 bit perceptual hashes, finds every stored hash within a Hamming distance
+    threshold without comparing against all of them.
+
+    Each hash is split into `chunks` equal parts and every part is indexed in its own table.  By the pigeonhole
+    principle two hashes within distance r have at least one part within distance r // chunks, so a query only
+    probes the buckets near each of its parts and checks the (few) candidates found there.
+    """
+
+    BITS = 64
+
+    def __init__(self, threshold, chunks=4):
+        if self.BITS % chunks:
+            raise ValueError(f"chunks must divide {self.BITS}")
+        self.threshold = int(threshold)
+        self.chunks = chunks
+        self.chunk_bits = self.BITS // chunks
+        self.chunk_mask = (1 << self.chunk_bits) - 1
+        self.tables = [{} for _ in range(chunks)]       # chunk value -> list of hashes
+        self.values = set()
+
+        # xor masks of every bit pattern within the per chunk search radius
+        radius = self.threshold // chunks
+        self._flip_masks = [0]
+        for distance in range(1, radius + 1):
+            for bits in combinations(range(self.chunk_bits), distance):
+                mask = 0
+                for bit in bits:
+                    mask |= 1 << bit
+                self._flip_masks.append(mask)
+
+    def __len__(self):
+        return len(self.values)
+
+    @staticmethod
+    def to_int(file_hash):
+        """ Converts a hex phash string (str(imagehash.phash(img))) to an int.  Returns None if it isn't one """
+        if isinstance(file_hash, int):
+            return file_hash
+        try:
+            value = int(file_hash, 16)
+        except (TypeError, ValueError):
+            return None
+        return value if value.bit_length() <= HammingIndex.BITS else None
+
+    def _parts(self, value):
+        return [(value >> (i * self.chunk_bits)) & self.chunk_mask for i in range(self.chunks)]
+
+    def add(self, file_hash):
+        value = self.to_int(file_hash)
+        if value is None or value in self.values:
+            return
+        self.values.add(value)
+        for table, part in zip(self.tables, self._parts(value)):
+            table.setdefault(part, []).append(value)
+
+    def remove(self, file_hash):
+        value = self.to_int(file_hash)
+        if value is None or value not in self.values:
+            return
+        self.values.discard(value)
+        for table, part in zip(self.tables, self._parts(value)):
+            bucket = table.get(part)
+            if bucket:
+                bucket.remove(value)
+                if not bucket:
+                    del table[part]
+
+    def query(self, file_hash, threshold=None):
+        """
+        Returns [(distance, hash_int), ...] for every stored hash within threshold of file_hash, closest first.
+        threshold can't be larger than the threshold the index was built for.
+        """
+        value = self.to_int(file_hash)
+        if value is None:
+            return []
+        threshold = self.threshold if threshold is None else min(int(threshold), self.threshold)
+
+        matches = {}
+        for table, part in zip(self.tables, self._parts(value)):
+            for mask in self._flip_masks:
+                for candidate in table.get(part ^ mask, ()):
+                    if candidate not in matches:
+                        distance = (candidate ^ value).bit_count()
+                        if distance <= threshold:
+                            matches[candidate] = distance
+        return sorted((distance, candidate) for candidate, distance in matches.items())
+
+    def has_match(self, file_hash, threshold=None):
+        """ True if any stored hash is within threshold of file_hash """
+        return len(self.query(file_hash, threshold)) > 0
+
+    def load(self, conn):
+        """ Builds the index from every hash in file_hashes """
+        for (file_hash,) in conn.execute("SELECT DISTINCT hash FROM file_hashes"):
+            self.add(file_hash)
@@ -0,0 +1,125 @@
+import sys
+import math
+import hashlib
+
+
+class BloomFilter():
+    """
+    Fixed size Bloom filter over strings/ints.  might_contain() never returns a false negative, false
+    positives happen at roughly fp_rate once capacity items have been added.
+    """
+
+    def __init__(self, capacity, fp_rate=0.01, max_bytes=None):
+        capacity = max(1, int(capacity))
+        bits = int(-capacity * math.log(fp_rate) / (math.log(2) ** 2))
+        if max_bytes is not None:
+            bits = min(bits, int(max_bytes) * 8)                        # stay inside the memory budget
+        self.num_bits = max(64, bits)
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(str(item).encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))     # double hashing
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def might_contain(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+    def memory_usage(self):
+        return len(self.bits)
+
+
+class HashIndex():
+    """
+    In memory index of the hashes (and paths) stored in media.db, so duplicate checks don't need a query
+    against the database on the NAS.
+
+    - "set" mode: every hash is held in a set (packed to an int when it's a hex phash).  Lookups are exact.
+    - "bloom" mode: used when the set won't fit in memory_budget_mb (or bloom=True).  Only a Bloom filter is
+      held, misses are answered from memory and possible hits have to be confirmed against the database.
+    - Known paths are always held in a Bloom filter, so get_hash for a new file doesn't touch the database.
+
+    FileHashDB keeps the index write-through: every hash it writes is added, removed hashes are discarded.
+    """
+
+    SET_ENTRY_BYTES = 100           # approx. memory of an int in a set, including the slot and resize headroom
+    GROWTH = 2                      # size bloom filters for twice the current rows, so imports don't saturate them
+
+    def __init__(self, memory_budget_mb=64, bloom=False):
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self.force_bloom = bloom
+        self.mode = None
+        self.hashes = None
+        self.hash_filter = None
+        self.path_filter = None
+
+    @property
+    def exact(self):
+        """ True if might_contain_hash answers exactly (no database confirmation needed) """
+        return self.mode == "set"
+
+    @staticmethod
+    def _key(file_hash):
+        """ Packs a hex phash to an int, which takes far less memory than the string """
+        try:
+            return int(file_hash, 16)
+        except (TypeError, ValueError):
+            return file_hash
+
+    def load(self, conn):
+        """ Builds the index from every row in file_hashes """
+        rows = conn.execute("SELECT COUNT(*) FROM file_hashes").fetchone()[0]
+        capacity = max(rows * self.GROWTH, 10000)
+
+        # paths get a bloom filter with a 1/4 of the budget
+        self.path_filter = BloomFilter(capacity, max_bytes=self.memory_budget // 4)
+        remaining = self.memory_budget - self.path_filter.memory_usage()
+
+        if not self.force_bloom and rows * self.SET_ENTRY_BYTES <= remaining:
+            self.mode = "set"
+            self.hashes = set()
+        else:
+            self.mode = "bloom"
+            self.hash_filter = BloomFilter(capacity, max_bytes=remaining)
+
+        for path, file_hash in conn.execute("SELECT path, hash FROM file_hashes"):
+            self.add(file_hash, path)
+
+    def add(self, file_hash, path=None):
+        if path is not None:
+            self.path_filter.add(path)
+        if file_hash is None:
+            return
+        if self.mode == "set":
+            self.hashes.add(self._key(file_hash))
+        else:
+            self.hash_filter.add(self._key(file_hash))
+
+    def discard(self, file_hash):
+        """ Removes a hash that no longer has any rows.  Bloom filters can't remove, they stay a 'maybe' """
+        if self.mode == "set":
+            self.hashes.discard(self._key(file_hash))
+
+    def might_contain_hash(self, file_hash):
+        key = self._key(file_hash)
+        if self.mode == "set":
+            return key in self.hashes
+        return self.hash_filter.might_contain(key)
+
+    def might_contain_path(self, path):
+        return self.path_filter.might_contain(path)
+
+    def memory_usage(self):
+        """ Estimated memory used by the index in bytes """
+        usage = self.path_filter.memory_usage() if self.path_filter else 0
+        if self.mode == "set":
+            usage += sys.getsizeof(self.hashes) + len(self.hashes) * 36       # set table + int objects
+        elif self.hash_filter is not None:
+            usage += self.hash_filter.memory_usage()
+        return usage
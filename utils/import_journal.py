@@ -0,0 +1,157 @@
+"""
+Per run import journal, kept in its own SQLite file next to media.db.  Every source file of a run has a row with
+the last step it completed, so an interrupted import can be resumed (import_media.py --resume <run id>) without
+decoding and hashing the files that were already imported.
+
+States, in the order the handlers reach them:
+- pending           listed by the scan, nothing done yet
+- placed            output file written (output_path is set)
+- original_deleted  original removed after the copy (delete_after_copy)
+- sidecar_copied    .json sidecar copied next to the output
+- done              import complete (or skipped as a duplicate)
+- failed            import failed, retried on resume
+
+State changes are written in batches (batch_size / flush_interval).  A crash loses at most the last batch, those
+files are imported again on resume.
+"""
+import os
+import time
+import uuid
+import sqlite3
+import threading
+from datetime import datetime
+
+PENDING = "pending"
+PLACED = "placed"
+ORIGINAL_DELETED = "original_deleted"
+SIDECAR_COPIED = "sidecar_copied"
+DONE = "done"
+FAILED = "failed"
+
+PARTIAL_STATES = (PLACED, ORIGINAL_DELETED, SIDECAR_COPIED)     # output written, import not finished
+
+
+class ImportJournal:
+    def __init__(self, db_name, batch_size=200, flush_interval=2.0, journal_mode="WAL"):
+        self.db_name = db_name
+        self.batch_size = max(1, int(batch_size))   # state changes written per transaction
+        self.flush_interval = flush_interval        # seconds, staged changes are written at least this often
+        self._last_flush = time.monotonic()
+        self.run_id = None
+        self.conn = sqlite3.connect(self.db_name, timeout=30, check_same_thread=False)     # shared by pipeline threads and import workers
+        self.lock = threading.RLock()
+        self._pending = {}                          # path -> (state, output_path) not yet written
+
+        if journal_mode:
+            self.conn.execute(f"PRAGMA journal_mode={journal_mode}")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._init_db()
+
+    @staticmethod
+    def path_for(media_db_path):
+        """ Journal filepath next to media.db """
+        return os.path.join(os.path.dirname(os.path.abspath(media_db_path)), "import_journal.db")
+
+    def _init_db(self):
+        with self.lock:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS runs (
+                    run_id TEXT PRIMARY KEY,
+                    import_directory TEXT,
+                    started TEXT,
+                    finished TEXT
+                )
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS journal (
+                    run_id TEXT,
+                    path TEXT,
+                    state TEXT,
+                    output_path TEXT,
+                    updated TEXT,
+                    PRIMARY KEY (run_id, path)
+                )
+            """)
+            self.conn.commit()
+
+    def start_run(self, import_directory):
+        """ Creates a new run and returns its id """
+        run_id = datetime.now().strftime("%Y%m%d_%H%M%S_") + uuid.uuid4().hex[:6]
+        with self.lock:
+            self.conn.execute("INSERT INTO runs (run_id, import_directory, started) VALUES (?, ?, ?)",
+                              (run_id, import_directory, datetime.now().isoformat(timespec="seconds")))
+            self.conn.commit()
+        self.run_id = run_id
+        return run_id
+
+    def resume_run(self, run_id):
+        """ Continues an existing run.  Returns its import directory, raises KeyError for an unknown run id """
+        with self.lock:
+            row = self.conn.execute("SELECT import_directory FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"Unknown import run: {run_id}")
+        self.run_id = run_id
+        return row[0]
+
+    def open_run(self, run_id):
+        """ Attaches to a run started by another process (import workers) """
+        self.run_id = run_id
+
+    def add_files(self, paths):
+        """ Adds the files of the run as pending, files already in the journal keep their state """
+        now = datetime.now().isoformat(timespec="seconds")
+        with self.lock:
+            self.conn.executemany("INSERT OR IGNORE INTO journal (run_id, path, state, updated) VALUES (?, ?, ?, ?)",
+                                  [(self.run_id, path, PENDING, now) for path in paths])
+            self.conn.commit()
+
+    def states(self):
+        """ Returns {path: (state, output_path)} for the run, a single range query on the primary key """
+        with self.lock:
+            self.flush()
+            rows = self.conn.execute("SELECT path, state, output_path FROM journal WHERE run_id = ?", (self.run_id,))
+            return {path: (state, output_path) for path, state, output_path in rows}
+
+    def mark(self, path, state, output_path=None):
+        """ Records the step path reached.  Written with the next batch, see flush """
+        if self.run_id is None:
+            return
+        with self.lock:
+            if output_path is None and path in self._pending:
+                output_path = self._pending[path][1]            # keep the output of an earlier step
+            self._pending[path] = (state, output_path)
+            if len(self._pending) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+                self.flush()
+
+    def flush(self):
+        """ Writes the staged state changes as one transaction """
+        with self.lock:
+            self._last_flush = time.monotonic()
+            if not self._pending:
+                return
+            now = datetime.now().isoformat(timespec="seconds")
+            rows = [(self.run_id, path, state, output_path, now) for path, (state, output_path) in self._pending.items()]
+            try:
+                self.conn.executemany("""
+                    INSERT INTO journal (run_id, path, state, output_path, updated) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(run_id, path) DO UPDATE SET state=excluded.state, updated=excluded.updated,
+                                                            output_path=COALESCE(excluded.output_path, output_path)
+                """, rows)
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            self._pending.clear()
+
+    def finish_run(self):
+        """ Writes the remaining state changes and records the end of the run """
+        with self.lock:
+            self.flush()
+            self.conn.execute("UPDATE runs SET finished = ? WHERE run_id = ?",
+                              (datetime.now().isoformat(timespec="seconds"), self.run_id))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.conn.close()
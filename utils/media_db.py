@@ -1,14 +1,87 @@
 import os
 import sqlite3
+import threading
+from utils.hash_index import HashIndex
+from utils.hamming_index import HammingIndex
+from utils.metrics import metrics
 
 
 class FileHashDB():
-    def __init__(self, db_name="media.db", algorithm="sha256"):
+    # Schema migrations, applied in order to bring existing media.db files up to date.  The schema version is
+    # stored in PRAGMA user_version, version N means MIGRATIONS[:N] have been applied.  Only ever append.
+    MIGRATIONS = [
+        # 1 - index hash lookups (hash_exists is called for every imported image)
+        ["CREATE INDEX IF NOT EXISTS idx_file_hashes_hash ON file_hashes(hash)"],
+        # 2 - file size, stored next to mtime so rescans can tell if a file changed
+        ["ALTER TABLE file_hashes ADD COLUMN size INTEGER"],
+        # 3 - method used to compute the hash ("full" or "fast" decode), NULL rows were hashed with "full"
+        ["ALTER TABLE file_hashes ADD COLUMN hash_method TEXT"],
+        # 4 - video fingerprints (size + sampled chunks), full_hash is only filled in once fingerprints collide
+        ["""CREATE TABLE IF NOT EXISTS video_fingerprints (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                path TEXT UNIQUE,
+                size INTEGER,
+                fingerprint TEXT,
+                full_hash TEXT,
+                mtime REAL
+            )""",
+         "CREATE INDEX IF NOT EXISTS idx_video_fingerprints_fingerprint ON video_fingerprints(fingerprint)"],
+        # 5 - content digests of verified copies (imported file -> source it was copied from)
+        ["""CREATE TABLE IF NOT EXISTS file_digests (
+                path TEXT PRIMARY KEY,
+                source TEXT,
+                size INTEGER,
+                digest TEXT,
+                algorithm TEXT,
+                mtime REAL
+            )"""],
+    ]
+
+    UPSERT_SQL = """
+        INSERT INTO file_hashes (path, hash, mtime, size, hash_method) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(path) DO UPDATE SET hash=excluded.hash, mtime=excluded.mtime, size=excluded.size,
+                                        hash_method=excluded.hash_method
+    """
+
+    VIDEO_UPSERT_SQL = """
+        INSERT INTO video_fingerprints (path, size, fingerprint, full_hash, mtime) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(path) DO UPDATE SET size=excluded.size, fingerprint=excluded.fingerprint,
+                                        full_hash=excluded.full_hash, mtime=excluded.mtime
+    """
+
+    DIGEST_UPSERT_SQL = """
+        INSERT INTO file_digests (path, source, size, digest, algorithm, mtime) VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(path) DO UPDATE SET source=excluded.source, size=excluded.size, digest=excluded.digest,
+                                        algorithm=excluded.algorithm, mtime=excluded.mtime
+    """
+
+    def __init__(self, db_name="media.db", algorithm="blake2b", batch_size=500, journal_mode="WAL"):
         self.db_name = db_name
-        self.algorithm = algorithm
-        self.conn = sqlite3.connect(self.db_name)
+        self.algorithm = algorithm                  # content hash of videos and verified copies
+        self.batch_size = max(1, int(batch_size))   # rows written per transaction by add_files / stage_file
+        self.journal_mode = journal_mode            # WAL needs all writers on the same host, use DELETE otherwise
+        self.hash_method = "full"                   # stored with each row, see DuplicateImageRemover.hash_method
+        self.conn = sqlite3.connect(self.db_name, timeout=30, check_same_thread=False)     # timeout so concurrent import workers wait on locks
+        self.lock = threading.RLock()           # connection is shared between pipeline threads
+
+        self._pending = {}                      # path -> (hash, mtime, size) staged by stage_file, not yet written
+        self._pending_hashes = set()
+        self._pending_digests = []              # file_digests rows staged by stage_digest
+        self.hash_index = None                  # optional in memory index, see load_hash_index
+        self.hamming_index = None               # optional near duplicate index, see load_hamming_index
+
+        self._configure()
         self._init_db() 
 
+    def _configure(self):
+        """Set journaling and pragmas so writes aren't bound by fsync latency"""
+        c = self.conn.cursor()
+        if self.journal_mode:
+            c.execute(f"PRAGMA journal_mode={self.journal_mode}")
+        c.execute("PRAGMA synchronous=NORMAL")      # with WAL only the checkpoints fsync
+        c.execute("PRAGMA temp_store=MEMORY")
+        c.execute("PRAGMA cache_size=-16000")       # 16MB page cache
+
     def _init_db(self):
         """Create table if it doesn’t exist"""
         c = self.conn.cursor()
@@ -21,33 +94,396 @@ class FileHashDB():
             )
         """)
         self.conn.commit()
+        self._migrate()
+
+    def schema_version(self):
+        """Returns the schema version of the database"""
+        with self.lock:
+            return self.conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def _migrate(self):
+        """Applies any migrations in self.MIGRATIONS that haven't been applied to this database yet"""
+        with self.lock:
+            if self.schema_version() >= len(self.MIGRATIONS):
+                return
+
+            c = self.conn.cursor()
+            c.execute("BEGIN IMMEDIATE")            # another process may be migrating the same db
+            try:
+                version = c.execute("PRAGMA user_version").fetchone()[0]
+                for number, statements in enumerate(self.MIGRATIONS[version:], start=version + 1):
+                    for statement in statements:
+                        c.execute(statement)
+                    c.execute(f"PRAGMA user_version = {number}")
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+    def load_hash_index(self, memory_budget_mb=64, bloom=False):
+        """
+        Preloads every stored hash into an in memory HashIndex so hash_exists/get_hash misses don't query the
+        database.  The index is kept write-through by this class, writes made by other processes aren't
+        seen (register_hash always checks the database, so atomic registration is unaffected).
+        """
+        with self.lock:
+            self.flush()
+            index = HashIndex(memory_budget_mb, bloom=bloom)
+            index.load(self.conn)
+            self.hash_index = index
+        return index
+
+    def load_hamming_index(self, threshold, chunks=4):
+        """
+        Builds a HammingIndex over every stored hash so near duplicates (re-compressed or resized copies) can be
+        found with find_similar.  Kept write-through like the hash index.
+        """
+        with self.lock:
+            self.flush()
+            index = HammingIndex(threshold, chunks=chunks)
+            index.load(self.conn)
+            for file_hash, _, _ in self._pending.values():
+                index.add(file_hash)
+            self.hamming_index = index
+        return index
+
+    def find_similar(self, file_hash, threshold=None):
+        """
+        Returns [(distance, hash), ...] of stored hashes within threshold bits of file_hash, closest first.
+        Needs load_hamming_index, returns [] otherwise.
+        """
+        if self.hamming_index is None:
+            return []
+        with self.lock:
+            return [(distance, f"{value:016x}") for distance, value in self.hamming_index.query(file_hash, threshold)]
+
+    def _index_add(self, file_hash, path=None):
+        """Adds a written hash to the in memory indexes"""
+        if self.hash_index is not None:
+            self.hash_index.add(file_hash, path)
+        if self.hamming_index is not None:
+            self.hamming_index.add(file_hash)
 
     def add_file(self, path, file_hash):
         """Insert or update a file’s hash in the database"""
         if not os.path.isfile(path):
             raise FileNotFoundError(f"{path} not found")
         file_hash = FileHashDB.normalize_hash(file_hash)
+        stat = os.stat(path)
+        with self.lock:
+            self.conn.execute(FileHashDB.UPSERT_SQL, (path, file_hash, stat.st_mtime, stat.st_size, self.hash_method))
+            self.conn.commit()
+            self._index_add(file_hash, path)
+
+    @metrics.timed("db_operation_seconds", op="add_files")
+    def add_files(self, files, batch_size=None):
+        """
+        Bulk insert or update of file hashes.
+
+        Args:
+            files (iterable): (path, hash) or (path, hash, mtime, size) tuples.  mtime and size are read from
+                disk if not given
+            batch_size (int): rows per transaction, defaults to self.batch_size
+
+        Returns:
+            number of rows written
+        """
+        batch_size = batch_size or self.batch_size
+        written = 0
+        batch = []
+
+        for entry in files:
+            if len(entry) == 4:
+                path, file_hash, mtime, size = entry
+            else:
+                path, file_hash = entry
+                stat = os.stat(path)
+                mtime, size = stat.st_mtime, stat.st_size
+            batch.append((path, FileHashDB.normalize_hash(file_hash), mtime, size))
+
+            if len(batch) >= batch_size:
+                written += self._write_batch(batch)
+                batch = []
+
+        if batch:
+            written += self._write_batch(batch)
+        return written
+
+    @metrics.timed("db_operation_seconds", op="write_batch")
+    def _write_batch(self, batch):
+        with self.lock:
+            try:
+                self.conn.executemany(FileHashDB.UPSERT_SQL, [row + (self.hash_method,) for row in batch])
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            for path, file_hash, _, _ in batch:
+                self._index_add(file_hash, path)
+        metrics.inc("db_rows_written_total", len(batch))
+        return len(batch)
+
+    def stage_file(self, path, file_hash, mtime=None, size=None):
+        """
+        Queues a file’s hash to be written with the next batch (see add_files).  Staged hashes are visible to
+        get_hash and hash_exists right away.  Call flush() (or close()) to write the remaining rows.
+        """
+        if mtime is None or size is None:
+            stat = os.stat(path)
+            mtime, size = stat.st_mtime, stat.st_size
+        file_hash = FileHashDB.normalize_hash(file_hash)
+        with self.lock:
+            self._pending[path] = (file_hash, mtime, size)
+            self._pending_hashes.add(file_hash)
+            if self.hamming_index is not None:
+                self.hamming_index.add(file_hash)       # near duplicates within the batch must be found too
+            if len(self._pending) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        """Write all staged rows"""
+        with self.lock:
+            if self._pending_digests:
+                try:
+                    self.conn.executemany(FileHashDB.DIGEST_UPSERT_SQL, self._pending_digests)
+                    self.conn.commit()
+                except Exception:
+                    self.conn.rollback()
+                    raise
+                self._pending_digests.clear()
+            if not self._pending:
+                return
+            rows = [(path,) + values for path, values in self._pending.items()]
+            self._write_batch(rows)
+            self._pending.clear()
+            self._pending_hashes.clear()
+
+    def stage_digest(self, path, source, digest, algorithm=None):
+        """
+        Queues the content digest of a verified copy (path) of source, written with the next flush like
+        stage_file.  algorithm defaults to self.algorithm.
+        """
+        stat = os.stat(path)
+        with self.lock:
+            self._pending_digests.append((path, source, stat.st_size, digest, algorithm or self.algorithm, stat.st_mtime))
+            if len(self._pending_digests) >= self.batch_size:
+                self.flush()
+
+    def get_digest(self, path):
+        """Returns (digest, algorithm) recorded for path, or None"""
+        with self.lock:
+            self.flush()
+            return self.conn.execute("SELECT digest, algorithm FROM file_digests WHERE path = ?", (path,)).fetchone()
+
+    @metrics.timed("db_operation_seconds", op="register_hash")
+    def register_hash(self, path, file_hash):
+        """
+        Checks if file_hash already exists and adds path to the database if it doesn't, as a single
+        transaction.  Safe to call from several processes at once, only one of them will register a hash.
+
+        Returns:
+            True if the hash already existed (duplicate), False if path was added
+        """
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"{path} not found")
+        file_hash = FileHashDB.normalize_hash(file_hash)
+        stat = os.stat(path)
+        with self.lock:
+            self.flush()                            # staged rows must be written before taking the write lock
+            c = self.conn.cursor()
+
+            c.execute("BEGIN IMMEDIATE")            # take the write lock before the lookup
+            try:
+                c.execute("SELECT 1 FROM file_hashes WHERE hash = ? LIMIT 1", (file_hash,))
+                if c.fetchone():
+                    self.conn.commit()
+                    return True
+
+                c.execute(FileHashDB.UPSERT_SQL, (path, file_hash, stat.st_mtime, stat.st_size, self.hash_method))
+                self.conn.commit()
+                self._index_add(file_hash, path)
+                return False
+            except Exception:
+                self.conn.rollback()
+                raise
+
+    @metrics.timed("db_operation_seconds", op="register_video")
+    def register_video(self, path, fingerprint, size, full_hash_func):
+        """
+        Checks if a video with the same content is already stored and adds path if it isn't, as a single
+        transaction (safe across import workers like register_hash).
+
+        Fingerprint matches are confirmed with full_hash_func(path) -> str, so a full read of the files only
+        happens when fingerprints collide.  The full hash of the stored video is saved for the next collision.
+        Full hashes are computed before the transaction, so the write lock isn't held while large videos are read.
+
+        Returns:
+            path of the stored duplicate, or None if path was added
+        """
         mtime = os.path.getmtime(path)
-        c = self.conn.cursor()
-        
-        # Check if the path exists
-        c.execute("SELECT 1 FROM file_hashes WHERE path = ? LIMIT 1", (path,))
-        if c.fetchone():
-            # Update existing row
-            c.execute("UPDATE file_hashes SET hash=?, mtime=? WHERE path=?",
-                    (file_hash, mtime, path))
-        else:
-            # Insert new row
-            c.execute("INSERT INTO file_hashes (path, hash, mtime) VALUES (?, ?, ?)",
-                    (path, file_hash, mtime))
-        self.conn.commit()
+        full_hash = None
+        computed = {}                               # stored path -> full hash computed outside the transaction
+        missing = set()                             # stored paths that no longer exist
+        query = "SELECT path, full_hash FROM video_fingerprints WHERE fingerprint = ? AND path != ?"
+        while True:
+            with self.lock:
+                rows = self.conn.execute(query, (fingerprint, path)).fetchall()
+            for stored_path, stored_hash in rows:
+                if stored_hash is None and stored_path not in computed and stored_path not in missing:
+                    if os.path.isfile(stored_path):
+                        computed[stored_path] = full_hash_func(stored_path)
+                    else:
+                        missing.add(stored_path)
+            if rows and full_hash is None:
+                full_hash = full_hash_func(path)
+
+            with self.lock:
+                self.flush()                        # staged rows must be written before taking the write lock
+                c = self.conn.cursor()
 
+                c.execute("BEGIN IMMEDIATE")
+                try:
+                    rows = c.execute(query, (fingerprint, path)).fetchall()
+                    if any(stored_hash is None and stored_path not in computed and stored_path not in missing
+                           for stored_path, stored_hash in rows) or (rows and full_hash is None):
+                        self.conn.rollback()        # another worker added a candidate meanwhile, hash it first
+                        continue
+
+                    for stored_path, stored_hash in rows:
+                        if stored_hash is None:
+                            if stored_path in missing:
+                                c.execute("DELETE FROM video_fingerprints WHERE path = ?", (stored_path,))     # stale row
+                                continue
+                            stored_hash = computed[stored_path]
+                            c.execute("UPDATE video_fingerprints SET full_hash = ? WHERE path = ?", (stored_hash, stored_path))
+                        if stored_hash == full_hash:
+                            self.conn.commit()
+                            return stored_path
+
+                    c.execute(FileHashDB.VIDEO_UPSERT_SQL, (path, size, fingerprint, full_hash, mtime))
+                    self.conn.commit()
+                    return None
+                except Exception:
+                    self.conn.rollback()
+                    raise
+
+    @metrics.timed("db_operation_seconds", op="move_video")
+    def move_video(self, path, new_path, full_hash=None):
+        """
+        Points a registered video at its new path (the imported copy).  full_hash (self.algorithm) is stored if
+        given, e.g. the digest of a verified copy, so a later collision doesn't have to hash this video.
+        """
+        with self.lock:
+            self.conn.execute("UPDATE video_fingerprints SET path = ?, mtime = ?, full_hash = COALESCE(?, full_hash) WHERE path = ?",
+                              (new_path, os.path.getmtime(new_path), full_hash, path))
+            self.conn.commit()
+
+    def remove_videos(self, paths):
+        """Delete the fingerprint rows of videos.  Returns number of rows removed"""
+        with self.lock:
+            c = self.conn.executemany("DELETE FROM video_fingerprints WHERE path = ?", [(path,) for path in paths])
+            self.conn.commit()
+            return c.rowcount
+
+    @metrics.timed("db_operation_seconds", op="remove_files")
+    def remove_files(self, paths):
+        """Delete the rows of files that no longer exist.  Returns number of rows removed"""
+        removed = 0
+        batch = []
+        unstaged = set()                            # hashes of staged rows dropped here
+        with self.lock:
+            for path in paths:
+                staged = self._pending.pop(path, None)
+                if staged is not None:
+                    unstaged.add(staged[0])
+                batch.append((path,))
+                if len(batch) >= self.batch_size:
+                    removed += self._delete_batch(batch)
+                    batch = []
+            if batch:
+                removed += self._delete_batch(batch)
+
+            # staged hashes are visible to hash_exists, drop the ones no other staged row uses
+            unstaged -= {file_hash for file_hash, _, _ in self._pending.values()}
+            for file_hash in unstaged:
+                self._pending_hashes.discard(file_hash)
+                if self.hamming_index is not None:
+                    stored = self.conn.execute("SELECT 1 FROM file_hashes WHERE hash = ? LIMIT 1", (file_hash,)).fetchone()
+                    if stored is None:
+                        self.hamming_index.remove(file_hash)
+        return removed
+
+    def _delete_batch(self, batch):
+        removed_hashes = set()
+        if (self.hash_index is not None and self.hash_index.exact) or self.hamming_index is not None:
+            for (path,) in batch:
+                row = self.conn.execute("SELECT hash FROM file_hashes WHERE path = ?", (path,)).fetchone()
+                if row:
+                    removed_hashes.add(row[0])
+        try:
+            self.conn.executemany("DELETE FROM file_hashes WHERE path = ?", batch)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+        # keep the index consistent, a hash only leaves it once no row uses it
+        for file_hash in removed_hashes:
+            if self.conn.execute("SELECT 1 FROM file_hashes WHERE hash = ? LIMIT 1", (file_hash,)).fetchone() is None:
+                if self.hash_index is not None:
+                    self.hash_index.discard(file_hash)
+                if self.hamming_index is not None:
+                    self.hamming_index.remove(file_hash)
+        return len(batch)
+
+    @metrics.timed("db_operation_seconds", op="get_file_states")
+    def get_file_states(self, directory):
+        """
+        Returns {path: (hash, mtime, size)} for every file stored under directory.  Uses a range query on the
+        path index instead of LIKE, so it doesn't scan the whole table.
+        """
+        prefix = os.path.join(directory, "")                                    # ensure trailing separator
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)                          # first string after every prefix match
+        with self.lock:
+            self.flush()
+            rows = self.conn.execute(
+                "SELECT path, hash, mtime, size FROM file_hashes WHERE path >= ? AND path < ?",
+                (prefix, upper))
+            return {path: (file_hash, mtime, size) for path, file_hash, mtime, size in rows}
+
+    def hash_method_counts(self):
+        """Returns {hash_method: number of rows}.  Rows from before hash methods were stored count as "full" """
+        with self.lock:
+            self.flush()
+            rows = self.conn.execute("SELECT COALESCE(hash_method, 'full'), COUNT(*) FROM file_hashes GROUP BY 1")
+            return dict(rows.fetchall())
+
+    def get_rows_by_method(self, exclude_method=None, limit=None):
+        """Returns [(path, hash), ...] of rows, optionally only those not hashed with exclude_method"""
+        sql = "SELECT path, hash FROM file_hashes"
+        params = []
+        if exclude_method is not None:
+            sql += " WHERE COALESCE(hash_method, 'full') != ?"
+            params.append(exclude_method)
+        if limit is not None:
+            sql += " ORDER BY RANDOM() LIMIT ?"
+            params.append(int(limit))
+        with self.lock:
+            self.flush()
+            return self.conn.execute(sql, params).fetchall()
+
+    @metrics.timed("db_operation_seconds", op="get_hash")
     def get_hash(self, path):
         """Retrieve stored hash for a file"""
-        c = self.conn.cursor()
-        c.execute("SELECT hash FROM file_hashes WHERE path = ?", (path,))
-        row = c.fetchone()
-        return row[0] if row else None
+        with self.lock:
+            if path in self._pending:
+                return self._pending[path][0]
+            if self.hash_index is not None and not self.hash_index.might_contain_path(path):
+                return None                     # definitely not stored, no query needed
+            c = self.conn.cursor()
+            c.execute("SELECT hash FROM file_hashes WHERE path = ?", (path,))
+            row = c.fetchone()
+            return row[0] if row else None
 
     def has_changed(self, path, current_hash):
         """Check if file contents have changed since last stored or if they exist"""
@@ -64,12 +500,21 @@ class FileHashDB():
             if not recursive:
                 break
 
+    @metrics.timed("db_operation_seconds", op="hash_exists")
     def hash_exists(self, file_hash):
         """Check if a hash already exists in the database"""
         file_hash = FileHashDB.normalize_hash(file_hash)
-        c = self.conn.cursor()
-        c.execute("SELECT 1 FROM file_hashes WHERE hash = ? LIMIT 1", (file_hash,))
-        return c.fetchone() is not None
+        with self.lock:
+            if file_hash in self._pending_hashes:
+                return True
+            if self.hash_index is not None:
+                if not self.hash_index.might_contain_hash(file_hash):
+                    return False                # definitely not stored
+                if self.hash_index.exact:
+                    return True
+            c = self.conn.cursor()
+            c.execute("SELECT 1 FROM file_hashes WHERE hash = ? LIMIT 1", (file_hash,))
+            return c.fetchone() is not None
 
     @staticmethod
     def normalize_hash(h):
@@ -77,7 +522,8 @@ class FileHashDB():
         return h
 
     def close(self):
-        """Close database connection"""
+        """Write staged rows and close database connection"""
+        self.flush()
         self.conn.close()
 
 
@@ -0,0 +1,86 @@
+import os
+from utils.sidecar_index import SidecarIndex, match_sidecar
+
+
+class MediaEntry():
+    """ A media file found by MediaScanner, with the stat results cached from the scan """
+
+    __slots__ = ("path", "name", "kind", "size", "mtime", "sidecar")
+
+    def __init__(self, path, name, kind, size, mtime, sidecar=None):
+        self.path = path            # full filepath
+        self.name = name            # filename
+        self.kind = kind            # "image" or "video"
+        self.size = size            # size in bytes
+        self.mtime = mtime          # modification time
+        self.sidecar = sidecar      # filepath of the matching .json sidecar, or None
+
+    def __repr__(self):
+        return f"MediaEntry({self.kind}, {self.path})"
+
+
+class MediaScanner():
+    """
+    Walks a directory tree once with os.scandir and yields a MediaEntry for every image and video.
+
+    - Sidecars are matched from the directory listing (including Google Takeout's names, see utils.sidecar_index),
+      no extra stat calls.  The matches are kept in self.sidecar_index for the image/video handlers
+    - Counts are kept while scanning, so the statistics don't need a second walk (see self.counts)
+    """
+
+    def __init__(self, img_extensions, video_extensions):
+        self.img_extensions = img_extensions
+        self.video_extensions = video_extensions
+        self.counts = {"image": 0, "video": 0, "sidecar": 0}
+        self.sidecar_index = SidecarIndex()
+
+    def scan(self, directory, skip_dir=None):
+        """
+        Generator yielding a MediaEntry for every media file nested within directory.
+        - skip_dir: optional function(dirpath) -> bool, directories it returns True for aren't descended into
+        """
+        self.counts = {"image": 0, "video": 0, "sidecar": 0}
+        self.sidecar_index = SidecarIndex()
+        pending = [directory]
+
+        while pending:
+            current = pending.pop()
+            try:
+                with os.scandir(current) as it:
+                    entries = list(it)
+            except OSError:
+                continue                                        # unreadable directory, skipped like os.walk does
+
+            json_names = set()
+            media = []
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if skip_dir is None or not skip_dir(entry.path):
+                        pending.append(entry.path)
+                elif entry.name.endswith(".json"):
+                    json_names.add(entry.name)
+                elif entry.name.endswith(self.img_extensions):
+                    media.append((entry, "image"))
+                elif entry.name.endswith(self.video_extensions):
+                    media.append((entry, "video"))
+            self.sidecar_index.add_directory(current, json_names)
+
+            for entry, kind in media:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue                                    # file removed since the listing
+
+                sidecar = self.match_sidecar(entry.name, json_names)
+                if sidecar is not None:
+                    sidecar = os.path.join(current, sidecar)
+                    self.counts["sidecar"] += 1
+                self.sidecar_index.add(entry.path, sidecar)
+
+                self.counts[kind] += 1
+                yield MediaEntry(entry.path, entry.name, kind, stat.st_size, stat.st_mtime, sidecar)
+
+    @staticmethod
+    def match_sidecar(name, json_names):
+        """ Returns the name of the .json sidecar for the media file name, or None """
+        return match_sidecar(name, json_names)
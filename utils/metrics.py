@@ -0,0 +1,222 @@
+"""
+In process counters and latency histograms for the import.  The stages of ImgHandler, VideoHandler,
+DuplicateImageRemover.check_image and FileHashDB record into the shared registry (metrics), import_media.py exports
+it as json at the end of a run and can serve it live in the Prometheus text format.
+
+    from utils.metrics import metrics
+
+    @metrics.timed("image_stage_seconds", stage="read")
+    def read_stage(self, job): ...
+
+    with metrics.timer("import_scan_seconds"):
+        ...
+    metrics.inc("image_read_bytes_total", len(data))
+
+Recording is a perf_counter pair, a bisect and a dict update under a lock (a few microseconds).  Histograms use
+fixed buckets, so they can be merged across worker processes (see merge) and percentiles are bucket upper bounds.
+"""
+import json
+import time
+import functools
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class _Histogram:
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self, size):
+        self.counts = [0] * size                # per bucket (not cumulative), the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+
+class _Timer:
+    """ Context manager returned by MetricsRegistry.timer """
+    __slots__ = ("registry", "name", "labels", "start")
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class MetricsRegistry:
+    def __init__(self, namespace="media", buckets=BUCKETS):
+        self.namespace = namespace              # prefix of the Prometheus metric names
+        self.buckets = tuple(buckets)           # histogram bucket upper bounds in seconds
+        self.enabled = True                     # False turns recording into a no-op
+        self.reset()
+
+    def reset(self):
+        """ Drops everything recorded (import workers start empty, they inherit the parent's registry on fork) """
+        self._lock = threading.Lock()
+        self._counters = {}                     # (name, labels) -> value
+        self._histograms = {}                   # (name, labels) -> _Histogram
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items())) if labels else ()
+
+    def inc(self, name, value=1, **labels):
+        """ Adds value to a counter """
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """ Records a duration in a histogram """
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(len(self.buckets) + 1)
+            histogram.counts[bisect_left(self.buckets, seconds)] += 1
+            histogram.count += 1
+            histogram.sum += seconds
+            if seconds > histogram.max:
+                histogram.max = seconds
+
+    def timer(self, name, **labels):
+        """ Context manager recording the duration of its block """
+        return _Timer(self, name, labels)
+
+    def timed(self, name, **labels):
+        """ Decorator recording the duration of every call (calls that raise are recorded too) """
+        def decorate(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - start, **labels)
+            return wrapper
+        return decorate
+
+    def _quantile(self, histogram, q):
+        """ Upper bound of the bucket holding the q quantile (max for the +Inf bucket) """
+        target = q * histogram.count
+        seen = 0
+        for bound, count in zip(self.buckets, histogram.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, histogram.max)
+        return histogram.max
+
+    def snapshot(self):
+        """ Everything recorded as a json serializable dict, the format of write_json and merge """
+        with self._lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value}
+                        for (name, labels), value in sorted(self._counters.items())]
+            histograms = [{"name": name, "labels": dict(labels), "count": h.count, "sum": h.sum, "max": h.max,
+                           "mean": h.sum / h.count if h.count else 0.0, "p50": self._quantile(h, 0.5),
+                           "p95": self._quantile(h, 0.95), "p99": self._quantile(h, 0.99), "buckets": list(h.counts)}
+                          for (name, labels), h in sorted(self._histograms.items())]
+        return {"bucket_bounds": list(self.buckets), "counters": counters, "histograms": histograms}
+
+    def merge(self, snapshot):
+        """ Adds a snapshot (of an import worker) to this registry.  Both must use the same buckets """
+        if list(snapshot["bucket_bounds"]) != list(self.buckets):
+            raise ValueError("Can't merge metrics recorded with different histogram buckets")
+        with self._lock:
+            for counter in snapshot["counters"]:
+                key = self._key(counter["name"], counter["labels"])
+                self._counters[key] = self._counters.get(key, 0) + counter["value"]
+            for entry in snapshot["histograms"]:
+                key = self._key(entry["name"], entry["labels"])
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = _Histogram(len(self.buckets) + 1)
+                histogram.counts = [a + b for a, b in zip(histogram.counts, entry["buckets"])]
+                histogram.count += entry["count"]
+                histogram.sum += entry["sum"]
+                histogram.max = max(histogram.max, entry["max"])
+
+    def write_json(self, path, **info):
+        """ Writes the snapshot to path, info (run id, mode, ...) is added at the top level """
+        with open(path, "w") as file:
+            json.dump(dict(info, **self.snapshot()), file, indent=2)
+        return path
+
+    def prometheus_text(self):
+        """ Prometheus text exposition format (version 0.0.4) """
+        def label_text(labels, **extra):
+            labels = dict(labels, **extra)
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+        snapshot = self.snapshot()
+        lines = []
+        typed = set()
+        for counter in snapshot["counters"]:
+            name = f"{self.namespace}_{counter['name']}"
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{label_text(counter['labels'])} {counter['value']}")
+        for histogram in snapshot["histograms"]:
+            name = f"{self.namespace}_{histogram['name']}"
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), histogram["buckets"]):
+                cumulative += count
+                lines.append(f"{name}_bucket{label_text(histogram['labels'], le=bound)} {cumulative}")
+            lines.append(f"{name}_sum{label_text(histogram['labels'])} {histogram['sum']}")
+            lines.append(f"{name}_count{label_text(histogram['labels'])} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="127.0.0.1"):
+        """ Serves prometheus_text over http on a daemon thread.  Returns the server, stop it with shutdown() """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass                                # don't print every scrape
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        return server
+
+    def format_table(self, limit=15):
+        """ Histograms by total time, the summary printed at the end of an import """
+        histograms = sorted(self.snapshot()["histograms"], key=lambda h: h["sum"], reverse=True)[:limit]
+        lines = [f"{'timer':<44}  {'count':>7}  {'total (s)':>9}  {'mean (ms)':>9}  {'p95 (ms)':>9}"]
+        for histogram in histograms:
+            labels = ",".join(f"{key}={value}" for key, value in histogram["labels"].items())
+            name = f"{histogram['name']}{{{labels}}}" if labels else histogram["name"]
+            lines.append(f"{name:<44}  {histogram['count']:>7}  {histogram['sum']:>9.2f}  "
+                         f"{histogram['mean'] * 1e3:>9.2f}  {histogram['p95'] * 1e3:>9.2f}")
+        return "\n".join(lines)
+
+
+metrics = MetricsRegistry()                     # shared by the handlers of this process
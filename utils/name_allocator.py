@@ -0,0 +1,78 @@
+"""
+Destination filename allocator.  Each output directory is listed once, after that names are allocated from memory:
+burst photos that all map to the same YYYYMMDD_HHMMSS.jpg get name, name-01, name-02, ... without a stat call per
+candidate.  Names are still claimed with an O_EXCL create, so other import workers (threads or processes) writing
+to the same directory never get the same name.
+"""
+import os
+import threading
+
+
+class NameAllocator:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dirs = set()                  # directories known to exist
+        self._names = {}                    # directory -> set of names taken (listed once, then kept up to date)
+        self._counters = {}                 # (directory, base, ext) -> next counter to try
+
+    def ensure_dir(self, directory):
+        """ Creates directory if it doesn't exist, only the first call for a directory touches the filesystem """
+        if directory in self._dirs:
+            return
+        os.makedirs(directory, exist_ok=True)               # exist_ok in case another import worker created it first
+        with self._lock:
+            self._dirs.add(directory)
+
+    def reserve(self, filepath):
+        """
+        Same naming as FileTools.get_unique_filename (name, name-01, name-02, ...): claims the first free
+        name by atomically creating an empty placeholder, and creates the directory if needed.
+
+        Returns:
+            reserved filepath, the caller overwrites the empty placeholder
+        """
+        directory, filename = os.path.split(filepath)
+        base, ext = os.path.splitext(filename)
+        self.ensure_dir(directory)
+
+        with self._lock:
+            names = self._listing(directory)
+            key = (directory, base, ext)
+            counter = self._counters.get(key, 0)            # 0 is the name itself, N is name-NN
+            while True:
+                candidate = filename if counter == 0 else f"{base}-{counter:02d}{ext}"
+                counter += 1
+                if candidate in names:
+                    continue
+                try:
+                    fd = os.open(os.path.join(directory, candidate), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                    os.close(fd)
+                except FileExistsError:                     # created by another worker since the listing
+                    names.add(candidate)
+                    continue
+                names.add(candidate)
+                self._counters[key] = counter
+                return os.path.join(directory, candidate)
+
+    def release(self, filepath):
+        """ Removes a placeholder created by reserve if nothing was written to it, its name can be reserved again """
+        directory, filename = os.path.split(filepath)
+        try:
+            if os.path.getsize(filepath) != 0:
+                return
+            os.remove(filepath)
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self._names.get(directory, set()).discard(filename)
+            for key in [key for key in self._counters if key[0] == directory]:
+                _, base, ext = key
+                if filename == base + ext or (filename.startswith(base + "-") and filename.endswith(ext)):
+                    del self._counters[key]                 # rescan this base so the freed name is reused
+
+    def _listing(self, directory):
+        names = self._names.get(directory)
+        if names is None:
+            names = {entry.name for entry in os.scandir(directory)}
+            self._names[directory] = names
+        return names
@@ -0,0 +1,51 @@
+"""
+Precompiled directory matcher.  The directories are resolved once when they're added, after that checking whether a
+path is inside any of them is a string comparison (a bisect over the sorted prefixes), no filesystem calls.
+"""
+import os
+from bisect import bisect_right
+
+
+def _normalize(path):
+    """ Absolute, normalized, case folded on Windows and with a trailing separator so "/a/b" doesn't match "/a/bc" """
+    return os.path.join(os.path.normcase(os.path.normpath(os.path.abspath(path))), "")
+
+
+class PathMatcher:
+    """
+    Matches paths against a set of directories (a path matches if it is one of the directories or inside one).
+
+    Each directory is stored as given and resolved (symlinks followed), so either spelling matches.  Candidate paths
+    are only normalized, not resolved: paths from a directory walk match as long as the walk didn't go through a
+    symlinked directory.
+    """
+    def __init__(self, directories=()):
+        self._prefixes = []                 # sorted, none of them inside another (see matches)
+        self.add(directories)
+
+    def add(self, directories):
+        """ Adds a directory or a list of directories """
+        if isinstance(directories, str):
+            directories = [directories]
+        prefixes = set(self._prefixes)
+        for directory in directories:
+            prefixes.add(_normalize(directory))
+            prefixes.add(_normalize(os.path.realpath(directory)))
+
+        # Drop directories nested in another one.  Without nesting, the only prefix that can contain a path is the
+        # greatest prefix <= the path, so matches needs a single bisect
+        self._prefixes = []
+        for prefix in sorted(prefixes):
+            if not self._prefixes or not prefix.startswith(self._prefixes[-1]):
+                self._prefixes.append(prefix)
+
+    def matches(self, path):
+        """ True if path is one of the directories or nested inside one of them """
+        if not self._prefixes:
+            return False
+        path = _normalize(path)
+        index = bisect_right(self._prefixes, path) - 1
+        return index >= 0 and path.startswith(self._prefixes[index])
+
+    def __len__(self):
+        return len(self._prefixes)
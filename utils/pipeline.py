@@ -0,0 +1,134 @@
+import queue
+import threading
+
+
+class StagedPipeline():
+    """
+    Runs items through a list of stages joined by bounded queues.
+
+    - Each stage is (name, func, workers).  func takes the value from the previous stage and returns the
+      value passed on to the next stage.
+    - A stage can be (name, func, workers, batch_size) instead.  func then takes a list of up to batch_size
+      values (whatever is queued, it doesn't wait for a full batch) and returns a list of results in the
+      same order.  If it raises, every item of the batch fails.
+    - Every stage runs on its own pool of threads, so NAS reads/writes of one file overlap with the
+      decode/encode of others.
+    - Queues are bounded by queue_size, a full queue blocks the stage feeding it (back-pressure), so the
+      number of files held in memory never exceeds roughly (number of stages * (queue_size + workers)).
+    - If a stage raises, the item skips the remaining stages and is yielded with the exception.
+    """
+
+    _DONE = object()                    # sentinel that shuts down a stage worker
+
+    def __init__(self, stages, queue_size=8):
+        if not stages:
+            raise ValueError("StagedPipeline needs at least one stage")
+        self.stages = []
+        for stage in stages:
+            name, func, workers = stage[:3]
+            batch_size = stage[3] if len(stage) > 3 else None
+            self.stages.append((name, func, max(1, int(workers)), max(1, int(batch_size)) if batch_size else None))
+        self.queue_size = max(1, int(queue_size))
+
+    def run(self, items):
+        """
+        Generator that feeds items through every stage.
+
+        Yields:
+            (item, value, error): item is the original input, value is the return value of the last stage
+            (None on failure) and error is a StageError naming the stage that failed (None on success).
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = []
+
+        # feed the first queue from a thread so the caller can start consuming results right away
+        def feeder():
+            for item in items:
+                queues[0].put([item, item, None])
+            for _ in range(self.stages[0][2]):
+                queues[0].put(self._DONE)
+
+        threads.append(threading.Thread(target=feeder, name="pipeline-feeder", daemon=True))
+
+        for index, (name, func, workers, batch_size) in enumerate(self.stages):
+            in_queue = queues[index]
+            out_queue = queues[index + 1]
+            next_workers = self.stages[index + 1][2] if index + 1 < len(self.stages) else 1
+            remaining = [workers]                       # workers of this stage still running
+            lock = threading.Lock()
+
+            def worker(name=name, func=func, batch_size=batch_size, in_queue=in_queue, out_queue=out_queue,
+                       next_workers=next_workers, remaining=remaining, lock=lock):
+                done = False
+                while not done:
+                    entry = in_queue.get()
+                    if entry is self._DONE:
+                        break
+                    if batch_size is None:
+                        if entry[2] is None:            # skip stages once an item has failed
+                            try:
+                                entry[1] = func(entry[1])
+                            except Exception as e:
+                                entry[1] = None
+                                entry[2] = StageError(name, e)
+                        out_queue.put(entry)
+                        continue
+
+                    # batched stage, take whatever else is already queued
+                    batch = [entry]
+                    while len(batch) < batch_size:
+                        try:
+                            entry = in_queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        if entry is self._DONE:
+                            done = True
+                            break
+                        batch.append(entry)
+
+                    pending = [entry for entry in batch if entry[2] is None]
+                    if pending:
+                        try:
+                            results = func([entry[1] for entry in pending])
+                            for entry, result in zip(pending, results):
+                                entry[1] = result
+                        except Exception as e:
+                            for entry in pending:
+                                entry[1] = None
+                                entry[2] = StageError(name, e)
+                    for entry in batch:
+                        out_queue.put(entry)
+
+                # last worker of a stage to finish shuts down the next stage
+                with lock:
+                    remaining[0] -= 1
+                    last_worker = remaining[0] == 0
+                if last_worker:
+                    for _ in range(next_workers):
+                        out_queue.put(self._DONE)
+
+            for i in range(workers):
+                threads.append(threading.Thread(target=worker, name=f"pipeline-{name}-{i}", daemon=True))
+
+        for thread in threads:
+            thread.start()
+
+        # drain the output of the last stage
+        results = queues[-1]
+        while True:
+            entry = results.get()
+            if entry is self._DONE:
+                break
+            yield tuple(entry)
+
+        for thread in threads:
+            thread.join()
+
+
+class StageError(Exception):
+    """ Wraps an exception raised inside a pipeline stage with the name of the stage """
+
+    def __init__(self, stage, error):
+        super().__init__(f"{stage} stage failed: {error}")
+        self.stage = stage
+        self.error = error
@@ -0,0 +1,182 @@
+"""
+Native QuickTime/MP4 metadata reader.  Reads the creation dates from the moov atom of a .mov/.mp4 by seeking from
+atom header to atom header, the media data (mdat) itself is never read.
+
+Dates are returned under the same names exiftool uses, so callers can fall back to exiftool for anything else:
+- QuickTime:CreateDate          mvhd creation time (UTC)
+- QuickTime:CreationDate        com.apple.quicktime.creationdate from the keys/ilst metadata (local time)
+- QuickTime:ContentCreateDate   ©day from udta (or the udta/meta/ilst item list)
+"""
+import io
+import re
+import struct
+from datetime import datetime, timedelta, timezone
+
+QUICKTIME_EPOCH = datetime(1904, 1, 1, tzinfo=timezone.utc)
+CREATIONDATE_KEY = b"com.apple.quicktime.creationdate"
+MAX_ATOM_BYTES = 4 * 1024 * 1024            # never read more than this for a metadata atom
+
+_DATE_PATTERN = re.compile(r"(\d{4})[:\-](\d{2})[:\-](\d{2})[T ](\d{2}):(\d{2}):(\d{2})")
+
+
+def normalize_date(value):
+    """
+    Converts the date formats found in videos ("2019-03-04T05:06:07-0800", "2019:03:04 05:06:07+01:00", ...) to
+    'YYYY:MM:DD HH:MM:SS'.  The time zone offset is dropped, the local time is kept.  None if value isn't a date.
+    """
+    if not value:
+        return None
+    match = _DATE_PATTERN.search(str(value))
+    if match is None or match.group(1) == "0000":
+        return None
+    return "{}:{}:{} {}:{}:{}".format(*match.groups())
+
+
+def read_quicktime_dates(source):
+    """
+    Returns {exiftool tag name: 'YYYY:MM:DD HH:MM:SS'} for the creation dates found in the file.
+    - source: filepath or a seekable binary file object
+    - {} if there are no dates, raises ValueError if the file isn't a QuickTime/MP4 file or is malformed
+    """
+    if isinstance(source, str):
+        with open(source, "rb") as file:
+            return _read_quicktime_dates(file)
+    return _read_quicktime_dates(source)
+
+
+def _read_quicktime_dates(file):
+    file.seek(0, io.SEEK_END)
+    file_size = file.tell()
+    file.seek(0)
+
+    try:
+        first = file.read(8)
+        if len(first) < 8 or first[4:8] not in (b"ftyp", b"moov", b"mdat", b"wide", b"free", b"skip", b"pnot"):
+            raise ValueError("Not a QuickTime/MP4 file")
+        file.seek(0)
+
+        for atom_type, start, end in _atoms(file, 0, file_size):
+            if atom_type == b"moov":
+                return _moov_dates(file, start, end)
+    except (struct.error, IndexError) as e:
+        raise ValueError(f"Malformed atom: {e}")
+    return {}
+
+
+def _atoms(file, start, end):
+    """ Yields (atom type, payload start, payload end) for every atom between start and end, seeking past payloads """
+    position = start
+    while position + 8 <= end:
+        file.seek(position)
+        size, atom_type = struct.unpack(">I4s", file.read(8))
+        payload = position + 8
+        if size == 1:                                               # 64 bit size
+            size = struct.unpack(">Q", file.read(8))[0]
+            payload += 8
+        elif size == 0:                                             # atom runs to the end of its parent
+            size = end - position
+        if size < payload - position or position + size > end:
+            raise ValueError(f"Malformed atom size: {atom_type!r}")
+        yield atom_type, payload, position + size
+        position += size
+
+
+def _read_payload(file, start, end):
+    if end - start > MAX_ATOM_BYTES:
+        raise ValueError("Metadata atom too large")
+    file.seek(start)
+    return file.read(end - start)
+
+
+def _moov_dates(file, start, end):
+    dates = {}
+    for atom_type, atom_start, atom_end in _atoms(file, start, end):
+        if atom_type == b"mvhd":
+            create_date = _mvhd_create_date(_read_payload(file, atom_start, min(atom_end, atom_start + 32)))
+            if create_date:
+                dates["QuickTime:CreateDate"] = create_date
+        elif atom_type == b"meta":
+            creation_date = _mdta_creation_date(file, atom_start, atom_end)
+            if creation_date:
+                dates["QuickTime:CreationDate"] = creation_date
+        elif atom_type == b"udta":
+            content_date = _udta_content_date(file, atom_start, atom_end)
+            if content_date:
+                dates["QuickTime:ContentCreateDate"] = content_date
+    return dates
+
+
+def _mvhd_create_date(data):
+    """ mvhd creation time (seconds since 1904, UTC), None if unset """
+    if len(data) < 8 or (data[0] == 1 and len(data) < 12):
+        raise ValueError("Truncated mvhd atom")
+    version = data[0]
+    if version == 1:
+        seconds = struct.unpack(">Q", data[4:12])[0]
+    else:
+        seconds = struct.unpack(">I", data[4:8])[0]
+    if seconds == 0:
+        return None
+    return (QUICKTIME_EPOCH + timedelta(seconds=seconds)).strftime("%Y:%m:%d %H:%M:%S")
+
+
+def _meta_children_start(file, start):
+    """ QuickTime meta atoms are plain atoms, MP4 (ISO) meta atoms are full boxes with 4 bytes of version/flags """
+    file.seek(start + 4)
+    return start if file.read(4) == b"hdlr" else start + 4
+
+
+def _mdta_creation_date(file, start, end):
+    """ Apple mdta metadata: keys lists the key names, ilst holds the values indexed by key number """
+    start = _meta_children_start(file, start)
+    keys = {}
+    ilst = None
+    for atom_type, atom_start, atom_end in _atoms(file, start, end):
+        if atom_type == b"keys":
+            data = _read_payload(file, atom_start, atom_end)
+            count = struct.unpack(">I", data[4:8])[0]
+            offset = 8
+            for index in range(1, count + 1):
+                key_size = struct.unpack(">I", data[offset:offset + 4])[0]
+                if key_size < 8:
+                    break
+                keys[index] = data[offset + 8:offset + key_size]        # skip size + namespace
+                offset += key_size
+        elif atom_type == b"ilst":
+            ilst = (atom_start, atom_end)
+
+    key_index = next((index for index, name in keys.items() if name == CREATIONDATE_KEY), None)
+    if key_index is None or ilst is None:
+        return None
+    for atom_type, atom_start, atom_end in _atoms(file, *ilst):
+        if struct.unpack(">I", atom_type)[0] == key_index:
+            return normalize_date(_data_atom_text(file, atom_start, atom_end))
+    return None
+
+
+def _data_atom_text(file, start, end):
+    """ Text of the 'data' atom inside an ilst item """
+    for atom_type, atom_start, atom_end in _atoms(file, start, end):
+        if atom_type == b"data":
+            data = _read_payload(file, atom_start, atom_end)
+            return data[8:].decode("utf-8", "replace")                  # skip type indicator + locale
+    return None
+
+
+def _udta_content_date(file, start, end):
+    for atom_type, atom_start, atom_end in _atoms(file, start, end):
+        if atom_type == b"\xa9day":
+            data = _read_payload(file, atom_start, atom_end)
+            if data[4:8] == b"data":                                    # iTunes style item
+                return normalize_date(_data_atom_text(file, atom_start, atom_end))
+            # QuickTime user data text: 16 bit length, 16 bit language, text
+            length = struct.unpack(">H", data[:2])[0]
+            return normalize_date(data[4:4 + length].decode("utf-8", "replace"))
+        if atom_type == b"meta":                                        # MP4 style udta/meta/ilst/©day
+            meta_start = _meta_children_start(file, atom_start)
+            for child_type, child_start, child_end in _atoms(file, meta_start, atom_end):
+                if child_type == b"ilst":
+                    for item_type, item_start, item_end in _atoms(file, child_start, child_end):
+                        if item_type == b"\xa9day":
+                            return normalize_date(_data_atom_text(file, item_start, item_end))
+    return None
@@ -0,0 +1,110 @@
+"""
+Failure aware retries for the import loop.  Errors are classified as permanent (the file itself is bad: decode and
+format errors, missing files) or transient (I/O errors and timeouts of the NAS, a locked media.db).  Permanent
+failures aren't retried, transient ones are re-queued behind the rest of the batch and retried after an
+exponential backoff.
+"""
+import json
+import time
+import errno
+import sqlite3
+from PIL import UnidentifiedImageError
+from utils.utils import CopyVerificationError
+from utils.metrics import metrics
+
+PERMANENT = "permanent"
+TRANSIENT = "transient"
+
+TRANSIENT_ERRNOS = {
+    errno.EIO, errno.EAGAIN, errno.EBUSY, errno.EINTR, errno.ETIMEDOUT, errno.ESTALE, errno.ECONNRESET,
+    errno.ECONNABORTED, errno.ECONNREFUSED, errno.EHOSTDOWN, errno.EHOSTUNREACH, errno.ENETDOWN,
+    errno.ENETUNREACH, errno.ENOLCK, errno.ENOSPC,
+}
+PERMANENT_ERRORS = (UnidentifiedImageError, SyntaxError, ValueError, TypeError, KeyError, IndexError,
+                    FileNotFoundError, IsADirectoryError, NotADirectoryError, PermissionError)
+
+
+def classify_error(error):
+    """ Returns PERMANENT or TRANSIENT for an exception raised while importing a file """
+    error = getattr(error, "error", error)                  # unwrap utils.pipeline.StageError
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return TRANSIENT
+    if isinstance(error, sqlite3.OperationalError):
+        return TRANSIENT                                    # database is locked / busy
+    if isinstance(error, PERMANENT_ERRORS):                 # decode/format errors (Pillow raises SyntaxError and ValueError too)
+        return PERMANENT
+    if isinstance(error, CopyVerificationError):
+        return TRANSIENT                                    # the copy is retried
+    if isinstance(error, OSError):
+        # errors from the OS carry an errno, Pillow raises OSError without one for truncated/broken image data
+        return TRANSIENT if error.errno in TRANSIENT_ERRNOS else PERMANENT
+    return PERMANENT
+
+
+def describe_error(error):
+    """ Picklable summary of an exception: {"kind", "type", "message"} """
+    cause = getattr(error, "error", error)
+    return {"kind": classify_error(error), "type": type(cause).__name__, "message": str(cause)}
+
+
+class RetryScheduler:
+    """
+    Runs batches of items through an attempt function and retries the transient failures.
+
+    attempt_batch(items) is called with the items due for an attempt and yields (item, failure) for each, failure
+    is None on success or a describe_error dict.  Every item is attempted once before any is retried: the
+    transient failures of a round are collected and attempted together in the next round, after a backoff of
+    base_delay * 2 ** (round - 1) seconds (capped at max_delay).  Items fail for good on a permanent error or
+    after max_attempts.
+    """
+    def __init__(self, max_attempts=4, base_delay=2.0, max_delay=60.0, logger=None):
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.logger = logger
+        self.failures = []                                  # structured report, see write_report
+
+    def backoff(self, retry_round):
+        return min(self.max_delay, self.base_delay * 2 ** (retry_round - 1))
+
+    def run(self, items, attempt_batch):
+        """
+        Generator yielding (item, failure) once per item, when it succeeded or failed for good.
+        """
+        attempts = {}
+        due = list(items)
+        retry_round = 0
+        while due:
+            retry = []
+            for item, failure in attempt_batch(due):
+                attempts[item] = attempts.get(item, 0) + 1
+                if failure is None:
+                    yield item, None
+                elif failure["kind"] == TRANSIENT and attempts[item] < self.max_attempts:
+                    retry.append(item)
+                    metrics.inc("import_retries_total", kind=failure["type"])
+                    self._log(f"Transient error importing [{item}] (attempt {attempts[item]}): {failure['type']}: {failure['message']}")
+                else:
+                    self.failures.append(dict(failure, path=item, attempts=attempts[item]))
+                    self._log(f"Failed importing [{item}] after {attempts[item]} attempt(s), {failure['kind']} "
+                              f"{failure['type']}: {failure['message']}")
+                    yield item, failure
+
+            if retry:
+                retry_round += 1
+                delay = self.backoff(retry_round)
+                self._log(f"Retrying {len(retry)} files in {delay:.1f}s")
+                time.sleep(delay)
+            due = retry
+
+    def write_report(self, path, **info):
+        """ Writes the failures as json ({"failures": [...], **info}), nothing is written if there are none """
+        if not self.failures:
+            return None
+        with open(path, "w") as file:
+            json.dump(dict(info, failures=self.failures), file, indent=2)
+        return path
+
+    def _log(self, message):
+        if self.logger is not None:
+            self.logger.info(message)
@@ -0,0 +1,118 @@
+"""
+Matches media files to their .json sidecars from directory listings, so finding a sidecar never needs a stat call.
+
+Besides name.json and name.ext.json, the names Google Takeout gives sidecars are matched:
+- the sidecar name (without .json) is cut to 46 characters:  a_very_long_name_....jpg -> a_very_long_name_....j.json
+- duplicate suffixes move behind the extension:             IMG_1234(1).jpg -> IMG_1234.jpg(1).json
+- newer exports add ".supplemental-metadata" (also cut):     IMG_1234.jpg.supplemental-metadata.json
+- edited copies share the original's sidecar:               IMG_1234-edited.jpg -> IMG_1234.jpg.json
+"""
+import os
+import re
+import threading
+
+TAKEOUT_NAME_LIMIT = 46                         # max length of a Takeout sidecar name without ".json"
+SUPPLEMENTAL_SUFFIX = ".supplemental-metadata"
+EDITED_SUFFIXES = ("-edited",)
+
+_DUPLICATE_SUFFIX = re.compile(r"^(.*?)(\(\d+\))$")
+
+
+def sidecar_candidates(name):
+    """ Returns the possible sidecar names of the media file name, most specific first """
+    base, ext = os.path.splitext(name)
+    candidates = [name + ".json", base + ".json"]
+
+    counter = ""
+    match = _DUPLICATE_SUFFIX.match(base)
+    if match:
+        base, counter = match.groups()
+    originals = [base] + [base[:-len(suffix)] for suffix in EDITED_SUFFIXES if base.endswith(suffix)]
+
+    for original in originals:
+        for stem in (original + ext, original + ext + SUPPLEMENTAL_SUFFIX, original):
+            candidates.append(stem[:TAKEOUT_NAME_LIMIT] + counter + ".json")
+    return list(dict.fromkeys(candidates))      # drop repeats, keep the order
+
+
+def sidecar_sharers(name):
+    """ Returns the names of the other media files that can share the sidecar of name (the original and its edited copies) """
+    base, ext = os.path.splitext(name)
+    counter = ""
+    match = _DUPLICATE_SUFFIX.match(base)
+    if match:
+        base, counter = match.groups()
+    original = next((base[:-len(suffix)] for suffix in EDITED_SUFFIXES if base.endswith(suffix)), base)
+    names = [original + counter + ext] + [original + suffix + counter + ext for suffix in EDITED_SUFFIXES]
+    return [other for other in names if other != name]
+
+
+def match_sidecar(name, json_names):
+    """ Returns the name of the .json sidecar for the media file name, or None.  json_names: set of names in its directory """
+    for candidate in sidecar_candidates(name):
+        if candidate in json_names:
+            return candidate
+    return None
+
+
+class SidecarIndex:
+    """
+    Media filepath -> sidecar filepath.  MediaScanner fills it while it walks the import directory, files that
+    weren't scanned are matched from a listing of their directory (listed once, then cached).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sidecars = {}                     # media filepath -> sidecar filepath or None
+        self._json_names = {}                   # directory -> set of .json names in it
+
+    def add_directory(self, directory, json_names):
+        """ Stores the .json names of a directory listed by the scan """
+        with self._lock:
+            self._json_names[directory] = json_names
+
+    def add(self, path, sidecar):
+        """ Stores the sidecar (filepath or None) matched for the media file at path """
+        with self._lock:
+            self._sidecars[path] = sidecar
+
+    def lookup(self, path):
+        """ Returns the sidecar filepath of the media file at path, or None if it doesn't have one """
+        with self._lock:
+            if path in self._sidecars:
+                return self._sidecars[path]
+
+        directory, name = os.path.split(path)
+        json_names = self._listing(directory)
+        sidecar = match_sidecar(name, json_names)
+        sidecar = os.path.join(directory, sidecar) if sidecar is not None else None
+        self.add(path, sidecar)
+        return sidecar
+
+    def is_shared(self, path):
+        """
+        True if another media file that is still in the import directory uses the sidecar of path.  An original and
+        its -edited copy share one, it may only be deleted (delete_after_copy) once both were imported.  Checked on
+        the filesystem rather than counted in the index, so it also holds across import workers.
+        """
+        sidecar = self.lookup(path)
+        directory, name = os.path.split(path)
+        for other in sidecar_sharers(name):
+            other_path = os.path.join(directory, other)
+            if os.path.exists(other_path) and self.lookup(other_path) == sidecar:
+                return True
+        return False
+
+    def _listing(self, directory):
+        with self._lock:
+            json_names = self._json_names.get(directory)
+        if json_names is None:
+            try:
+                with os.scandir(directory or ".") as it:
+                    json_names = {entry.name for entry in it if entry.name.endswith(".json")}
+            except OSError:
+                json_names = set()
+            self.add_directory(directory, json_names)
+        return json_names
+
+    def __len__(self):
+        return len(self._sidecars)
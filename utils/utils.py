@@ -1,10 +1,27 @@
 import os
+import time
+import errno
+import shutil
 import ctypes
+import hashlib
 import platform
 import logging
 from pathlib import Path
 from datetime import datetime
 
+try:
+    import fcntl                        # reflink clones (FICLONE ioctl), not available on Windows
+except ImportError:
+    fcntl = None
+
+FICLONE = 0x40049409                    # linux ioctl: share the source extents with the destination (btrfs, xfs, ...)
+TRANSFER_CHUNK_SIZE = 8 * 1024 * 1024   # bytes per copy_file_range / sendfile / read call
+DIGEST_ALGORITHM = "blake2b"            # content digest of verified copies, see FileTools.verified_copy
+
+
+class CopyVerificationError(OSError):
+    """ The digest of a written file doesn't match the data that was written """
+
 # Sets up logger function
 def setup_logger(name, log_filename, log_path, level=logging.DEBUG):
     formatter = logging.Formatter(fmt='%(asctime)s %(message)s', datefmt="%Y-%m-%d %H:%M:%S - ")
@@ -59,7 +76,7 @@ class FileTools():
     def ensure_folder_exists(folder_path):
         """ Checks to see if folder path exists and creates it if it doesn't exits  """
         if not os.path.exists(folder_path):
-            os.makedirs(folder_path)
+            os.makedirs(folder_path, exist_ok=True)         # exist_ok in case another import worker created it first
         
     def get_unique_filename(filepath):
         """
@@ -80,7 +97,159 @@ class FileTools():
             unique_fielpath = f"{base}-{counter:02d}{ext}"
             counter += 1
         return unique_fielpath
-    
+
+    def transfer_file(src, dst, move=False, verify=False, algorithm=DIGEST_ALGORITHM):
+        """
+        Copies (or moves) src to dst with the cheapest method the platform and filesystems allow.  dst may be
+        an empty placeholder from NameAllocator.reserve, it's overwritten.  Metadata is copied like shutil.copy2.
+
+        Methods, tried in order:
+            - rename:           move=True and src/dst on the same device, no data is copied
+            - reflink:          FICLONE clone on filesystems that support it (btrfs, xfs), no data is copied
+            - copy_file_range:  in kernel copy, server side copy on NFS/SMB mounts that support it
+            - sendfile:         in kernel copy between file descriptors
+            - read/write:       portable fallback with large buffers
+
+        verify=True copies with verified_copy instead (unless the file is renamed, which doesn't copy any data):
+        the in kernel methods never hand the bytes to us, so hashing them would need an extra read of the source.
+
+        Returns:
+            dict with the method used, bytes transferred, seconds and bytes_per_sec.  Verified copies add the
+            content digest under "digest"
+        """
+        start = time.perf_counter()
+        size = os.path.getsize(src)
+
+        if move and os.stat(src).st_dev == os.stat(os.path.dirname(os.path.abspath(dst))).st_dev:
+            try:
+                os.replace(src, dst)
+                return FileTools._transfer_stats("rename", size, start)
+            except OSError:
+                pass                                            # e.g. different bind mounts of the same device, copy instead
+
+        if verify:
+            return FileTools.verified_copy(src, dst, move=move, algorithm=algorithm)
+
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            method, copied = FileTools._copy_data(fsrc.fileno(), fdst.fileno(), size)
+            if copied < size:                                   # portable fallback for whatever is left
+                fsrc.seek(copied)
+                fdst.seek(copied)
+                shutil.copyfileobj(fsrc, fdst, TRANSFER_CHUNK_SIZE)
+                method = method if copied else "read/write"
+
+        shutil.copystat(src, dst)
+        if move:
+            os.remove(src)
+        return FileTools._transfer_stats(method, size, start)
+
+    def verified_copy(src, dst, move=False, algorithm=DIGEST_ALGORITHM):
+        """
+        Copies src to dst and verifies the copy.  The source is hashed in the same read pass that copies it, so
+        only the destination is read a second time (from disk, see file_digest).  A copy that doesn't match is
+        removed and CopyVerificationError is raised, src is only removed (move=True) once the copy is verified.
+
+        Returns:
+            dict with the method, bytes, seconds and bytes_per_sec (like transfer_file) plus the hex digest
+        """
+        start = time.perf_counter()
+        source_digest = hashlib.new(algorithm)
+        size = 0
+
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            buffer = bytearray(TRANSFER_CHUNK_SIZE)
+            view = memoryview(buffer)
+            while True:
+                count = fsrc.readinto(buffer)
+                if not count:
+                    break
+                source_digest.update(view[:count])
+                fdst.write(view[:count])
+                size += count
+            fdst.flush()
+            os.fsync(fdst.fileno())                             # on disk before it's read back
+
+        digest = source_digest.hexdigest()
+        FileTools._verify_digest(dst, digest, algorithm)
+        shutil.copystat(src, dst)
+        if move:
+            os.remove(src)
+        stats = FileTools._transfer_stats("verified read/write", size, start)
+        stats["digest"] = digest
+        return stats
+
+    def write_verified(data, dst, algorithm=DIGEST_ALGORITHM):
+        """
+        Writes data (bytes) to dst and verifies it by reading dst back.  The digest of data is computed in memory.
+        A file that doesn't match is removed and CopyVerificationError is raised.
+
+        Returns:
+            hex digest of data
+        """
+        digest = hashlib.new(algorithm, data).hexdigest()
+        with open(dst, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        FileTools._verify_digest(dst, digest, algorithm)
+        return digest
+
+    def file_digest(path, algorithm=DIGEST_ALGORITHM, drop_cache=True):
+        """
+        Returns the hex digest of the file at path.  drop_cache evicts the file from the page cache first (where
+        the platform supports it), so a file that was just written is read back from disk and not from memory.
+        """
+        digest = hashlib.new(algorithm)
+        with open(path, "rb") as file:
+            if drop_cache and hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            for chunk in iter(lambda: file.read(TRANSFER_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _verify_digest(path, expected, algorithm):
+        actual = FileTools.file_digest(path, algorithm)
+        if actual != expected:
+            os.remove(path)                                     # never leave a corrupt copy behind
+            raise CopyVerificationError(f"Copy verification failed for {path}: {algorithm} {actual} != {expected}")
+
+    def _copy_data(src_fd, dst_fd, size):
+        """
+        Copies with the in kernel methods of transfer_file.  Returns (method, bytes copied), stops early
+        (bytes copied < size) when none of them work on this platform / filesystem.
+        """
+        if fcntl is not None and platform.system() == "Linux":
+            try:
+                fcntl.ioctl(dst_fd, FICLONE, src_fd)
+                return "reflink", size
+            except OSError:
+                pass                                            # not supported by the filesystem or across devices
+
+        copied = 0
+        for method in ("copy_file_range", "sendfile"):
+            if not hasattr(os, method):
+                continue
+            try:
+                while copied < size:
+                    if method == "copy_file_range":
+                        sent = os.copy_file_range(src_fd, dst_fd, min(TRANSFER_CHUNK_SIZE, size - copied), copied, copied)
+                    else:
+                        os.lseek(dst_fd, copied, os.SEEK_SET)
+                        sent = os.sendfile(dst_fd, src_fd, copied, min(TRANSFER_CHUNK_SIZE, size - copied))
+                    if sent == 0:
+                        break                                   # src shrank, the fallback finds the real end
+                    copied += sent
+                return method, copied
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP):
+                    raise
+                # not supported here, carry on from copied with the next method
+        return "read/write", copied
+
+    def _transfer_stats(method, size, start):
+        seconds = max(time.perf_counter() - start, 1e-9)
+        return {"method": method, "bytes": size, "seconds": seconds, "bytes_per_sec": size / seconds}
+
     def set_file_creation_date(filepath, created_timestamp):
         """
         Sets the file creation date of the <filepath> given, based on the date defined
@@ -0,0 +1,40 @@
+"""
+Cheap content fingerprints for large media files.  A fingerprint hashes the file size plus a few sampled chunks
+(head, fixed offsets and tail), so a multi GB video is identified by reading about a megabyte.  Files with the
+same fingerprint are almost certainly identical, full_file_hash confirms it when fingerprints collide.
+"""
+import os
+import hashlib
+
+SAMPLE_SIZE = 256 * 1024                    # bytes read per sample
+SAMPLE_OFFSETS = (0.25, 0.5, 0.75)          # samples between the head and tail, as a fraction of the file size
+FULL_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def video_fingerprint(path, sample_size=SAMPLE_SIZE, offsets=SAMPLE_OFFSETS):
+    """
+    Returns (size, fingerprint) of the file at path.  Files smaller than the samples combined are hashed whole.
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(size.to_bytes(8, "little"))
+
+    with open(path, "rb") as file:
+        if size <= sample_size * (len(offsets) + 2):
+            digest.update(file.read())
+        else:
+            positions = [0] + [int(size * offset) for offset in offsets] + [size - sample_size]
+            for position in positions:
+                file.seek(position)
+                digest.update(file.read(sample_size))
+
+    return size, digest.hexdigest()
+
+
+def full_file_hash(path, algorithm="sha256", chunk_size=FULL_HASH_CHUNK_SIZE):
+    """ Streams the whole file through algorithm, only used when two fingerprints collide """
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()